@@ -0,0 +1,303 @@
+#
+# Benchmarks the electrochemistry models (have to be compiled first!)
+#
+# Times ECModel.simulate and POMModel.simulate over grids of mesh, step and
+# data sizes, batch simulation, and ECTimeData loading from synthetic
+# datafiles, and measures the accuracy against the cost of each solver mode
+# relative to a fine reference solution. Results are saved as JSON, to be
+# compared between commits with compare.py, e.g.
+#
+#     $ python benchmarks/benchmark.py --output before.json
+#     $ python benchmarks/benchmark.py --output after.json
+#     $ python benchmarks/compare.py before.json after.json
+#
+from __future__ import print_function
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from math import pi
+
+import numpy as np
+
+import electrochemistry
+
+EC = {
+    'reversed': True,
+    'Estart': 0.5,
+    'Ereverse': -0.1,
+    'omega': 9.0152,
+    'phase': 0,
+    'dE': 0.08,
+    'v': -0.08941,
+    't_0': 0.001,
+    'T': 297.0,
+    'a': 0.07,
+    'c_inf': 1 * 1e-3 * 1e-3,
+    'D': 7.2e-6,
+    'Ru': 8.0,
+    'Cdl': 20.0 * 1e-6,
+    'E0': 0.214,
+    'k0': 0.0101,
+    'alpha': 0.53,
+}
+
+POMS = {
+    'reversed': False,
+    'Estart': 0.6,
+    'Ereverse': -0.1,
+    'omega': 6.05168,
+    'phase': 0,
+    'dE': 20e-3,
+    'v': -0.1043081,
+    't_0': 0.00,
+    'T': 298.2,
+    'a': 0.0707,
+    'c_inf': 0.1 * 1e-3 * 1e-3,
+    'Ru': 50.0,
+    'Cdl': 0.000008,
+    'Gamma': 0.7 * 53.0e-12,
+    'alpha1': 0.5,
+    'alpha2': 0.5,
+    'E01': 0.368,
+    'E02': 0.338,
+    'E11': 0.227,
+    'E12': 0.227,
+    'E21': 0.011,
+    'E22': -0.016,
+    'k01': 7300,
+    'k02': 7300,
+    'k11': 1e4,
+    'k12': 1e4,
+    'k21': 2500,
+    'k22': 2500,
+    'alpha11': 0.5,
+    'alpha12': 0.5,
+    'alpha21': 0.5,
+    'alpha22': 0.5,
+}
+
+GRIDS = {
+    'full': {
+        'ec_Nx': [100, 300, 600],
+        'ec_Nt': [100, 200, 400],
+        'pom_Nt': [200, 600, 2000],
+        'n_times': [1000, 10000, 100000],
+        'batch': [1, 8, 32],
+        'data_rows': [10**5, 10**6],
+    },
+    'quick': {
+        'ec_Nx': [100, 300],
+        'ec_Nt': [100, 200],
+        'pom_Nt': [200, 600],
+        'n_times': [1000, 10000],
+        'batch': [1, 8],
+        'data_rows': [10**5],
+    },
+}
+
+
+def quiet(f, *args, **kwargs):
+    """ calls f, discarding anything it prints """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return f(*args, **kwargs)
+
+
+def measure(f, repeat):
+    """ the best wall time of repeat calls to f, and the peak memory
+    allocated by (numpy and python in) a call, in bytes
+    """
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best, peak
+
+
+def steps(params, times):
+    """ number of fixed time steps taken to simulate up to the last time """
+    return int(np.ceil(params['Nt'] * times[-1] * params['omega'] / (2 * pi)))
+
+
+def simulate_grid(grid, repeat):
+    results = []
+    ec = quiet(electrochemistry.ECModel, EC)
+    pom = quiet(electrochemistry.POMModel, POMS)
+
+    # the same time span (2 * (Ereverse - Estart)) at each number of times
+    ec_end = 2 * abs(ec.params['Ereverse'] - ec.params['Estart'])
+    pom_end = 2 * abs(pom.params['Ereverse'] - pom.params['Estart'])
+    for n_times in grid['n_times']:
+        times = np.linspace(0, ec_end, n_times)
+        for Nx in grid['ec_Nx']:
+            for Nt in grid['ec_Nt']:
+                params = dict(ec.params, Nx=Nx, Nt=Nt)
+                seconds, peak = measure(
+                    lambda: ec.simulate(times, params), repeat)
+                results.append({
+                    'name': 'ec_simulate', 'Nx': Nx, 'Nt': Nt,
+                    'n_times': n_times, 'seconds': seconds,
+                    'steps_per_second': steps(params, times) / seconds,
+                    'peak_memory': peak})
+
+        times = np.linspace(0, pom_end, n_times)
+        for Nt in grid['pom_Nt']:
+            params = dict(pom.params, Nt=Nt)
+            seconds, peak = measure(
+                lambda: pom.simulate(times, params), repeat)
+            results.append({
+                'name': 'pom_simulate', 'Nt': Nt, 'n_times': n_times,
+                'seconds': seconds,
+                'steps_per_second': steps(params, times) / seconds,
+                'peak_memory': peak})
+
+    # batches of perturbed parameter sets, at the default settings
+    names = ['E0', 'k0', 'Cdl']
+    times = np.linspace(0, ec_end, grid['n_times'][0])
+    real = np.array([ec.params[name] for name in names])
+    for batch in grid['batch']:
+        vectors = real * np.random.RandomState(1).uniform(
+            0.95, 1.05, (batch, len(names)))
+        seconds, peak = measure(
+            lambda: ec.simulate_batch(vectors, names, times), repeat)
+        results.append({
+            'name': 'ec_simulate_batch', 'batch': batch,
+            'n_times': len(times), 'seconds': seconds,
+            'steps_per_second': batch * steps(ec.params, times) / seconds,
+            'peak_memory': peak})
+    return results
+
+
+def data_grid(grid, repeat):
+    results = []
+    ec = quiet(electrochemistry.ECModel, EC)
+    samples_per_period = 1000
+    dt = 1.0 / (ec.dim_params['omega'] * samples_per_period)
+    directory = tempfile.mkdtemp()
+    try:
+        for rows in grid['data_rows']:
+            filename = os.path.join(directory, 'data_%d.txt' % rows)
+            times = dt * np.arange(rows)
+            current = np.sin(2 * pi * ec.dim_params['omega'] * times)
+            np.savetxt(filename, np.array([np.zeros(rows), current, times]).T,
+                       header='\n' * 18)
+
+            def load(cache):
+                return quiet(electrochemistry.ECTimeData, filename, ec, 100,
+                             cache=cache)
+
+            for name, cache in [('data_parse', False), ('data_cached', True)]:
+                if cache:
+                    load(True)
+                seconds, peak = measure(lambda: load(cache), repeat)
+                results.append({
+                    'name': name, 'rows': rows, 'seconds': seconds,
+                    'rows_per_second': rows / seconds, 'peak_memory': peak})
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def accuracy(model, reference, candidates, times, repeat):
+    """ the error (max abs difference, relative to the max abs current) and
+    the cost of each of the candidate parameters, relative to the reference
+    """
+    expected = model.simulate(times, reference)
+    scale = np.max(np.abs(expected))
+    results = []
+    for label, params in candidates:
+        try:
+            current = model.simulate(times, params)
+        except RuntimeError as e:
+            results.append({'mode': label, 'error': str(e)})
+            continue
+        seconds, _ = measure(lambda: model.simulate(times, params), repeat)
+        results.append({
+            'mode': label,
+            'relative_error': float(np.max(np.abs(current - expected)) /
+                                    scale),
+            'seconds': seconds})
+    return results
+
+
+def accuracy_curves(repeat):
+    ec = quiet(electrochemistry.ECModel, EC)
+    times = ec.suggest_times()
+    reference = dict(ec.params, Nx=600, Nt=4000)
+    candidates = [('Nt=%d' % Nt, dict(ec.params, Nt=Nt))
+                  for Nt in [50, 100, 200, 400, 800]]
+    candidates += [('rtol=%g' % rtol, dict(ec.params, rtol=rtol, atol=rtol))
+                   for rtol in [1e-3, 1e-4, 1e-5, 1e-6]]
+    candidates += [('integral Nt=%d' % Nt,
+                    dict(ec.params, Nt=Nt, integral_tol=1e-8))
+                   for Nt in [100, 200, 400, 800]]
+    results = {'ec': accuracy(ec, reference, candidates, times, repeat)}
+
+    pom = quiet(electrochemistry.POMModel, POMS)
+    times = np.linspace(0, 2 * abs(pom.params['Ereverse'] -
+                                   pom.params['Estart']), 2000)
+    reference = dict(pom.params, rtol=1e-8, atol=1e-10)
+    candidates = [('Nt=%d' % Nt, dict(pom.params, Nt=Nt))
+                  for Nt in [600, 2000, 10000, 50000]]
+    candidates += [('rtol=%g' % rtol, dict(pom.params, rtol=rtol))
+                   for rtol in [1e-2, 1e-3, 1e-4, 1e-5]]
+    results['pom'] = accuracy(pom, reference, candidates, times, repeat)
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', default='benchmark.json',
+                        help='JSON file to write the results to')
+    parser.add_argument('--grid', choices=sorted(GRIDS), default='full',
+                        help='size of the grid of settings to time')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs, the best is reported')
+    args = parser.parse_args()
+
+    grid = GRIDS[args.grid]
+    report = {
+        'commit': commit(),
+        'date': datetime.datetime.now().isoformat(),
+        'machine': platform.platform(),
+        'python': sys.version,
+        'grid': args.grid,
+        'simulate': simulate_grid(grid, args.repeat),
+        'data': data_grid(grid, args.repeat),
+        'accuracy': accuracy_curves(args.repeat),
+        # high water mark of the whole process, including the C++ work arrays
+        # that tracemalloc does not see (kilobytes on Linux)
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('wrote', args.output)
+
+
+if __name__ == '__main__':
+    main()
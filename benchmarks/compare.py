@@ -0,0 +1,59 @@
+#
+# Compares two sets of benchmark results written by benchmark.py
+#
+#     $ python benchmarks/compare.py before.json after.json
+#
+# printing the ratio of the times (after / before) of each benchmark present
+# in both, and the change in error of each solver mode
+#
+from __future__ import print_function
+import argparse
+import json
+
+
+def key(result):
+    return tuple(sorted((k, v) for k, v in result.items()
+                        if k not in ('seconds', 'peak_memory') and
+                        not k.endswith('_per_second')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before', help='JSON results of the baseline')
+    parser.add_argument('after', help='JSON results to compare')
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='flag time ratios above this as regressions')
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print('before:', before['commit'], before['date'])
+    print('after: ', after['commit'], after['date'])
+
+    for section in ['simulate', 'data']:
+        old = {key(r): r for r in before[section]}
+        for r in after[section]:
+            k = key(r)
+            if k not in old:
+                continue
+            ratio = r['seconds'] / old[k]['seconds']
+            flag = '  <-- slower' if ratio > args.threshold else ''
+            print('%-60s %8.3f%s' % (
+                ', '.join('%s=%s' % item for item in k), ratio, flag))
+
+    for model in sorted(after['accuracy']):
+        old = {r['mode']: r for r in before['accuracy'].get(model, [])}
+        for r in after['accuracy'][model]:
+            if r['mode'] not in old or 'relative_error' not in r or \
+                    'relative_error' not in old[r['mode']]:
+                continue
+            o = old[r['mode']]
+            print('%-4s %-16s error %9.3g -> %9.3g, time ratio %8.3f' % (
+                model, r['mode'], o['relative_error'], r['relative_error'],
+                r['seconds'] / o['seconds']))
+
+
+if __name__ == '__main__':
+    main()
@@ -78,6 +78,11 @@ setup(
     packages=find_packages('src'),
     package_dir={'': 'src'},
     test_suite='test',
+    entry_points={
+        'console_scripts': [
+            'electrochemistry-sweep = electrochemistry.sweep:main',
+        ],
+    },
     install_requires=[
         'pints',
     ]
@@ -1,5 +1,21 @@
 from __future__ import print_function
 
 from .electrochemistry import seq_electron_transfer3_explicit, e_implicit_exponential_mesh
+from .electrochemistry import seq_electron_transfer3_explicit_batch, e_implicit_exponential_mesh_batch
+from .electrochemistry import seq_electron_transfer3_explicit_sensitivities, e_implicit_exponential_mesh_sensitivities
+from .electrochemistry import seq_electron_transfer3_explicit_sum_of_squares, e_implicit_exponential_mesh_sum_of_squares
+from .electrochemistry import ECSimulator, POMSimulator
+from .electrochemistry import joint_sum_of_squares, joint_simulate
 from .data import ECTimeData
-from .models import ECModel, POMModel, PintsModelAdaptor
+from .models import ECModel, POMModel, PintsModelAdaptor, ParameterTransform
+from .models import merge_stats
+from .harmonics import HarmonicTransform
+from .surrogate import SurrogateModel
+from .cache import SimulationCache
+from .fidelity import MultilevelFidelity
+from .joint import MultiExperimentModel
+from .parallel import ProcessPoolEvaluator
+from .sweep import run_sweep
+from .errors import SumOfSquaresError, GaussianKnownSigmaLogLikelihood
+from .errors import HarmonicSumOfSquaresError
+from .errors import MultiExperimentSumOfSquaresError, MultiExperimentLogLikelihood
@@ -0,0 +1,130 @@
+from __future__ import print_function
+import collections
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+
+def _json_default(value):
+    # json encoding of the model parameters that aren't numbers, i.e. numpy
+    # arrays such as a measured potential, by a digest of their values
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(
+            np.ascontiguousarray(value, dtype='double').tobytes()).hexdigest()
+    return float(value)
+
+
+class SimulationCache:
+
+    """Least recently used cache of simulated currents, e.g. for a
+    :class:`PintsModelAdaptor` that is asked for the same parameters more
+    than once, keyed on the parameter vector, the fixed model parameters and
+    the times
+
+    Cached arrays are stored as read-only copies, and :meth:`get` returns a
+    new copy, so callers can't modify the cache through them.
+
+    Args:
+        max_bytes (int): memory budget for the cached currents, beyond which
+            the least recently used are evicted
+        filename (str): optional ``.npz`` file the cache is loaded from (if
+            it exists) and written to by :meth:`save`
+    """
+
+    def __init__(self, max_bytes=2**28, filename=None):
+        self.max_bytes = max_bytes
+        self.filename = filename
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if filename is not None and os.path.exists(filename):
+            with np.load(filename) as f:
+                for key in f.files:
+                    self._put(key, f[key])
+
+    def __getstate__(self):
+        # a copy (e.g. in a worker process) starts empty, with the same budget
+        state = dict(self.__dict__)
+        state['_entries'] = collections.OrderedDict()
+        state['nbytes'] = state['hits'] = state['misses'] = 0
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(parameters, params, times, names=(), model=''):
+        """ the cache key of a simulation
+
+        Args:
+            parameters (numpy vector): values of the fitted parameters
+            params (dict): values of all the model parameters
+            times (numpy vector): output times
+            names (list of str): names of the fitted parameters, in the order
+                of ``parameters``
+            model (str): name of the model class
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps([model, list(names)]).encode())
+        h.update(np.ascontiguousarray(parameters, dtype='double').tobytes())
+        h.update(json.dumps(sorted(params.items()),
+                            default=_json_default).encode())
+        h.update(np.ascontiguousarray(times, dtype='double').tobytes())
+        return h.hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ a copy of the current cached under key, or None """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # most recently used
+            self._entries[key] = self._entries.pop(key)
+        return np.array(value)
+
+    def put(self, key, value):
+        """ caches a copy of value under key """
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key).nbytes
+        value = np.array(value)
+        if value.nbytes > self.max_bytes:
+            return
+        value.flags.writeable = False
+        self._entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self._entries.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        """ empties the cache, and resets the hit and miss counts """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def save(self, filename=None):
+        """ writes the cache to filename, by default that it was created with
+        """
+        if filename is None:
+            filename = self.filename
+        with self._lock:
+            entries = dict(self._entries)
+        with open(filename, 'wb') as f:
+            np.savez(f, **entries)
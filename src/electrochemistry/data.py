@@ -1,77 +1,201 @@
 from __future__ import print_function
+import os
+import shutil
+import warnings
 import numpy as np
-from math import pi, floor, ceil
+from math import pi, floor
 
 import electrochemistry
+from .harmonics import HarmonicTransform
 
 
-def read_cvsin_type_1(filename):
+def _write_cache(filename, cache_filename, skiprows, usecols, chunk_size):
+    """ parses the columns usecols of a text datafile, chunk_size rows at a
+    time, and writes them as the rows of a .npy file
+    """
+    columns = [cache_filename + '.%d' % i for i in range(len(usecols))]
+    try:
+        n = 0
+        with open(filename) as f:
+            outputs = [open(column, 'wb') for column in columns]
+            try:
+                for _ in range(skiprows):
+                    next(f)
+                while True:
+                    with warnings.catch_warnings():
+                        # reading past the last row warns of no data
+                        warnings.simplefilter('ignore', UserWarning)
+                        block = np.loadtxt(f, usecols=usecols, ndmin=2,
+                                           max_rows=chunk_size)
+                    if len(block) == 0:
+                        break
+                    n += len(block)
+                    for column, output in zip(block.T, outputs):
+                        np.ascontiguousarray(column).tofile(output)
+            finally:
+                for output in outputs:
+                    output.close()
+
+        with open(cache_filename, 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(float)),
+                'fortran_order': False,
+                'shape': (len(columns), n)})
+            for column in columns:
+                with open(column, 'rb') as g:
+                    shutil.copyfileobj(g, f)
+    finally:
+        for column in columns:
+            if os.path.exists(column):
+                os.remove(column)
+
+
+def read_cvsin_type_1(filename, cache=True, chunk_size=2**20):
     """ read in a datafile of format svsin_type_1
 
+    Only the time and current columns are parsed. Unless ``cache`` is False,
+    the first read writes them to a binary cache, ``filename + '.npy'``,
+    stamped with the modification time of the datafile, parsing chunk_size
+    rows at a time so that the datafile is never held in memory, and all reads
+    memory-map the cache instead of parsing the datafile again. The cache is
+    rewritten if the datafile is modified, and skipped if it cannot be
+    written.
+
     Args:
         filename (str): filename of the data file
+        cache (bool): whether to use (and write) the binary cache
+        chunk_size (int): number of rows to parse at a time
 
     returns:
         time (numpy vector): vector of time samples
         current (numpy vector): vector of current samples
     """
 
+    cache_filename = filename + '.npy'
+    stat = os.stat(filename)
+    if cache and os.path.exists(cache_filename) and \
+            os.stat(cache_filename).st_mtime_ns == stat.st_mtime_ns:
+        exp_data = np.load(cache_filename, mmap_mode='r')
+        return exp_data[0], exp_data[1]
+
     if filename[-11:] == '_cv_current':
         print('filename ends with _cv_current')
-        exp_data = np.loadtxt(filename)
-        t_index = 0
-        c_index = 1
+        skiprows = 0
+        usecols = (0, 1)
     else:
-        exp_data = np.loadtxt(filename, skiprows=19)
-        t_index = 2
-        c_index = 1
-    return exp_data[:, t_index], exp_data[:, c_index]
+        skiprows = 19
+        usecols = (2, 1)
+
+    if cache:
+        # write to a temporary file first, so that an interrupted write never
+        # leaves a valid looking cache
+        tmp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+        try:
+            _write_cache(filename, tmp_filename, skiprows, usecols,
+                         chunk_size)
+            os.utime(tmp_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(tmp_filename, cache_filename)
+            exp_data = np.load(cache_filename, mmap_mode='r')
+            return exp_data[0], exp_data[1]
+        except OSError:
+            print('could not write cache ', cache_filename)
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    exp_data = np.loadtxt(filename, skiprows=skiprows, usecols=usecols,
+                          unpack=True)
+    return exp_data[0], exp_data[1]
+
+
+def _chunks(samples, begin, end, chunk_size):
+    """ yields consecutive blocks samples[i:j] of samples[begin:end], of at
+    most chunk_size samples, with the index i - begin of each block
+    """
+    for i in range(begin, end, chunk_size):
+        yield i - begin, samples[i:min(i + chunk_size, end)]
+
+
+def decimate(samples, begin, end, downsample, chunk_size=2**20):
+    """ the moving averages over consecutive windows of downsample samples of
+    samples[begin:end], the last window holding any remaining samples
+
+    The samples are read in blocks of about chunk_size samples (e.g. from a
+    memory-mapped file), so that besides the output the memory used is
+    bounded by the block size.
+
+    Args:
+        samples (numpy vector): samples to decimate
+        begin (int): index of the first sample to use
+        end (int): index after the last sample to use
+        downsample (int): number of samples to average over
+        chunk_size (int): number of samples to read at a time
+
+    returns:
+        numpy vector: the averages
+    """
+    n = end - begin
+    out = np.empty(-(-n // downsample))
+    chunk_size = max(chunk_size // downsample, 1) * downsample
+    for i, block in _chunks(samples, begin, end, chunk_size):
+        whole = len(block) - len(block) % downsample
+        j = i // downsample
+        out[j:j + whole // downsample] = \
+            block[:whole].reshape(-1, downsample).mean(axis=1)
+        if whole < len(block):
+            out[-1] = block[whole:].mean()
+    return out
 
 
 class ECTimeData:
 
     def __init__(self, filename, model, ignore_begin_samples,
-                 ignore_end_samples=0, samples_per_period=200, datafile_type='scsin_type_1'):
+                 ignore_end_samples=0, samples_per_period=200, datafile_type='scsin_type_1',
+                 cache=True, chunk_size=2**20):
         print('ECTimeData: loading data from filename = ', filename, ' ...')
-        self.times, self.current = read_cvsin_type_1(filename)
-
-        print('\tUsing samples from ', ignore_begin_samples,
-              ' to ', len(self.times) - ignore_end_samples)
-        if (ignore_end_samples > 0):
-            self.times = self.times[ignore_begin_samples:-ignore_end_samples]
-            self.current = self.current[
-                ignore_begin_samples:-ignore_end_samples]
-        else:
-            self.times = self.times[ignore_begin_samples:]
-            self.current = self.current[ignore_begin_samples:]
+        times, current = read_cvsin_type_1(filename, cache, chunk_size)
+
+        begin = ignore_begin_samples
+        end = len(times) - ignore_end_samples
+        print('\tUsing samples from ', begin, ' to ', end)
 
         print('\tCut data to multiple of period')
-        dt = self.times[100] - self.times[99]
+        dt = times[begin + 100] - times[begin + 99]
         data_samples_per_period = 1.0 / (model.dim_params['omega'] * dt)
-        discard_samples = int(len(self.current) % data_samples_per_period)
-        if (discard_samples > 0):
-            self.times = self.times[0:-discard_samples]
-            self.current = self.current[0:-discard_samples]
+        end -= int((end - begin) % data_samples_per_period)
 
         downsample = int(floor(data_samples_per_period /
                                samples_per_period))
         if downsample == 0:
             downsample = 1
-        print('\tBefore downsampling, have ', len(self.times), ' data points')
+        print('\tBefore downsampling, have ', end - begin, ' data points')
         print('\tDatafile has ', data_samples_per_period, ' samples per period.')
         print(
             '\tReducing number of samples using a moving average window of size ', downsample)
 
-        new_length = int(len(self.times) / downsample)
-        pad_size = int(
-            ceil(float(len(self.times)) / downsample) * downsample) - len(self.times)
-        self.times = np.append(self.times, np.zeros(pad_size) * np.NaN)
-        self.times = np.nanmean(self.times.reshape(-1, downsample), axis=1)
-        self.current = np.append(self.current, np.zeros(pad_size) * np.NaN)
-        self.current = np.nanmean(self.current.reshape(-1, downsample), axis=1)
-
-        self.current = self.current / model.I0
-        self.times = self.times / model.T0
+        self.times = decimate(times, begin, end, downsample, chunk_size)
+        self.times /= model.T0
+        self.current = decimate(current, begin, end, downsample, chunk_size)
+        self.current /= model.I0
         # self.distance_scale = np.linalg.norm(self.current)
 
         print('\tAfter downsampling, have ', len(self.times), ' data points')
+
+        self.omega = model.params['omega']
+        self._harmonics = {}
+
+    def harmonics(self, harmonics, bandwidth=0.5):
+        """ the transform of the current to the given harmonics of omega, and
+        the envelopes of the harmonics (see :class:`HarmonicTransform`),
+        computed once for each set of harmonics and bandwidth
+
+        returns:
+            transform (HarmonicTransform): the transform
+            envelopes (numpy array): envelope of each harmonic, in rows
+        """
+        key = (tuple(harmonics), bandwidth)
+        if key not in self._harmonics:
+            transform = HarmonicTransform(self.times, self.omega, harmonics,
+                                          bandwidth)
+            self._harmonics[key] = (transform,
+                                    transform.envelopes(self.current))
+        return self._harmonics[key]
@@ -1,7 +1,9 @@
 
 #include "e_implicit_exponential_mesh.hpp"
 #include <boost/math/constants/constants.hpp>
+#include <boost/math/special_functions/erf.hpp>
 #include <boost/math/tools/roots.hpp>
+#include <boost/math/tools/toms748_solve.hpp>
 #include <boost/math/tools/tuple.hpp>
 #include <exception>
 #include <iostream>
@@ -9,13 +11,20 @@
 
 namespace electrochemistry {
 
-struct BCfun {
-  BCfun(const double h0, const double Cdl, const double f1, const double e1,
-        const double Eapp1, const double Eapp0, const double Ru,
-        const double alpha, const double E0, const double dt,
-        const double Itot0, const double k0)
-      : h0(h0), Cdl(Cdl), f1(f1), e1(e1), Eapp1(Eapp1), Eapp0(Eapp0), Ru(Ru),
-        alpha(alpha), E0(E0), dt(dt), Itot0(Itot0), k0(k0) {}
+// residual of the boundary condition at the electrode surface, as a function
+// of the total current Itot1 at the end of the time step. T is either double,
+// or dual when differentiating the residual with respect to a parameter.
+//
+// The time derivative of the effective potential Eeff = Eapp - Ru*Itot is
+// discretised as (Eeff1 - Eeff0) / dt, so for backward Euler Eeff0 is the
+// effective potential at the start of the step, and for BDF2 it is the
+// weighted history term with dt scaled to match (see run_adaptive)
+template <typename T> struct BCfun {
+  BCfun(const T h0, const T Cdl, const T f1, const T e1, const T Eapp1,
+        const T Eeff0, const T Ru, const T alpha, const T E0, const double dt,
+        const T k0)
+      : h0(h0), Cdl(Cdl), f1(f1), e1(e1), Eapp1(Eapp1), Eeff0(Eeff0), Ru(Ru),
+        alpha(alpha), E0(E0), dt(dt), k0(k0) {}
 
   boost::math::tuple<double, double> operator()(const double Itot1) const {
     return boost::math::make_tuple(residual(Itot1), residual_gradient(Itot1));
@@ -23,42 +32,50 @@ struct BCfun {
   // double operator()(const double Itot1) const {
   //    return residual(Itot1);
   //}
-  double residual(const double Itot1) const {
-    const double tmpIf = If(Itot1);
-    const double exptmp = Eapp1 - Itot1 * Ru - E0;
-    const double U0 = (f1 - h0 * tmpIf) / (1 - e1);
-    return tmpIf - k0 * (U0 * std::exp((1 - alpha) * exptmp) -
-                         (1 - U0) * std::exp(-alpha * exptmp));
+  T residual(const T Itot1) const {
+    using std::exp;
+    const T tmpIf = If(Itot1);
+    const T exptmp = Eapp1 - Itot1 * Ru - E0;
+    const T U0 = (f1 - h0 * tmpIf) / (1 - e1);
+    return tmpIf - k0 * (U0 * exp((1 - alpha) * exptmp) -
+                         (1 - U0) * exp(-alpha * exptmp));
   }
 
-  double If(const double Itot1) const {
-    const double deltaEeff = (Eapp1 - Itot1 * Ru) - (Eapp0 - Itot0 * Ru);
-    const double Ic = Cdl * deltaEeff / dt;
+  T If(const T Itot1) const {
+    const T deltaEeff = (Eapp1 - Itot1 * Ru) - Eeff0;
+    const T Ic = Cdl * deltaEeff / dt;
     return Itot1 - Ic;
   }
 
-  double If2(const double Itot1) const {
-    const double tmpIf = If(Itot1);
-    const double exptmp = Eapp1 - Itot1 * Ru - E0;
-    const double U0 = (f1 - h0 * tmpIf) / (1 - e1);
-    return k0 * (U0 * std::exp((1 - alpha) * exptmp) -
-                 (1 - U0) * std::exp(-alpha * exptmp));
+  T If2(const T Itot1) const {
+    using std::exp;
+    const T tmpIf = If(Itot1);
+    const T exptmp = Eapp1 - Itot1 * Ru - E0;
+    const T U0 = (f1 - h0 * tmpIf) / (1 - e1);
+    return k0 * (U0 * exp((1 - alpha) * exptmp) -
+                 (1 - U0) * exp(-alpha * exptmp));
   }
 
-  double residual_gradient(const double Itot1) const {
-    const double tmpIf = If(Itot1);
-    const double exptmp = Eapp1 - Itot1 * Ru - E0;
-    const double U0 = (f1 - h0 * tmpIf) / (1 - e1);
-    const double tmp = Cdl * Ru / dt;
-    const double dU0dItot1 = -h0 * (1 + tmp) / (1 - e1);
-    const double exp1 = std::exp((1 - alpha) * exptmp);
-    const double exp2 = std::exp(-alpha * exptmp);
+  // surface concentration
+  T U0(const T Itot1) const { return (f1 - h0 * If(Itot1)) / (1 - e1); }
+
+  T residual_gradient(const T Itot1) const {
+    using std::exp;
+    const T tmpIf = If(Itot1);
+    const T exptmp = Eapp1 - Itot1 * Ru - E0;
+    const T U0 = (f1 - h0 * tmpIf) / (1 - e1);
+    const T tmp = Cdl * Ru / dt;
+    const T dU0dItot1 = -h0 * (1 + tmp) / (1 - e1);
+    const T exp1 = exp((1 - alpha) * exptmp);
+    const T exp2 = exp(-alpha * exptmp);
     return 1 + tmp -
            k0 * (dU0dItot1 * (exp1 + exp2) + U0 * Ru * (alpha - 1) * exp1 -
                  (1 - U0) * alpha * Ru * exp2);
   }
 
-  const double h0, Cdl, f1, e1, Eapp1, Eapp0, Ru, alpha, E0, dt, Itot0, k0;
+  const T h0, Cdl, f1, e1, Eapp1, Eeff0, Ru, alpha, E0;
+  const double dt;
+  const T k0;
 };
 
 struct TolFun {
@@ -69,40 +86,393 @@ struct TolFun {
   const double tol;
 };
 
-void e_implicit_exponential_mesh(py::dict params,
-                                 py::array_t<double> Itot_numpy,
-                                 py::array_t<double> t_numpy) {
+// solves the boundary condition bc for the current Itot1 at the end of a time
+// step, starting Newton from the predicted current guess and searching within
+// guess +/- bound. If Newton does not converge in max_iterations, or stops at
+// the edge of the bracket (where newton_raphson_iterate ends up when the root
+// is outside it), falls back to TOMS 748 on a bracket found by widening
+// guess +/- bound until the residual changes sign, which is slower but safe
+// once a bracket is found. Returns false if neither method finds the root
+template <typename T>
+bool solve_bc(const BCfun<T> &bc, const double guess, const double bound,
+              const int digits, const boost::uintmax_t max_iterations,
+              solver_stats *const st, double &Itot1) {
+  phase_timer timer(st, "newton");
+  boost::uintmax_t max_it = max_iterations;
+  bool converged;
+  try {
+    Itot1 = boost::math::tools::newton_raphson_iterate(
+        bc, guess, guess - bound, guess + bound, digits, max_it);
+    converged = max_it < max_iterations && std::isfinite(Itot1);
+  } catch (const boost::math::evaluation_error &) {
+    max_it = max_iterations;
+    converged = false;
+  }
+  const bool bracket_hit =
+      converged && std::abs(Itot1 - guess) > (1 - 1e-6) * bound;
+  if (st)
+    st->newton(max_it, bracket_hit);
+  if (converged && !bracket_hit)
+    return true;
 
-  py::buffer_info Itot_info = Itot_numpy.request();
-  py::buffer_info t_info = t_numpy.request();
+  if (st)
+    st->fallbacks++;
+  auto residual = [&bc](const double Itot) { return bc.residual(Itot); };
+  double width = bound;
+  double min = guess - width;
+  double max = guess + width;
+  double fmin = residual(min);
+  double fmax = residual(max);
+  for (int i = 0; (fmin > 0) == (fmax > 0); i++) {
+    if (i == 50 || std::isnan(fmin) || std::isnan(fmax))
+      return false;
+    width *= 4;
+    min = guess - width;
+    max = guess + width;
+    fmin = residual(min);
+    fmax = residual(max);
+  }
 
-  if ((Itot_info.ndim != 1) || (t_info.ndim != 1))
-    throw std::runtime_error("Number of dimensions must be one");
+  // the exponentials in the residual overflow far from the root, so bisect
+  // until the residual is finite at both ends, as TOMS 748 interpolates
+  for (int i = 0; !std::isfinite(fmin) || !std::isfinite(fmax); i++) {
+    const double mid = 0.5 * (min + max);
+    const double fmid = residual(mid);
+    if (i == 200 || std::isnan(fmid))
+      return false;
+    if ((fmid > 0) == (fmin > 0)) {
+      min = mid;
+      fmin = fmid;
+    } else {
+      max = mid;
+      fmax = fmid;
+    }
+  }
+  max_it = max_iterations;
+  const std::pair<double, double> root = boost::math::tools::toms748_solve(
+      residual, min, max, fmin, fmax,
+      boost::math::tools::eps_tolerance<double>(digits), max_it);
+  Itot1 = 0.5 * (root.first + root.second);
+  // an unconverged bracket is a failure, as for Newton
+  return max_it < max_iterations;
+}
 
-  if (Itot_info.shape[0] != t_info.shape[0])
-    throw std::runtime_error("Input shapes must be equal");
+ECSimulator::ECSimulator(const ECParams &params,
+                         const std::vector<int> &indices)
+    : params(params), indices(indices), stats_enabled(false), mesh_Nx(-1),
+      mesh_Nt(-1), mesh_omega(0), mesh_Xmax(0), soe_dt(0), soe_t_end(0),
+      soe_tol(0) {}
 
-  const size_t N = Itot_info.shape[0];
-  auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
-  auto t = reinterpret_cast<double *>(t_info.ptr);
+ECSimulator::ECSimulator(py::dict params, py::list names)
+    : ECSimulator(ECParams(params), ECParams::indices(names)) {}
+
+void ECSimulator::set_values(const double *values) {
+  for (size_t j = 0; j < indices.size(); ++j) {
+    params[indices[j]] = values[j];
+  }
+}
+
+void ECSimulator::setup(const double Xmax) {
+  const int Nx = params.Nx;
+  const int Nt = params.Nt;
+  const double omega = params.omega;
+  if (Nx == mesh_Nx && Nt == mesh_Nt && omega == mesh_omega &&
+      Xmax == mesh_Xmax)
+    return;
+  phase_timer timer(stats_enabled ? &stats : nullptr, "setup");
+  mesh_Nx = Nx;
+  mesh_Nt = Nt;
+  mesh_omega = omega;
+  mesh_Xmax = Xmax;
+
+  const double pi = boost::math::constants::pi<double>();
+  dt = (1.0 / Nt) * 2 * pi / omega;
+
+  // set up spatial mesh
+  const double r = 1.04;
+  h0 = Xmax * (1 - r) / (1 - pow(r, Nx + 1));
+#ifndef NDEBUG
+  std::cout << "\th0= " << h0 << std::endl;
+#endif
+  std::vector<double> h(Nx + 1);
+  for (int i = 0; i <= Nx; i++) {
+    h[i] = pow(r, i) * h0;
+  }
+
+  a.resize(Nx + 1);
+  b.resize(Nx + 1);
+  c.resize(Nx + 1);
+  g.resize(Nx + 1);
+  for (int i = 1; i < Nx; i++) {
+    const double hstar = h[i] * h[i - 1] * (h[i] + h[i - 1]);
+    a[i] = 2 * h[i] / hstar;
+    g[i] = 2 * (h[i] + h[i - 1]) / hstar;
+    b[i] = 1 / dt + g[i];
+    c[i] = 2 * h[i - 1] / hstar;
+  }
+  d.resize(Nx + 1);
+  e.resize(Nx + 1);
+  f.resize(Nx + 1);
+  e[Nx] = 0;
+  f[Nx] = 1;
+
+  for (int i = Nx - 1; i >= 1; i--) {
+    e[i] = a[i] / (b[i] - c[i] * e[i + 1]);
+  }
+
+  U.resize(Nx + 1);
+  sf.assign(Nx + 1, 0);
+}
+
+// width of the spatial domain, either params.Xmax, or if that is <= 0 wide
+// enough that diffusion from the electrode over the times t[0..N-1] changes
+// the concentration at Xmax by less than erfc(4) ~ 1e-8
+double ECSimulator::domain_width(const double *t, const size_t N) const {
+  if (params.Xmax > 0)
+    return params.Xmax;
+  const double t_end = N > 0 ? t[N - 1] : 0;
+  return t_end > 0 ? 8 * std::sqrt(t_end) : 20;
+}
+
+// as run, but with variable step BDF2 instead of Nt backward Euler steps per
+// period. The step size is chosen to keep the local error in the current and
+// the concentrations below atol + rtol * |value|, and the current at the
+// output times is given by the quadratic through the last three steps
+template <typename Output>
+void ECSimulator::run_adaptive(const double *t, const size_t N,
+                               Output &output) {
+  const double k0 = params.k0;
+  const double alpha = params.alpha;
+  const double Cdl = params.Cdl;
+  const double Ru = params.Ru;
+  const double E0 = params.E0;
+  const double dE = params.dE;
+  const int Nx = params.Nx;
+  const int Nt = params.Nt;
+  const double omega = params.omega;
+  const double phase = params.phase;
+  const double rtol = params.rtol;
+  const double atol = params.atol;
+  if (params.startn != 0)
+    throw std::runtime_error(
+        "startn is not supported with adaptive time stepping");
+
+  const int digits_accuracy = std::numeric_limits<double>::digits * 2 / 3;
+  const double max_iterations = 100;
+  solver_stats *const st = stats_enabled ? &stats : nullptr;
+
+  setup(domain_width(t, N));
+
+  const double pi = boost::math::constants::pi<double>();
+  const double period = 2 * pi / omega;
+  const double min_step = 1e-12 * period;
+  const double max_step = period / 8;
 
-  const double k0 = get(params, std::string("k0"), 35.0);
-  const double alpha = get(params, std::string("alpha"), 0.5);
-  const double Cdl = get(params, std::string("Cdl"), 0.0037);
-  const double Ru = get(params, std::string("Ru"), 2.74);
-  const double E0 = get(params, std::string("E0"), 0.0);
-  const double dE = get(params, std::string("dE"), 0.1);
-  const int Nx = get(params, std::string("Nx"), 300.0);
-  const int Nt = get(params, std::string("Nt"), 200.0);
-  const int startn = get(params, std::string("startn"), 0.0);
-  const double Estart = get(params, std::string("Estart"), -10.0);
-  const double Ereverse = get(params, std::string("Ereverse"), 10.0);
+  // the step size varies, so the potential is evaluated rather than
+  // tabulated
+  const Efun E = applied_potential(params, phase, dt);
+
+  e_step.resize(Nx + 1);
+  U_prev.assign(Nx + 1, 1.0);
+  U_prev2.assign(Nx + 1, 1.0);
+  U_new.assign(Nx + 1, 1.0);
+  std::fill(U.begin(), U.end(), 1.0);
+
+  // solution at the last three steps, at times t1, t1 - h1 and t1 - h1 - h2.
+  // The two steps before the start are fictitious, with the initial values
+  double t1 = 0;
+  double step = 1e-4 * period;
+  double h1 = step;
+  double h2 = step;
+  double Itot0, Itot_neg1, Itot_neg2;
+  Itot0 = Cdl * dE * omega;
+  Itot_neg1 = Itot0;
+  Itot_neg2 = Itot0;
+  double Eeff0 = E(t1) - Ru * Itot0;
+  double Eeff_neg1 = Eeff0;
+  const double Itot_bound = std::max(10 * Cdl * dE * omega / Nt, 1.0);
+
+  // the first two steps are backward Euler, after which there are enough
+  // previous steps for BDF2 and for the error estimate
+  int n_steps = 0;
+  // the scaled error of the last accepted step, and whether the step since
+  // then has been rejected
+  double error_prev = 1;
+  bool rejected = false;
+
+  for (size_t n_out = 0; n_out < N; n_out++) {
+    while (t1 < t[n_out]) {
+      const double h = step;
+      const double t_new = t1 + h;
+
+      // BDF2 on a variable step: (a0*y1 - a1*y0 + a2*y_neg1) / h = dydt,
+      // written as (y1 - y_hist) / dt_eff = dydt so that the backward Euler
+      // tridiagonal sweep and BCfun can be reused
+      double a0 = 1, a1 = 1, a2 = 0;
+      if (n_steps >= 2) {
+        const double w = h / h1;
+        a0 = (1 + 2 * w) / (1 + w);
+        a1 = 1 + w;
+        a2 = w * w / (1 + w);
+      }
+      const double dt_eff = h / a0;
+
+      e_step[Nx] = 0;
+      f[Nx] = 1;
+      for (int i = Nx - 1; i >= 1; i--) {
+        const double denom = 1 / dt_eff + g[i] - c[i] * e_step[i + 1];
+        e_step[i] = a[i] / denom;
+        const double U_hist = (a1 * U[i] - a2 * U_prev[i]) / a0;
+        f[i] = (U_hist / dt_eff + f[i + 1] * c[i]) / denom;
+      }
+
+      // quadratic extrapolation from the last three steps, used as the
+      // initial guess for Newton and to estimate the local error
+      const double x0 = h;
+      const double x1 = h + h1;
+      const double x2 = h + h1 + h2;
+      const double p0 = x1 * x2 / (h1 * (h1 + h2));
+      const double p1 = -x0 * x2 / (h1 * h2);
+      const double p2 = x0 * x1 / ((h1 + h2) * h2);
+
+      const double Eapp1 = E(t_new);
+      const BCfun<double> bc(h0, Cdl, f[1], e_step[1], Eapp1,
+                             (a1 * Eeff0 - a2 * Eeff_neg1) / a0, Ru, alpha,
+                             E0, dt_eff, k0);
+      const double Itot_guess =
+          n_steps >= 2 ? p0 * Itot0 + p1 * Itot_neg1 + p2 * Itot_neg2 : Itot0;
+
+      double Itot1;
+      const bool solved = solve_bc(bc, Itot_guess, Itot_bound,
+                                   digits_accuracy, max_iterations, st, Itot1);
+      if (!solved) {
+        // retry with a smaller step
+        if (st)
+          st->rejected_steps++;
+        step = h / 4;
+        rejected = true;
+        if (step < min_step)
+          throw std::runtime_error("non-linear solve for Itot[n+1] failed, "
+                                   "no root found by Newton or TOMS 748");
+        continue;
+      }
+
+      U_new[0] = bc.U0(Itot1);
+      for (int i = 1; i < Nx; i++) {
+        U_new[i] = f[i] + e_step[i] * U_new[i - 1];
+      }
+
+      double factor = 1;
+      if (n_steps >= 2) {
+        // the local error of BDF2 is C_bdf*h^3*y''' and that of the
+        // extrapolation C_pred*h^3*y''', so their difference gives the error
+        const double C_bdf = h * h * x1 * x1 / (6 * (2 * h + h1));
+        const double C_pred = x0 * x1 * x2 / 6;
+        const double C = C_bdf / (C_bdf + C_pred);
+        double error = std::abs(Itot1 - Itot_guess) /
+                       (atol + rtol * std::abs(Itot1));
+        for (int i = 0; i < Nx; i++) {
+          const double U_guess =
+              p0 * U[i] + p1 * U_prev[i] + p2 * U_prev2[i];
+          error = std::max(error, std::abs(U_new[i] - U_guess) /
+                                      (atol + rtol * std::abs(U_new[i])));
+        }
+        error *= C;
+        if (error > 1) {
+          if (st)
+            st->rejected_steps++;
+          factor = std::max(0.9 * std::pow(error, -1.0 / 3), 0.2);
+          step = h * factor;
+          rejected = true;
+          if (step < min_step)
+            throw std::runtime_error("adaptive time step became too small");
+          continue;
+        }
+        // PI control of the step (error ~ h^3), which damps the oscillation
+        // between growing and rejected steps of the plain (I) controller,
+        // with the growth limited and not allowed just after a rejection
+        error = std::max(error, 1e-10);
+        factor = 0.9 * std::pow(error, -1.0 / 6) * std::pow(error_prev, 0.1);
+        factor = std::min(std::max(factor, 0.2), rejected ? 1.0 : 1.5);
+        error_prev = error;
+        rejected = false;
+      }
+
+      // accept the step
+      if (st)
+        st->steps++;
+      U_prev2.swap(U_prev);
+      U_prev.swap(U);
+      U.swap(U_new);
+      Itot_neg2 = Itot_neg1;
+      Itot_neg1 = Itot0;
+      Itot0 = Itot1;
+      Eeff_neg1 = Eeff0;
+      Eeff0 = Eapp1 - Ru * Itot1;
+      h2 = h1;
+      h1 = h;
+      t1 = t_new;
+      n_steps++;
+      step = std::min(h * factor, max_step);
+    }
+
+    // 2nd order interpolation through the last three steps
+    const double x = t[n_out];
+    const double x0 = t1;
+    const double x1 = t1 - h1;
+    const double x2 = t1 - h1 - h2;
+    const double w0 = (x - x1) * (x - x2) / ((x0 - x1) * (x0 - x2));
+    const double w1 = (x - x0) * (x - x2) / ((x1 - x0) * (x1 - x2));
+    const double w2 = (x - x0) * (x - x1) / ((x2 - x0) * (x2 - x1));
+    if (!output(n_out, w2 * Itot_neg2 + w1 * Itot_neg1 + w0 * Itot0))
+      return;
+  }
+}
+
+// simulates the current at times t, passing the current at each time to
+// output(n, I), which returns false to stop the simulation early. If sens is
+// non-empty, also integrates the forward sensitivities of the current with
+// respect to params[sens[j]], and writes them to the (N x sens.size()) array
+// dItot
+template <typename Output>
+void ECSimulator::run(const double *t, const size_t N, Output &output,
+                      const std::vector<int> &sens, double *dItot) {
+  if (!stats_enabled) {
+    integrate(t, N, output, sens, dItot);
+    return;
+  }
+  phase_timer timer(&stats, "total");
+  stats.simulations++;
+  try {
+    integrate(t, N, output, sens, dItot);
+  } catch (const std::exception &e) {
+    std::map<std::string, double> values;
+    for (int i = 0; i < ECParams::size; ++i) {
+      values[ECParams::name(i)] = params[i];
+    }
+    stats.failure(e.what(), values);
+    throw;
+  }
+}
+
+template <typename Output>
+void ECSimulator::integrate(const double *t, const size_t N, Output &output,
+                            const std::vector<int> &sens, double *dItot) {
+  const double k0 = params.k0;
+  const double alpha = params.alpha;
+  const double Cdl = params.Cdl;
+  const double Ru = params.Ru;
+  const double E0 = params.E0;
+  const double dE = params.dE;
+  const int Nx = params.Nx;
+  const int Nt = params.Nt;
+  const int startn = params.startn;
+  const double Estart = params.Estart;
+  const double Ereverse = params.Ereverse;
   if (Ereverse < Estart)
     throw std::runtime_error("Ereverse must be greater than Estart");
-  const double pi = boost::math::constants::pi<double>();
-  const double omega = get(params, std::string("omega"), 2 * pi);
-  const double phase = get(params, std::string("phase"), 0.0);
-  const double dt = (1.0 / Nt) * 2 * pi / omega;
+  const double omega = params.omega;
+  const double phase = params.phase;
 
 #ifndef NDEBUG
   std::cout << "Running e_implicit_exponential_mesh with parameters:"
@@ -123,22 +493,27 @@ void e_implicit_exponential_mesh(py::dict params,
   std::cout << "\tdE= " << dE << std::endl;
 #endif
 
-  const TolFun tol(1e-20);
-  const int digits_accuracy = std::numeric_limits<double>::digits * 2 / 3;
-  const double max_iterations = 100;
+  if (params.integral_tol > 0) {
+    if (!sens.empty())
+      throw std::runtime_error("sensitivities are not available with the "
+                               "boundary integral engine");
+    if (params.rtol > 0 || startn != 0)
+      throw std::runtime_error("the boundary integral engine requires fixed "
+                               "time steps and startn = 0");
+    run_integral(t, N, output);
+    return;
+  }
 
-  // set up spatial mesh
-  const double Xmax = 20;
-  const double r = 1.04;
-  const double h0 = Xmax * (1 - r) / (1 - pow(r, Nx + 1));
-#ifndef NDEBUG
-  std::cout << "\th0= " << h0 << std::endl;
-#endif
-  std::vector<double> h(Nx + 1);
-  double sum;
-  for (int i = 0; i <= Nx; i++) {
-    h[i] = pow(r, i) * h0;
-    sum += h[i];
+  // mesh, coefficients and work arrays are only rebuilt if Nx, Nt, omega or
+  // the domain width have changed since the last simulation
+  setup(domain_width(t, N));
+
+  if (params.rtol > 0) {
+    if (!sens.empty())
+      throw std::runtime_error(
+          "sensitivities are not available with adaptive time stepping");
+    run_adaptive(t, N, output);
+    return;
   }
 
   // set up temporal mesh
@@ -147,63 +522,268 @@ void e_implicit_exponential_mesh(py::dict params,
             << std::endl;
 #endif
 
-  double phase_adjust = 0;
-  if (startn != 0) {
-    phase_adjust = std::abs(Ereverse - Estart) * omega;
-  }
-  Efun E(Estart, Ereverse, dE, omega, phase + phase_adjust, dt);
+  reset();
 
-  std::vector<double> a(Nx + 1);
-  std::vector<double> b(Nx + 1);
-  std::vector<double> c(Nx + 1);
-  for (int i = 1; i < Nx; i++) {
-    const double hstar = h[i] * h[i - 1] * (h[i] + h[i - 1]);
-    a[i] = 2 * h[i] / hstar;
-    b[i] = 1 / dt + 2 * (h[i] + h[i - 1]) / hstar;
-    c[i] = 2 * h[i - 1] / hstar;
+  // forward sensitivities, the derivatives of U and Itot with respect to each
+  // parameter in sens are stepped using the derivative of each step of the
+  // solver: the Thomas sweep (linear in U) and the BCfun solve (via the
+  // implicit function theorem, dItot1/dp = -(dR/dp) / (dR/dItot1))
+  const size_t P = sens.size();
+  const int Cdl_index = ECParams::index("Cdl");
+  sU.resize(P);
+  for (size_t j = 0; j < P; j++) {
+    sU[j].assign(Nx + 1, 0);
+  }
+  sItot0.resize(P);
+  sItot1.resize(P);
+  sItot_neg1.resize(P);
+  for (size_t j = 0; j < P; j++) {
+    sItot_neg1[j] = sens[j] == Cdl_index ? dE * omega : 0;
+    sItot0[j] = sItot_neg1[j];
+    sItot1[j] = sItot_neg1[j];
   }
-  std::vector<double> d(Nx + 1);
-  std::vector<double> e(Nx + 1);
-  std::vector<double> f(Nx + 1);
-  e[Nx] = 0;
-  f[Nx] = 1;
 
-  for (int i = Nx - 1; i >= 1; i--) {
-    e[i] = a[i] / (b[i] - c[i] * e[i + 1]);
+  step_to(t, N, output, sens, dItot, startn);
+}
+
+// For semi-infinite diffusion from U = 1, with dU/dx = If at the electrode,
+// the surface concentration is
+//
+//     U0(t) = 1 - 1/sqrt(pi) int_0^t If(s) / sqrt(t - s) ds
+//
+// With If linear over each time step of length dt, the last step contributes
+// sqrt(dt) (2/3 If(t - dt) + 4/3 If(t)), and for the history (t - s >= dt)
+// the kernel is approximated by a sum of exponentials
+//
+//     1 / sqrt(tau) ~= sum_j w_j exp(-s_j tau),  dt <= tau <= t_end
+//
+// from the trapezoidal rule applied to
+// 1/sqrt(tau) = 2/sqrt(pi) int exp(x - tau exp(2x)) dx, whose error decays
+// like exp(-pi^2 / 2h) with the step h. The terms of the history then each
+// decay by exp(-s_j dt) per step, so a step costs O(number of terms)
+// regardless of the length of the history
+void ECSimulator::setup_integral(const double t_end) {
+  const double Nt = params.Nt;
+  const double omega = params.omega;
+  const double tol = params.integral_tol;
+  const double pi = boost::math::constants::pi<double>();
+  const double dt_new = (1.0 / Nt) * 2 * pi / omega;
+  const double t_end_new = std::max(t_end + dt_new, 2 * dt_new);
+  if (dt_new == soe_dt && t_end_new <= soe_t_end && tol == soe_tol)
+    return;
+  phase_timer timer(stats_enabled ? &stats : nullptr, "setup");
+  dt = dt_new;
+  soe_dt = dt_new;
+  soe_t_end = t_end_new;
+  soe_tol = tol;
+
+  const double log_tol = std::log(1 / tol);
+  const double h = pi * pi / (2 * (log_tol + 1));
+  const double x_min = std::log(tol / std::sqrt(t_end_new)) - 1;
+  const double x_max = 0.5 * std::log((log_tol + 3) / dt);
+  soe_s.clear();
+  soe_w.clear();
+  for (double x = x_min; x < x_max + h; x += h) {
+    soe_s.push_back(std::exp(2 * x));
+    soe_w.push_back(2 / std::sqrt(pi) * h * std::exp(x));
+  }
+  const size_t J = soe_s.size();
+  soe_decay.resize(J);
+  soe_gain0.resize(J);
+  soe_gain1.resize(J);
+  soe_history.resize(J);
+  for (size_t j = 0; j < J; j++) {
+    // the integrals over a step of exp(-s_j tau) times the hat functions
+    // of its start and end, int_0^1 exp(-z u) u du = phi and
+    // int_0^1 exp(-z u) du = psi, with the series of phi for small z
+    const double z = soe_s[j] * dt;
+    const double psi = z > 0 ? -std::expm1(-z) / z : 1;
+    const double phi =
+        z < 1e-2 ? 1.0 / 2 - z / 3 + z * z / 8 - z * z * z / 30
+                 : (-std::expm1(-z) - z * std::exp(-z)) / (z * z);
+    soe_decay[j] = std::exp(-z);
+    soe_gain0[j] = soe_decay[j] * dt * phi;
+    soe_gain1[j] = soe_decay[j] * dt * (psi - phi);
   }
+}
 
-  std::vector<double> U(Nx + 1, 1);
+// as run, but with the boundary integral form of the diffusion (see
+// setup_integral) instead of the spatial mesh. The surface concentration is
+// linear in If at the end of the step, U0 = f1 - h0 * If, so BCfun is used
+// with e1 = 0
+template <typename Output>
+void ECSimulator::run_integral(const double *t, const size_t N,
+                               Output &output) {
+  const double k0 = params.k0;
+  const double alpha = params.alpha;
+  const double Cdl = params.Cdl;
+  const double Ru = params.Ru;
+  const double E0 = params.E0;
+  const double dE = params.dE;
+  const int Nt = params.Nt;
+  const double omega = params.omega;
+  const double phase = params.phase;
+
+  const int digits_accuracy = std::numeric_limits<double>::digits * 2 / 3;
+  const double max_iterations = 100;
+  solver_stats *const st = stats_enabled ? &stats : nullptr;
+
+  setup_integral(N > 0 ? t[N - 1] : 0);
+  const size_t J = soe_s.size();
+  std::fill(soe_history.begin(), soe_history.end(), 0.0);
+
+  const double pi = boost::math::constants::pi<double>();
+  const double h_local = 4.0 / 3 * std::sqrt(dt / pi);
 
-  double Itot0, Itot1, Itot_neg1;
-  double t1 = 0;
   const double Itot_bound = std::max(10 * Cdl * dE * omega / Nt, 1.0);
+  t1 = 0;
+  Etab.update(applied_potential(params, phase, dt), N > 0 ? t[N - 1] : 0);
+  const double *Eapp = Etab.E.data();
   Itot_neg1 = Cdl * dE * omega;
   Itot0 = Itot_neg1;
   Itot1 = Itot_neg1;
+  // the initial current is all capacitive
+  double If0 = 0;
+  long n = 0;
+
+  for (size_t n_out = 0; n_out < N; n_out++) {
+    while (t1 < t[n_out]) {
+      Itot_neg1 = Itot0;
+      Itot0 = Itot1;
+
+      double history = 2.0 / 3 * std::sqrt(dt) * If0;
+      for (size_t j = 0; j < J; j++) {
+        history += soe_w[j] * soe_history[j];
+      }
+
+      const double Eapp1 = Eapp[2 * n + 2];
+      const double Eapp0 = Eapp[2 * n];
+      const BCfun<double> bc(h_local, Cdl, 1 - history / std::sqrt(pi), 0.0,
+                             Eapp1, Eapp0 - Itot0 * Ru, Ru, alpha, E0, dt,
+                             k0);
+
+      const double Itot_guess = 2 * Itot0 - Itot_neg1;
+      const bool solved = solve_bc(bc, Itot_guess, Itot_bound,
+                                   digits_accuracy, max_iterations, st, Itot1);
+      if (!solved)
+        throw std::runtime_error("non-linear solve for Itot[n+1] failed, no "
+                                 "root found by Newton or TOMS 748");
+      if (st)
+        st->steps++;
+
+      const double If1 = bc.If(Itot1);
+      for (size_t j = 0; j < J; j++) {
+        soe_history[j] = soe_decay[j] * soe_history[j] +
+                         soe_gain0[j] * If0 + soe_gain1[j] * If1;
+      }
+      If0 = If1;
+      t1 += dt;
+      n++;
+    }
+
+    // 2nd order interpolation, as in step_to
+    const double x0 = t1;
+    const double x1 = t1 - dt;
+    const double x2 = t1 - 2 * dt;
+    const double x = t[n_out];
+    const double dt2 = dt * dt;
+    const double w2 = (x - x0) * (x - x1) / (2 * dt2);
+    const double w1 = (x - x0) * (x - x2) / (-dt2);
+    const double w0 = (x - x1) * (x - x2) / (2 * dt2);
+    if (!output(n_out, w2 * Itot_neg1 + w1 * Itot0 + w0 * Itot1))
+      return;
+  }
+}
+
+// sets the solver state to the initial conditions at t = 0
+void ECSimulator::reset() {
+  std::fill(U.begin(), U.end(), 1.0);
+  t1 = 0;
+  Itot_neg1 = params.Cdl * params.dE * params.omega;
+  Itot0 = Itot_neg1;
+  Itot1 = Itot_neg1;
+}
+
+// steps the solver state on to each of the times t in turn (starting from
+// t[startn] and wrapping around), passing the current at each to output
+template <typename Output>
+void ECSimulator::step_to(const double *t, const size_t N, Output &output,
+                          const std::vector<int> &sens, double *dItot,
+                          const int startn) {
+  const double k0 = params.k0;
+  const double alpha = params.alpha;
+  const double Cdl = params.Cdl;
+  const double Ru = params.Ru;
+  const double E0 = params.E0;
+  const double dE = params.dE;
+  const int Nx = params.Nx;
+  const int Nt = params.Nt;
+  const double Estart = params.Estart;
+  const double Ereverse = params.Ereverse;
+  const double omega = params.omega;
+  const double phase = params.phase;
+
+  const TolFun tol(1e-20);
+  const int digits_accuracy = std::numeric_limits<double>::digits * 2 / 3;
+  const double max_iterations = 100;
+
+  double phase_adjust = 0;
+  if (startn != 0) {
+    if (!params.Edata.empty())
+      throw std::runtime_error(
+          "startn is not supported with a measured potential");
+    phase_adjust = std::abs(Ereverse - Estart) * omega;
+  }
+  Etab.update(applied_potential(params, phase + phase_adjust, dt),
+              N > 0 ? std::max(t[N - 1], t1) : t1);
+  const double *Eapp = Etab.E.data();
+  // index of the step from t1
+  long n = std::lround(t1 / dt);
+
+  const double Itot_bound = std::max(10 * Cdl * dE * omega / Nt, 1.0);
+  solver_stats *const st = stats_enabled ? &stats : nullptr;
+
+  const size_t P = sens.size();
+  const int k0_index = ECParams::index("k0");
+  const int alpha_index = ECParams::index("alpha");
+  const int Cdl_index = ECParams::index("Cdl");
+  const int Ru_index = ECParams::index("Ru");
+  const int E0_index = ECParams::index("E0");
+
   int n_out = startn;
   for (int dummy = 0; dummy < N; dummy++) {
     while (t1 < t[n_out]) {
       Itot_neg1 = Itot0;
       Itot0 = Itot1;
+      for (size_t j = 0; j < P; j++) {
+        sItot_neg1[j] = sItot0[j];
+        sItot0[j] = sItot1[j];
+      }
       for (int i = 1; i < Nx; i++) {
         d[i] = U[i] / dt;
       }
+      f[Nx] = 1;
       for (int i = Nx - 1; i >= 1; i--) {
-        f[i] = (d[i] + f[i + 1] * c[i]) / (b[i] - c[i] * e[i + 1]);
+        f[i] =
+            (d[i] + f[i + 1] * c[i]) / (b[i] - c[i] * e[i + 1]);
       }
 
-      const BCfun bc(h0, Cdl, f[1], e[1], E(t1 + dt), E(t1), Ru, alpha, E0, dt,
-                     Itot0, k0);
+      const double Eapp1 = Eapp[2 * n + 2];
+      const double Eapp0 = Eapp[2 * n];
+      const BCfun<double> bc(h0, Cdl, f[1], e[1], Eapp1,
+                             Eapp0 - Itot0 * Ru, Ru, alpha, E0, dt, k0);
 
-      boost::uintmax_t max_it = max_iterations;
-      Itot1 = boost::math::tools::newton_raphson_iterate(
-          bc, Itot0, Itot0 - Itot_bound, Itot0 + Itot_bound, digits_accuracy,
-          max_it);
+      // linear extrapolation from the last two steps as the initial guess
+      const double Itot_guess = 2 * Itot0 - Itot_neg1;
+      const bool solved = solve_bc(bc, Itot_guess, Itot_bound,
+                                   digits_accuracy, max_iterations, st, Itot1);
       // Itot1 =
       // boost::math::tools::bisect(bc,Itot0-1.1,Itot0+1.1,tol,max_it).first;
-      if (max_it == max_iterations)
-        throw std::runtime_error("non-linear solve for Itot[n+1] failed, max "
-                                 "number of iterations reached");
+      if (!solved)
+        throw std::runtime_error("non-linear solve for Itot[n+1] failed, no "
+                                 "root found by Newton or TOMS 748");
+      if (st)
+        st->steps++;
 
       // std::cout << "residual is "<<bc.residual(Itot1)<<std::endl;
       // std::cout << "max_it "<<max_it<<std::endl;
@@ -215,7 +795,31 @@ void e_implicit_exponential_mesh(py::dict params,
       for (int i = 1; i < Nx; i++) {
         U[i] = f[i] + e[i] * U[i - 1];
       }
+
+      const double dRdItot1 = P > 0 ? bc.residual_gradient(Itot1) : 0;
+      for (size_t j = 0; j < P; j++) {
+        std::vector<double> &sUj = sU[j];
+        for (int i = Nx - 1; i >= 1; i--) {
+          sf[i] = (sUj[i] / dt + sf[i + 1] * c[i]) /
+                  (b[i] - c[i] * e[i + 1]);
+        }
+        auto seed = [&](const double value, const int index) {
+          return dual(value, sens[j] == index ? 1 : 0);
+        };
+        const dual sRu = seed(Ru, Ru_index);
+        const BCfun<dual> sbc(h0, seed(Cdl, Cdl_index), dual(f[1], sf[1]),
+                              e[1], Eapp1,
+                              Eapp0 - dual(Itot0, sItot0[j]) * sRu,
+                              sRu, seed(alpha, alpha_index),
+                              seed(E0, E0_index), dt, seed(k0, k0_index));
+        sItot1[j] = -sbc.residual(Itot1).deriv / dRdItot1;
+        sUj[0] = sbc.U0(dual(Itot1, sItot1[j])).deriv;
+        for (int i = 1; i < Nx; i++) {
+          sUj[i] = sf[i] + e[i] * sUj[i - 1];
+        }
+      }
       t1 += dt;
+      n++;
     }
     // 2nd order interpolation
     const double x0 = t1;
@@ -228,15 +832,304 @@ void e_implicit_exponential_mesh(py::dict params,
     const double dt2 = dt * dt;
     // Itot[n_out] = -((x-x0)/dt) * y1 + ((x-x1)/dt) * y0;
     // Itot[n_out] = (Itot1-Itot0)*(t[n_out]-t1+dt)/dt + Itot0;
-    Itot[n_out] = ((x - x0) * (x - x1) / (2 * dt2)) * y2 +
-                  ((x - x0) * (x - x2) / (-dt2)) * y1 +
-                  ((x - x1) * (x - x2) / (2 * dt2)) * y0;
+    const double w2 = (x - x0) * (x - x1) / (2 * dt2);
+    const double w1 = (x - x0) * (x - x2) / (-dt2);
+    const double w0 = (x - x1) * (x - x2) / (2 * dt2);
+    for (size_t j = 0; j < P; j++) {
+      dItot[n_out * P + j] =
+          w2 * sItot_neg1[j] + w1 * sItot0[j] + w0 * sItot1[j];
+    }
+    if (!output(n_out, w2 * y2 + w1 * y1 + w0 * y0))
+      return;
     n_out++;
-    if (n_out >= N) {
+    // no steps are taken after wrapping around, as t[0] < t1
+    if (n_out >= N)
       n_out = 0;
-      E.set_phase(phase - phase_adjust);
-    }
   }
 }
 
+void ECSimulator::simulate(py::array_t<double> values_numpy,
+                           py::array_t<double> t_numpy,
+                           py::array_t<double> Itot_numpy) {
+
+  py::buffer_info values_info = values_numpy.request();
+  py::buffer_info Itot_info = Itot_numpy.request();
+  py::buffer_info t_info = t_numpy.request();
+
+  if ((values_info.ndim != 1) || (Itot_info.ndim != 1) || (t_info.ndim != 1))
+    throw std::runtime_error("Number of dimensions must be one");
+
+  if ((Itot_info.shape[0] != t_info.shape[0]) ||
+      (values_info.shape[0] != indices.size()))
+    throw std::runtime_error("Input shapes must be equal");
+
+  const size_t N = Itot_info.shape[0];
+  auto values = reinterpret_cast<double *>(values_info.ptr);
+  auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+  auto t = reinterpret_cast<double *>(t_info.ptr);
+
+  py::gil_scoped_release release;
+  set_values(values);
+  store_current output(Itot);
+  run(t, N, output);
+}
+
+double ECSimulator::sum_of_squares(py::array_t<double> values_numpy,
+                                   py::array_t<double> t_numpy,
+                                   py::array_t<double> data_numpy,
+                                   const double threshold) {
+
+  py::buffer_info values_info = values_numpy.request();
+  py::buffer_info data_info = data_numpy.request();
+  py::buffer_info t_info = t_numpy.request();
+
+  if ((values_info.ndim != 1) || (data_info.ndim != 1) || (t_info.ndim != 1))
+    throw std::runtime_error("Number of dimensions must be one");
+
+  if ((data_info.shape[0] != t_info.shape[0]) ||
+      (values_info.shape[0] != indices.size()))
+    throw std::runtime_error("Input shapes must be equal");
+
+  const size_t N = data_info.shape[0];
+  auto values = reinterpret_cast<double *>(values_info.ptr);
+  auto data = reinterpret_cast<double *>(data_info.ptr);
+  auto t = reinterpret_cast<double *>(t_info.ptr);
+
+  py::gil_scoped_release release;
+  set_values(values);
+  sum_of_squares_output output(data, threshold);
+  run(t, N, output);
+  return output.sum;
+}
+
+void ECSimulator::enable_stats(const bool enabled) { stats_enabled = enabled; }
+
+py::dict ECSimulator::get_stats() const { return stats.to_dict(); }
+
+void ECSimulator::reset_stats() { stats.reset(); }
+
+void ECSimulator::start(py::array_t<double> values_numpy, const double t_end) {
+  py::buffer_info values_info = values_numpy.request();
+  if (values_info.ndim != 1)
+    throw std::runtime_error("Number of dimensions must be one");
+  if (values_info.shape[0] != indices.size())
+    throw std::runtime_error("Input shapes must be equal");
+
+  set_values(reinterpret_cast<double *>(values_info.ptr));
+  check_chunked();
+  setup(domain_width(&t_end, 1));
+  reset();
+}
+
+void ECSimulator::check_chunked() const {
+  if (params.rtol > 0)
+    throw std::runtime_error(
+        "chunked simulation is not available with adaptive time stepping");
+  if (params.startn != 0)
+    throw std::runtime_error("chunked simulation requires startn = 0");
+  if (params.integral_tol > 0)
+    throw std::runtime_error("chunked simulation is not available with the "
+                             "boundary integral engine");
+  if (params.Ereverse < params.Estart)
+    throw std::runtime_error("Ereverse must be greater than Estart");
+}
+
+void ECSimulator::advance(py::array_t<double> t_numpy,
+                          py::array_t<double> Itot_numpy) {
+  py::buffer_info Itot_info = Itot_numpy.request();
+  py::buffer_info t_info = t_numpy.request();
+
+  if ((Itot_info.ndim != 1) || (t_info.ndim != 1))
+    throw std::runtime_error("Number of dimensions must be one");
+  if (Itot_info.shape[0] != t_info.shape[0])
+    throw std::runtime_error("Input shapes must be equal");
+  if (mesh_Nx < 0)
+    throw std::runtime_error("start or set_state must be called first");
+
+  const size_t N = Itot_info.shape[0];
+  auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+  auto t = reinterpret_cast<double *>(t_info.ptr);
+  // the current is interpolated from the last three steps
+  if (N > 0 && t[0] < t1 - 2 * dt)
+    throw std::runtime_error("times must not be before the solver state");
+
+  py::gil_scoped_release release;
+  store_current output(Itot);
+  step_to(t, N, output, {}, nullptr, 0);
+}
+
+py::dict ECSimulator::get_state() {
+  if (mesh_Nx < 0)
+    throw std::runtime_error("start or set_state must be called first");
+  std::vector<double> values(indices.size());
+  for (size_t j = 0; j < indices.size(); ++j) {
+    values[j] = params[indices[j]];
+  }
+  const std::vector<double> Itot = {Itot_neg1, Itot0, Itot1};
+  py::dict state;
+  state["t"] = t1;
+  state["Itot"] = py::array_t<double>(Itot.size(), Itot.data());
+  state["U"] = py::array_t<double>(U.size(), U.data());
+  state["Xmax"] = mesh_Xmax;
+  state["values"] = py::array_t<double>(values.size(), values.data());
+  return state;
+}
+
+void ECSimulator::set_state(py::dict state) {
+  auto values = state["values"].cast<py::array_t<double>>();
+  auto Itot = state["Itot"].cast<py::array_t<double>>();
+  auto U_state = state["U"].cast<py::array_t<double>>();
+  if (values.size() != indices.size() || Itot.size() != 3 ||
+      U_state.size() != params.Nx + 1)
+    throw std::runtime_error("state does not match the simulator");
+  set_values(values.data());
+  check_chunked();
+  setup(state["Xmax"].cast<double>());
+
+  t1 = state["t"].cast<double>();
+  Itot_neg1 = Itot.at(0);
+  Itot0 = Itot.at(1);
+  Itot1 = Itot.at(2);
+  std::copy(U_state.data(), U_state.data() + U.size(), U.begin());
+}
+
+py::object e_implicit_exponential_mesh(py::dict params,
+                                       py::array_t<double> Itot_numpy,
+                                       py::array_t<double> t_numpy,
+                                       const bool stats) {
+
+  py::buffer_info Itot_info = Itot_numpy.request();
+  py::buffer_info t_info = t_numpy.request();
+
+  if ((Itot_info.ndim != 1) || (t_info.ndim != 1))
+    throw std::runtime_error("Number of dimensions must be one");
+
+  if (Itot_info.shape[0] != t_info.shape[0])
+    throw std::runtime_error("Input shapes must be equal");
+
+  const size_t N = Itot_info.shape[0];
+  auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+  auto t = reinterpret_cast<double *>(t_info.ptr);
+
+  ECSimulator simulator(params);
+  simulator.enable_stats(stats);
+  {
+    py::gil_scoped_release release;
+    store_current output(Itot);
+    simulator.run(t, N, output);
+  }
+  if (stats)
+    return simulator.get_stats();
+  return py::none();
+}
+
+void e_implicit_exponential_mesh_sensitivities(py::dict params,
+                                               py::list names,
+                                               py::array_t<double> Itot_numpy,
+                                               py::array_t<double> dItot_numpy,
+                                               py::array_t<double> t_numpy) {
+
+  py::buffer_info Itot_info = Itot_numpy.request();
+  py::buffer_info dItot_info = dItot_numpy.request();
+  py::buffer_info t_info = t_numpy.request();
+
+  if ((Itot_info.ndim != 1) || (dItot_info.ndim != 2) || (t_info.ndim != 1))
+    throw std::runtime_error("Itot and t must be one dimensional, and dItot "
+                             "must be two dimensional");
+
+  if ((Itot_info.shape[0] != t_info.shape[0]) ||
+      (dItot_info.shape[0] != t_info.shape[0]) ||
+      (dItot_info.shape[1] != py::len(names)))
+    throw std::runtime_error("Input shapes must be equal");
+
+  const size_t N = Itot_info.shape[0];
+  auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+  auto dItot = reinterpret_cast<double *>(dItot_info.ptr);
+  auto t = reinterpret_cast<double *>(t_info.ptr);
+
+  const std::vector<int> sens = ECParams::indices(names);
+  for (size_t j = 0; j < sens.size(); ++j) {
+    if (sens[j] > ECParams::index("E0"))
+      throw std::runtime_error("sensitivities not available for parameter: " +
+                               names[j].cast<std::string>());
+  }
+
+  ECSimulator simulator(params);
+  py::gil_scoped_release release;
+  store_current output(Itot);
+  simulator.run(t, N, output, sens, dItot);
+}
+
+double e_implicit_exponential_mesh_sum_of_squares(
+    py::dict params, py::array_t<double> data_numpy,
+    py::array_t<double> t_numpy, const double threshold) {
+
+  py::buffer_info data_info = data_numpy.request();
+  py::buffer_info t_info = t_numpy.request();
+
+  if ((data_info.ndim != 1) || (t_info.ndim != 1))
+    throw std::runtime_error("Number of dimensions must be one");
+
+  if (data_info.shape[0] != t_info.shape[0])
+    throw std::runtime_error("Input shapes must be equal");
+
+  const size_t N = data_info.shape[0];
+  auto data = reinterpret_cast<double *>(data_info.ptr);
+  auto t = reinterpret_cast<double *>(t_info.ptr);
+
+  ECSimulator simulator(params);
+  py::gil_scoped_release release;
+  sum_of_squares_output output(data, threshold);
+  simulator.run(t, N, output);
+  return output.sum;
+}
+
+void e_implicit_exponential_mesh_batch(py::dict params, py::list names,
+                                       py::array_t<double> values_numpy,
+                                       py::array_t<double> Itot_numpy,
+                                       py::array_t<double> t_numpy,
+                                       const int n_threads) {
+
+  py::buffer_info values_info = values_numpy.request();
+  py::buffer_info Itot_info = Itot_numpy.request();
+  py::buffer_info t_info = t_numpy.request();
+
+  if ((values_info.ndim != 2) || (Itot_info.ndim != 2) || (t_info.ndim != 1))
+    throw std::runtime_error("values and Itot must be two dimensional, and t "
+                             "must be one dimensional");
+
+  if ((values_info.shape[0] != Itot_info.shape[0]) ||
+      (values_info.shape[1] != py::len(names)) ||
+      (Itot_info.shape[1] != t_info.shape[0]))
+    throw std::runtime_error("Input shapes must be equal");
+
+  const size_t Nbatch = values_info.shape[0];
+  const size_t Nparams = values_info.shape[1];
+  const size_t N = t_info.shape[0];
+  auto values = reinterpret_cast<double *>(values_info.ptr);
+  auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+  auto t = reinterpret_cast<double *>(t_info.ptr);
+
+  // one simulator (and hence one set of work arrays) per thread
+  std::vector<ECSimulator> simulators(parallel_for_threads(Nbatch, n_threads),
+                                      ECSimulator(params, names));
+
+  py::gil_scoped_release release;
+  parallel_for(Nbatch, n_threads, [&](const size_t i, const size_t thread) {
+    ECSimulator &simulator = simulators[thread];
+    simulator.set_values(values + i * Nparams);
+    store_current output(Itot + i * N);
+    simulator.run(t, N, output);
+  });
+}
+
+// the kernels run by joint_sum_of_squares and joint_simulate
+template void ECSimulator::run<store_current>(const double *, const size_t,
+                                              store_current &,
+                                              const std::vector<int> &,
+                                              double *);
+template void ECSimulator::run<sum_of_squares_output>(
+    const double *, const size_t, sum_of_squares_output &,
+    const std::vector<int> &, double *);
+
 } // namespace electrochemistry
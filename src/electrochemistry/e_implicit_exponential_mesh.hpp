@@ -3,13 +3,220 @@
 
 #include "utilities.hpp"
 
+#include <boost/math/constants/constants.hpp>
+
 #include <map>
 #include <string>
 #include <vector>
 
 namespace electrochemistry {
-void e_implicit_exponential_mesh(py::dict params, py::array_t<double> Itot,
-                                 py::array_t<double> t);
+
+struct ECParams {
+  ECParams(py::dict params)
+      : k0(get(params, std::string("k0"), 35.0)),
+        alpha(get(params, std::string("alpha"), 0.5)),
+        Cdl(get(params, std::string("Cdl"), 0.0037)),
+        Ru(get(params, std::string("Ru"), 2.74)),
+        E0(get(params, std::string("E0"), 0.0)),
+        dE(get(params, std::string("dE"), 0.1)),
+        Estart(get(params, std::string("Estart"), -10.0)),
+        Ereverse(get(params, std::string("Ereverse"), 10.0)),
+        omega(get(params, std::string("omega"),
+                  2 * boost::math::constants::pi<double>())),
+        phase(get(params, std::string("phase"), 0.0)),
+        Nx(get(params, std::string("Nx"), 300.0)),
+        Nt(get(params, std::string("Nt"), 200.0)),
+        startn(get(params, std::string("startn"), 0.0)),
+        rtol(get(params, std::string("rtol"), 0.0)),
+        atol(get(params, std::string("atol"), 1e-6)),
+        Xmax(get(params, std::string("Xmax"), 20.0)),
+        integral_tol(get(params, std::string("integral_tol"), 0.0)),
+        Edata(get(params, std::string("Edata"), std::vector<double>())),
+        dt_data(get(params, std::string("dt_data"), 0.0)) {}
+
+  // number of (floating point) parameters accessible with operator[]
+  static const int size = 10;
+
+  // name of the parameter with index i
+  static std::string name(const int i) {
+    const char *names[] = {"k0", "alpha",  "Cdl",      "Ru",    "E0",
+                           "dE", "Estart", "Ereverse", "omega", "phase"};
+    return names[i];
+  }
+
+  // index of a named (floating point) parameter, for use with operator[]
+  static int index(const std::string &name) {
+    for (int i = 0; i < size; ++i) {
+      if (name == ECParams::name(i))
+        return i;
+    }
+    throw std::runtime_error("unknown parameter name: " + name);
+  }
+
+  // indices of a list of parameter names
+  static std::vector<int> indices(py::list names) {
+    std::vector<int> indices(py::len(names));
+    for (size_t j = 0; j < indices.size(); ++j) {
+      indices[j] = index(names[j].cast<std::string>());
+    }
+    return indices;
+  }
+
+  double &operator[](const int i) {
+    switch (i) {
+    case 0:
+      return k0;
+    case 1:
+      return alpha;
+    case 2:
+      return Cdl;
+    case 3:
+      return Ru;
+    case 4:
+      return E0;
+    case 5:
+      return dE;
+    case 6:
+      return Estart;
+    case 7:
+      return Ereverse;
+    case 8:
+      return omega;
+    default:
+      return phase;
+    }
+  }
+
+  double k0, alpha, Cdl, Ru, E0, dE, Estart, Ereverse, omega, phase;
+  int Nx, Nt, startn;
+
+  // tolerances for adaptive time stepping, which replaces the fixed Nt steps
+  // per period if rtol > 0
+  double rtol, atol;
+
+  // width of the spatial domain (chosen from the simulated times if <= 0)
+  double Xmax;
+
+  // tolerance of the sum-of-exponentials approximation to the diffusion
+  // kernel of the boundary integral engine, which replaces the spatial mesh
+  // if integral_tol > 0
+  double integral_tol;
+
+  // measured applied potential, sampled every dt_data from t = 0, which
+  // replaces the dc ramp and sine wave if not empty (see applied_potential)
+  std::vector<double> Edata;
+  double dt_data;
+};
+
+// Simulates the EC model for many parameter sets in turn. The spatial mesh,
+// the tridiagonal coefficients and all work arrays depend only on Nx, Nt and
+// omega, so they are calculated once and reused by every simulation. Not
+// thread safe, use one ECSimulator per thread.
+class ECSimulator {
+public:
+  // params gives every parameter, and names (or indices) the parameters
+  // which are then set by each call to simulate
+  ECSimulator(const ECParams &params, const std::vector<int> &indices = {});
+  ECSimulator(py::dict params, py::list names);
+
+  void simulate(py::array_t<double> values, py::array_t<double> t,
+                py::array_t<double> Itot);
+  double sum_of_squares(py::array_t<double> values, py::array_t<double> t,
+                        py::array_t<double> data, const double threshold);
+
+  // chunked simulation with fixed time steps: start sets the values and
+  // resets the solver state to t = 0 (with the mesh for times up to t_end),
+  // advance continues from the state to the times t, and get_state and
+  // set_state snapshot and restore the state between calls
+  void start(py::array_t<double> values, const double t_end);
+  void advance(py::array_t<double> t, py::array_t<double> Itot);
+  py::dict get_state();
+  void set_state(py::dict state);
+
+  // solver stats (see solver_stats) are recorded while enabled, and summed
+  // over simulations until reset. Recording is off by default
+  void enable_stats(const bool enabled = true);
+  py::dict get_stats() const;
+  void reset_stats();
+
+  void set_values(const double *values);
+  template <typename Output>
+  void run(const double *t, const size_t N, Output &output,
+           const std::vector<int> &sens = {}, double *dItot = nullptr);
+
+  ECParams params;
+  std::vector<int> indices;
+
+private:
+  template <typename Output>
+  void integrate(const double *t, const size_t N, Output &output,
+                 const std::vector<int> &sens, double *dItot);
+  void setup(const double Xmax);
+  void check_chunked() const;
+  void reset();
+  template <typename Output>
+  void step_to(const double *t, const size_t N, Output &output,
+               const std::vector<int> &sens, double *dItot, const int startn);
+  double domain_width(const double *t, const size_t N) const;
+  template <typename Output>
+  void run_adaptive(const double *t, const size_t N, Output &output);
+  void setup_integral(const double t_end);
+  template <typename Output>
+  void run_integral(const double *t, const size_t N, Output &output);
+
+  solver_stats stats;
+  bool stats_enabled;
+
+  // settings used to build the cached mesh
+  int mesh_Nx, mesh_Nt;
+  double mesh_omega, mesh_Xmax;
+
+  double h0, dt;
+
+  // solver state: the time t1 and the current at the last three steps
+  double t1, Itot_neg1, Itot0, Itot1;
+  std::vector<double> a, b, c, d, e, f, g, U;
+  std::vector<double> sf, sItot0, sItot1, sItot_neg1;
+  std::vector<std::vector<double>> sU;
+
+  // applied potential at the half steps of the fixed-step solvers
+  Etable Etab;
+
+  // extra work arrays for adaptive time stepping
+  std::vector<double> e_step, U_prev, U_prev2, U_new;
+
+  // boundary integral engine: exponents, weights and per-step decay of each
+  // term of the sum of exponentials, their gains from If at the start and
+  // end of a step, the history of each term, and the settings they were
+  // calculated for
+  std::vector<double> soe_s, soe_w, soe_decay, soe_gain0, soe_gain1;
+  std::vector<double> soe_history;
+  double soe_dt, soe_t_end, soe_tol;
+};
+
+py::object e_implicit_exponential_mesh(py::dict params,
+                                       py::array_t<double> Itot_numpy,
+                                       py::array_t<double> t_numpy,
+                                       const bool stats);
+
+void e_implicit_exponential_mesh_sensitivities(py::dict params,
+                                               py::list names,
+                                               py::array_t<double> Itot,
+                                               py::array_t<double> dItot,
+                                               py::array_t<double> t);
+
+// sum of squared differences between the simulated current and data, stops
+// early and returns the partial sum once it exceeds threshold
+double e_implicit_exponential_mesh_sum_of_squares(py::dict params,
+                                                  py::array_t<double> data,
+                                                  py::array_t<double> t,
+                                                  const double threshold);
+
+void e_implicit_exponential_mesh_batch(py::dict params, py::list names,
+                                       py::array_t<double> values,
+                                       py::array_t<double> Itot,
+                                       py::array_t<double> t,
+                                       const int n_threads);
 }
 
 #endif
@@ -0,0 +1,161 @@
+from __future__ import print_function
+import pints
+import numpy as np
+
+from .harmonics import HarmonicTransform
+
+
+class SumOfSquaresError(pints.SumOfSquaresError):
+
+    """Sum of squared errors between a :class:`PintsModelAdaptor` and data,
+    accumulated inside the simulation kernel so that the simulated current is
+    never stored
+
+    Args:
+        problem (pints.SingleOutputProblem): problem wrapping a
+            :class:`PintsModelAdaptor`
+        threshold (float): if the partial sum exceeds this value the
+            simulation is stopped early, and the partial sum (which is then
+            also greater than threshold) is returned
+    """
+
+    def __init__(self, problem, threshold=np.inf):
+        super(SumOfSquaresError, self).__init__(problem)
+        self.threshold = threshold
+
+    def __call__(self, x):
+        return self._problem.model().sum_of_squares(
+            x, self._times, self._values, self.threshold)
+
+
+class GaussianKnownSigmaLogLikelihood(pints.GaussianKnownSigmaLogLikelihood):
+
+    """Gaussian log-likelihood with known noise level sigma, using the sum of
+    squared errors accumulated inside the simulation kernel
+
+    Args:
+        problem (pints.SingleOutputProblem): problem wrapping a
+            :class:`PintsModelAdaptor`
+        sigma (float): standard deviation of the noise
+        threshold (float): if the log-likelihood is certain to be less than
+            this value the simulation is stopped early, and a value less than
+            threshold is returned (e.g. the log-likelihood below which an MCMC
+            proposal will be rejected)
+    """
+
+    def __init__(self, problem, sigma, threshold=-np.inf):
+        super(GaussianKnownSigmaLogLikelihood, self).__init__(problem, sigma)
+        self.threshold = threshold
+        # log-likelihood = offset + multip * sum of squares
+        sigma = float(sigma)
+        n_times = len(self._times)
+        self.offset = -0.5 * n_times * np.log(2 * np.pi * sigma**2)
+        self.multip = -0.5 / sigma**2
+
+    def __call__(self, x):
+        sum_threshold = (self.threshold - self.offset) / self.multip
+        sum_of_squares = self._problem.model().sum_of_squares(
+            x, self._times, self._values, sum_threshold)
+        return self.offset + self.multip * sum_of_squares
+
+
+class HarmonicSumOfSquaresError(pints.ProblemErrorMeasure):
+
+    """Sum of squared errors between the selected harmonics of a
+    :class:`PintsModelAdaptor` and of the data, compared through their
+    windowed Fourier coefficients (see :class:`HarmonicTransform`). The
+    transform of the data is computed once, here
+
+    Args:
+        problem (pints.SingleOutputProblem): problem wrapping a
+            :class:`PintsModelAdaptor`, with uniformly spaced times
+        harmonics (list of int): harmonics to compare
+        bandwidth (float): half-width of the window around each harmonic, as
+            a fraction of the fundamental frequency
+        omega (float): (non-dimensional) angular frequency, by default that
+            of the wrapped model
+    """
+
+    def __init__(self, problem, harmonics, bandwidth=0.5, omega=None):
+        super(HarmonicSumOfSquaresError, self).__init__(problem)
+        if omega is None:
+            omega = problem.model().ec_model.params['omega']
+        self.transform = HarmonicTransform(
+            self._times, omega, harmonics, bandwidth)
+        self._data = self.transform.coefficients(self._values)
+
+    def __call__(self, x):
+        simulated = self.transform.coefficients(self._problem.evaluate(x))
+        return self.transform.sum_of_squares(simulated, self._data)
+
+    def evaluateS1(self, x):
+        y, dy = self._problem.evaluateS1(x)
+        r = self.transform.coefficients(y) - self._data
+        dr = self.transform.coefficients(dy)
+        weights = self.transform.weights
+        error = np.sum(weights * np.abs(r)**2)
+        derror = 2 * np.sum(
+            (weights * np.conj(r)).reshape(-1, 1) * dr, axis=0).real
+        return error, derror
+
+
+class MultiExperimentSumOfSquaresError(pints.ErrorMeasure):
+
+    """Weighted sum over several experiments of the sums of squared errors
+    between a :class:`MultiExperimentModel` and the data of each, see
+    :meth:`MultiExperimentModel.sum_of_squares`
+
+    Args:
+        model (MultiExperimentModel): the experiments and their data
+        threshold (float): if the sum exceeds this value the simulations are
+            stopped early, and a partial sum (also greater than threshold) is
+            returned
+    """
+
+    def __init__(self, model, threshold=np.inf):
+        super(MultiExperimentSumOfSquaresError, self).__init__()
+        self._model = model
+        self.threshold = threshold
+
+    def n_parameters(self):
+        return self._model.n_parameters()
+
+    def __call__(self, x):
+        return self._model.sum_of_squares(x, self.threshold)
+
+
+class MultiExperimentLogLikelihood(pints.LogPDF):
+
+    """Gaussian log-likelihood of the data of several experiments, with a
+    known noise level for each, given the shared parameters of a
+    :class:`MultiExperimentModel`
+
+    Args:
+        model (MultiExperimentModel): the experiments and their data
+        sigma (float or numpy vector): standard deviation of the noise of
+            each experiment, in that experiment's (non-dimensional) current
+            units
+        threshold (float): if the log-likelihood is certain to be less than
+            this value the simulations are stopped early, and a value less
+            than threshold is returned
+    """
+
+    def __init__(self, model, sigma, threshold=-np.inf):
+        super(MultiExperimentLogLikelihood, self).__init__()
+        self._model = model
+        sigma = np.broadcast_to(np.asarray(sigma, dtype='double'),
+                                (model.n_experiments(),))
+        if np.any(sigma <= 0):
+            raise ValueError('Standard deviation must be greater than zero.')
+        n_times = np.array([len(times) for times in model.times])
+        self._offset = -0.5 * np.sum(n_times * np.log(2 * np.pi * sigma**2))
+        self._multip = 0.5 / sigma**2
+        self.threshold = threshold
+
+    def n_parameters(self):
+        return self._model.n_parameters()
+
+    def __call__(self, x):
+        sum_threshold = self._offset - self.threshold
+        return self._offset - self._model.sum_of_squares(
+            x, sum_threshold, self._multip)
@@ -0,0 +1,168 @@
+from __future__ import print_function
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from .cache import _json_default
+
+# mesh levels of the fixed-step solvers, coarse to fine, each halving the
+# time step. The EC spatial error converges by Nx ~ 150 (the mesh is
+# geometric, so more points mostly refine it at the electrode), so Nx grows
+# with the first few levels and is then held
+EC_LEVELS = [
+    {'Nx': 50, 'Nt': 25},
+    {'Nx': 100, 'Nt': 50},
+    {'Nx': 150, 'Nt': 100},
+    {'Nx': 200, 'Nt': 200},
+    {'Nx': 300, 'Nt': 400},
+    {'Nx': 300, 'Nt': 800},
+    {'Nx': 300, 'Nt': 1600},
+    {'Nx': 300, 'Nt': 3200},
+]
+POM_LEVELS = [{'Nt': 150 * 2**level} for level in range(8)]
+
+# the (non-dimensional) parameters that describe an experiment, rather than
+# the electrode kinetics being fitted
+PROTOCOL = ['Estart', 'Ereverse', 'omega', 'phase', 'dE', 'Edata', 'dt_data']
+
+
+class MultilevelFidelity:
+
+    """Runs an :class:`ECModel` or :class:`POMModel` at a ladder of mesh
+    levels, from coarse to fine, and estimates the discretisation error of
+    each by Richardson extrapolation against the next finer level
+
+    Each level halves the time step of the one before, so if the error of
+    level ``l`` is ``C dt^p`` the difference ``d`` between levels ``l`` and
+    ``l + 1`` gives the error of level ``l`` as ``d 2^p / (2^p - 1)``, and the
+    extrapolated current as that of level ``l + 1`` plus ``d / (2^p - 1)``.
+    Errors are relative, the max absolute error over the max absolute current.
+    The levels set 'Nx' and 'Nt', so are for the fixed-step solvers.
+
+    :meth:`select` chooses the cheapest level meeting a tolerance, and caches
+    the choice for the protocol of the experiment (the times and the
+    parameters in ``PROTOCOL``), so that it is made once for each
+    experiment, not for every parameter set of a fit.
+
+    Args:
+        model (ECModel or POMModel): model to simulate
+        levels (list of dict): solver settings of each level, by default
+            ``EC_LEVELS`` or ``POM_LEVELS``
+        order (float): order of convergence p of the error in the time step,
+            1 for the backward Euler steps of both models
+        filename (str): optional JSON file the selections are loaded from (if
+            it exists) and written to by :meth:`select`
+    """
+
+    def __init__(self, model, levels=None, order=1, filename=None):
+        if levels is None:
+            levels = EC_LEVELS if 'Nx' in model.params else POM_LEVELS
+        self.model = model
+        self.levels = [dict(level) for level in levels]
+        self.order = order
+        self.filename = filename
+        self._selections = {}
+        self._lock = threading.Lock()
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                self._selections = json.load(f)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def n_levels(self):
+        return len(self.levels)
+
+    def params(self, level, params=None):
+        """ a copy of ``params`` (default ``model.params``) with the solver
+        settings of the given level
+        """
+        if params is None:
+            params = self.model.params
+        return dict(params, **self.levels[level])
+
+    def simulate(self, times, level, params=None):
+        """ the current at the given times, simulated at the given level """
+        return self.model.simulate(times, self.params(level, params))
+
+    def _richardson(self, coarse, fine):
+        # the relative error of coarse, and the extrapolated current
+        ratio = 2.0**self.order
+        difference = fine - coarse
+        scale = np.max(np.abs(fine))
+        error = np.max(np.abs(difference)) * ratio / (ratio - 1)
+        return error / scale, fine + difference / (ratio - 1)
+
+    def error_estimate(self, times, level, params=None):
+        """ the estimated relative error of the current simulated at a level
+        (below the finest), from the next finer level
+
+        returns:
+            error (float): the estimated error
+            current (numpy vector): the extrapolated current, usually more
+                accurate than that of either level
+        """
+        if level >= len(self.levels) - 1:
+            raise ValueError('the finest level has no error estimate')
+        return self._richardson(self.simulate(times, level, params),
+                                self.simulate(times, level + 1, params))
+
+    def observed_order(self, times, level, params=None):
+        """ the order of convergence shown by levels ``level``,
+        ``level + 1`` and ``level + 2``, to check ``order`` against
+        """
+        currents = [self.simulate(times, level + i, params)
+                    for i in range(3)]
+        return np.log2(np.max(np.abs(currents[1] - currents[0])) /
+                       np.max(np.abs(currents[2] - currents[1])))
+
+    def _key(self, times, tolerance, params):
+        protocol = [(name, params[name]) for name in PROTOCOL
+                    if name in params]
+        h = hashlib.sha1()
+        h.update(json.dumps([protocol, tolerance, self.levels],
+                            default=_json_default).encode())
+        h.update(np.ascontiguousarray(times, dtype='double').tobytes())
+        return h.hexdigest()
+
+    def select(self, times, tolerance, params=None):
+        """ the cheapest level whose estimated relative error is at most
+        ``tolerance`` (or the finest, if none are), for the experiment with
+        the given times and ``params`` (default ``model.params``)
+
+        Levels are tried from coarse to fine, each simulation being reused
+        for the estimate of the level below it. The choice is cached (and
+        written to ``filename``, if given) by protocol.
+        """
+        if params is None:
+            params = self.model.params
+        times = np.asarray(times, dtype='double')
+        key = self._key(times, tolerance, params)
+        with self._lock:
+            if key in self._selections:
+                return self._selections[key]
+
+        level = len(self.levels) - 1
+        coarse = self.simulate(times, 0, params)
+        for i in range(len(self.levels) - 1):
+            fine = self.simulate(times, i + 1, params)
+            if self._richardson(coarse, fine)[0] <= tolerance:
+                level = i
+                break
+            coarse = fine
+
+        with self._lock:
+            self._selections[key] = level
+            if self.filename is not None:
+                with open(self.filename, 'w') as f:
+                    json.dump(self._selections, f)
+        return level
@@ -0,0 +1,96 @@
+from __future__ import print_function
+import numpy as np
+from math import pi
+
+
+class HarmonicTransform:
+
+    """Band-pass filters a current, sampled at uniformly spaced times, around
+    harmonics of the angular frequency omega of the applied potential
+
+    The filter for harmonic h is a Hann window in the frequency domain,
+    centred on h*omega/(2*pi) and with a half-width of bandwidth times the
+    fundamental frequency, so that with the default bandwidth of 0.5 adjacent
+    windows meet. Only the Fourier coefficients inside these windows are kept,
+    which for a current sampled over many periods is a much smaller
+    representation than the time series.
+
+    Args:
+        times (numpy vector): uniformly spaced sample times
+        omega (float): angular frequency, in the units of 1/times
+        harmonics (list of int): harmonics to keep, 0 being the dc component
+        bandwidth (float): half-width of each window, as a fraction of the
+            fundamental frequency
+    """
+
+    def __init__(self, times, omega, harmonics, bandwidth=0.5):
+        n = len(times)
+        dt = (times[-1] - times[0]) / (n - 1)
+        frequencies = np.fft.rfftfreq(n, dt)
+        fundamental = omega / (2 * pi)
+
+        self.n = n
+        self.harmonics = list(harmonics)
+        self.bins = []
+        self.windows = []
+        for h in self.harmonics:
+            distance = np.abs(frequencies - h * fundamental) / \
+                (bandwidth * fundamental)
+            bins = np.nonzero(distance < 1)[0]
+            self.bins.append(bins)
+            self.windows.append(0.5 * (1 + np.cos(pi * distance[bins])))
+
+        # the coefficients kept, and their weights in the sum of squares, so
+        # that by Parseval's theorem this is the sum of squares of the
+        # filtered signals in the time domain
+        self._index = np.concatenate(self.bins)
+        self._window = np.concatenate(self.windows)
+        self.weights = np.where(self._index == 0, 1.0, 2.0) / n
+        if n % 2 == 0:
+            self.weights[self._index == n // 2] = 1.0 / n
+
+    def coefficients(self, current):
+        """ the windowed Fourier coefficients of the current, concatenated
+        over the harmonics
+
+        Args:
+            current (numpy array): current at the times, along the first axis
+
+        returns:
+            numpy array: complex coefficients along the first axis
+        """
+        spectrum = np.fft.rfft(current, axis=0)[self._index]
+        window = self._window.reshape((-1,) + (1,) * (spectrum.ndim - 1))
+        return spectrum * window
+
+    def sum_of_squares(self, a, b):
+        """ the sum of squared differences between two sets of coefficients
+        (from :meth:`coefficients`), equal to that between the filtered
+        signals
+        """
+        return np.sum(self.weights * np.abs(a - b)**2)
+
+    def envelopes(self, current):
+        """ the envelopes of the filtered harmonics of the current
+
+        Args:
+            current (numpy vector): current at the times
+
+        returns:
+            numpy array: the envelope of harmonic ``harmonics[i]`` in row i,
+            or for harmonic 0 the filtered (dc) current itself
+        """
+        spectrum = np.fft.rfft(current)
+        envelopes = np.empty((len(self.harmonics), self.n))
+        for i, (h, bins, window) in enumerate(
+                zip(self.harmonics, self.bins, self.windows)):
+            if h == 0:
+                band = np.zeros(len(spectrum), dtype=complex)
+                band[bins] = spectrum[bins] * window
+                envelopes[i] = np.fft.irfft(band, self.n)
+            else:
+                # analytic signal of the band, from the positive frequencies
+                band = np.zeros(self.n, dtype=complex)
+                band[bins] = 2 * spectrum[bins] * window
+                envelopes[i] = np.abs(np.fft.ifft(band))
+        return envelopes
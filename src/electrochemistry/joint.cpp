@@ -0,0 +1,150 @@
+#include "joint.hpp"
+
+#include <set>
+
+namespace electrochemistry {
+
+namespace {
+
+typedef py::array_t<double, py::array::c_style | py::array::forcecast>
+    double_array;
+
+// one experiment of a joint simulation, pointing into arrays that are kept
+// alive by the caller
+struct experiment {
+    ECSimulator *ec;
+    POMSimulator *pom;
+    const double *values;
+    const double *t;
+    size_t N;
+
+    template <typename Output>
+    void run(Output &output) {
+        if (ec) {
+            ec->set_values(values);
+            ec->run(t, N, output);
+        } else {
+            pom->set_values(values);
+            pom->run(t, N, output);
+        }
+    }
+};
+
+// checks the simulators, values and times of a joint simulation, appending
+// the (possibly converted) arrays to arrays so that they outlive the
+// experiments
+std::vector<experiment> experiments(py::list simulators, py::list values,
+                                    py::list t,
+                                    std::vector<double_array> &arrays) {
+    const size_t n = py::len(simulators);
+    if ((py::len(values) != n) || (py::len(t) != n))
+        throw std::runtime_error("Input shapes must be equal");
+
+    std::vector<experiment> result(n);
+    std::set<void *> seen;
+    for (size_t i = 0; i < n; ++i) {
+        experiment &e = result[i];
+        py::handle simulator = simulators[i];
+        size_t Nparams;
+        if (py::isinstance<ECSimulator>(simulator)) {
+            e.ec = simulator.cast<ECSimulator *>();
+            e.pom = nullptr;
+            Nparams = e.ec->indices.size();
+        } else if (py::isinstance<POMSimulator>(simulator)) {
+            e.ec = nullptr;
+            e.pom = simulator.cast<POMSimulator *>();
+            Nparams = e.pom->indices.size();
+        } else {
+            throw std::runtime_error(
+                "simulators must be ECSimulator or POMSimulator objects");
+        }
+        if (!seen.insert(simulator.ptr()).second)
+            throw std::runtime_error("each simulator may only be used once");
+
+        double_array v = values[i].cast<double_array>();
+        double_array times = t[i].cast<double_array>();
+        arrays.push_back(v);
+        arrays.push_back(times);
+        if ((v.ndim() != 1) || (times.ndim() != 1))
+            throw std::runtime_error("Number of dimensions must be one");
+        if (static_cast<size_t>(v.shape(0)) != Nparams)
+            throw std::runtime_error("Input shapes must be equal");
+        e.values = v.data();
+        e.t = times.data();
+        e.N = times.shape(0);
+    }
+    return result;
+}
+
+} // namespace
+
+void joint_sum_of_squares(py::list simulators, py::list values, py::list t,
+                          py::list data, py::array_t<double> thresholds_numpy,
+                          py::array_t<double> sums_numpy,
+                          const int n_threads) {
+
+    std::vector<double_array> arrays;
+    std::vector<experiment> joint =
+        experiments(simulators, values, t, arrays);
+
+    py::buffer_info thresholds_info = thresholds_numpy.request();
+    py::buffer_info sums_info = sums_numpy.request();
+    if ((thresholds_info.ndim != 1) || (sums_info.ndim != 1))
+        throw std::runtime_error("Number of dimensions must be one");
+    if ((py::len(data) != joint.size()) ||
+        (static_cast<size_t>(thresholds_info.shape[0]) != joint.size()) ||
+        (static_cast<size_t>(sums_info.shape[0]) != joint.size()))
+        throw std::runtime_error("Input shapes must be equal");
+    auto thresholds = reinterpret_cast<double *>(thresholds_info.ptr);
+    auto sums = reinterpret_cast<double *>(sums_info.ptr);
+
+    std::vector<const double *> observed(joint.size());
+    for (size_t i = 0; i < joint.size(); ++i) {
+        double_array d = data[i].cast<double_array>();
+        arrays.push_back(d);
+        if ((d.ndim() != 1) || (static_cast<size_t>(d.shape(0)) != joint[i].N))
+            throw std::runtime_error("Input shapes must be equal");
+        observed[i] = d.data();
+    }
+
+    py::gil_scoped_release release;
+    parallel_for(joint.size(), n_threads,
+                 [&](const size_t i, const size_t /*thread*/) {
+                     sum_of_squares_output output(observed[i],
+                                                  thresholds[i]);
+                     joint[i].run(output);
+                     sums[i] = output.sum;
+                 });
+}
+
+void joint_simulate(py::list simulators, py::list values, py::list t,
+                    py::list Itot, const int n_threads) {
+
+    std::vector<double_array> arrays;
+    std::vector<experiment> joint =
+        experiments(simulators, values, t, arrays);
+
+    if (py::len(Itot) != joint.size())
+        throw std::runtime_error("Input shapes must be equal");
+    std::vector<double *> current(joint.size());
+    for (size_t i = 0; i < joint.size(); ++i) {
+        // written in place, so must not be a converted copy
+        py::handle h = Itot[i];
+        if (!double_array::check_(h))
+            throw std::runtime_error(
+                "Itot must hold contiguous arrays of doubles");
+        double_array I = h.cast<double_array>();
+        if ((I.ndim() != 1) || (static_cast<size_t>(I.shape(0)) != joint[i].N))
+            throw std::runtime_error("Input shapes must be equal");
+        current[i] = I.mutable_data();
+    }
+
+    py::gil_scoped_release release;
+    parallel_for(joint.size(), n_threads,
+                 [&](const size_t i, const size_t /*thread*/) {
+                     store_current output(current[i]);
+                     joint[i].run(output);
+                 });
+}
+
+} // namespace electrochemistry
@@ -0,0 +1,30 @@
+#ifndef JOINT_HPP
+#define JOINT_HPP
+
+#include "e_implicit_exponential_mesh.hpp"
+#include "seq_electron_transfer3_explicit.hpp"
+
+namespace electrochemistry {
+
+// simulations of several experiments at once, e.g. for fitting one set of
+// parameters to all of them. Experiment i is simulated by simulators[i] (an
+// ECSimulator or POMSimulator, each made with its own parameters and
+// protocol) with the values values[i] at the times t[i], and the experiments
+// are run concurrently on up to n_threads threads (all cores if n_threads <=
+// 0), so that they take about as long as the slowest one. A simulator may
+// only appear once
+
+// sums[i] = sum of squared differences between the current of experiment i
+// and data[i], stopped early (see sum_of_squares_output) once it exceeds
+// thresholds[i]
+void joint_sum_of_squares(py::list simulators, py::list values, py::list t,
+                          py::list data, py::array_t<double> thresholds,
+                          py::array_t<double> sums, const int n_threads);
+
+// writes the current of experiment i to Itot[i]
+void joint_simulate(py::list simulators, py::list values, py::list t,
+                    py::list Itot, const int n_threads);
+
+} // namespace electrochemistry
+
+#endif // JOINT_HPP
@@ -0,0 +1,161 @@
+from __future__ import print_function
+import threading
+
+import numpy as np
+
+import electrochemistry
+from .models import _same_params
+
+
+class MultiExperimentModel:
+
+    """Simulates several experiments (e.g. with different omega, dE, scan
+    direction or electrode) with one shared set of parameters, for fitting
+    them jointly
+
+    Each experiment has its own :class:`ECModel` or :class:`POMModel`, made
+    with that experiment's protocol, and so its own non-dimensional scaling.
+    The shared parameter vector is non-dimensional in the scaling of the
+    first (reference) experiment, with E0 as given to its constructor (see
+    :class:`ParameterTransform`), and is mapped into the scaling of each
+    experiment by a precomputed scale and offset, undoing the mirroring of E0
+    of any reversed scans. The experiments are then simulated concurrently in
+    the compiled kernels, one thread each, so that an evaluation takes about
+    as long as the slowest experiment.
+
+    Args:
+        models (list of ECModel or POMModel): model of each experiment
+        names (list of str): names of the shared parameters
+        datasets (list): data of each experiment, an :class:`ECTimeData`
+            loaded with that experiment's model, or a ``(times, current)``
+            pair of non-dimensional arrays
+        weights (numpy vector): weight of each experiment's sum of squares in
+            :meth:`sum_of_squares`, by default ``(I0 / I0_ref)**2`` so that
+            the sum is of the residuals in the current units of the reference
+            experiment
+        n_threads (int): number of threads, default uses all cores
+    """
+
+    def __init__(self, models, names, datasets, weights=None, n_threads=0):
+        if len(models) != len(datasets):
+            raise ValueError('need one dataset per model')
+        self.models = list(models)
+        self.names = list(names)
+        self.n_threads = n_threads
+        self.times = []
+        self.data = []
+        for dataset in datasets:
+            if isinstance(dataset, tuple):
+                times, current = dataset
+            else:
+                times, current = dataset.times, dataset.current
+            self.times.append(np.ascontiguousarray(times, dtype='double'))
+            self.data.append(np.ascontiguousarray(current, dtype='double'))
+            if len(self.times[-1]) != len(self.data[-1]):
+                raise ValueError('times and current of a dataset differ in '
+                                 'length')
+
+        # experiment i's vector = shared vector * scale[i] + offset[i]
+        reference = self.models[0].transform(self.names, experiment=True)
+        self.transform = reference
+        self._scale = []
+        self._offset = []
+        for model in self.models:
+            transform = model.transform(self.names, experiment=True)
+            self._scale.append(reference.scale / transform.scale)
+            self._offset.append(
+                (reference.offset - transform.offset) / transform.scale)
+
+        if weights is None:
+            I0 = self.models[0].I0
+            weights = [(model.I0 / I0)**2 for model in self.models]
+        self.weights = np.asarray(weights, dtype='double')
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # the simulators belong to the process, a copy starts without any
+        state = dict(self.__dict__)
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def n_parameters(self):
+        return len(self.names)
+
+    def n_experiments(self):
+        return len(self.models)
+
+    def dimensionalise(self, parameters):
+        """ converts a shared vector, or an (n_samples x n_parameters) array,
+        to dimensional values
+        """
+        return self.transform.dimensionalise(parameters)
+
+    def non_dimensionalise(self, parameters):
+        """ inverse of :meth:`dimensionalise` """
+        return self.transform.non_dimensionalise(parameters)
+
+    def experiment_vectors(self, parameters):
+        """ the (non-dimensional) vector of each experiment's model for a
+        shared vector
+        """
+        parameters = np.asarray(parameters, dtype='double')
+        return [parameters * scale + offset
+                for scale, offset in zip(self._scale, self._offset)]
+
+    def _simulators(self):
+        # one compiled simulator per experiment and thread, rebuilt if the
+        # parameters of the models have changed since they were made
+        local = self._local
+        params = getattr(local, 'params', None)
+        if params is None or not all(
+                _same_params(a, model.params)
+                for a, model in zip(params, self.models)):
+            local.params = [dict(model.params) for model in self.models]
+            local.simulators = [
+                model.simulator(self.names, p)
+                for model, p in zip(self.models, local.params)]
+        return local.simulators
+
+    def simulate(self, parameters):
+        """ the (non-dimensional) current of each experiment at its data's
+        times, in the current units of that experiment
+        """
+        currents = [np.empty_like(times) for times in self.times]
+        electrochemistry.joint_simulate(
+            self._simulators(), self.experiment_vectors(parameters),
+            self.times, currents, self.n_threads)
+        return currents
+
+    def sums_of_squares(self, parameters, thresholds=np.inf):
+        """ the sum of squared differences between the simulated current and
+        the data of each experiment, in the current units of that experiment.
+        The simulation of experiment i is stopped once its partial sum exceeds
+        ``thresholds[i]`` (a scalar applies to all), and the partial sum
+        returned
+        """
+        thresholds = np.ascontiguousarray(
+            np.broadcast_to(thresholds, (len(self.models),)), dtype='double')
+        sums = np.empty(len(self.models))
+        electrochemistry.joint_sum_of_squares(
+            self._simulators(), self.experiment_vectors(parameters),
+            self.times, self.data, thresholds, sums, self.n_threads)
+        return sums
+
+    def sum_of_squares(self, parameters, threshold=np.inf, weights=None):
+        """ the sum over the experiments of ``weights`` (default
+        ``self.weights``) times their sums of squares. If the sum is certain
+        to exceed ``threshold`` the simulations are stopped early, and a
+        partial sum (which is > threshold) is returned
+        """
+        if weights is None:
+            weights = self.weights
+        weights = np.asarray(weights, dtype='double')
+        # the sum exceeds threshold once any one of its terms does
+        with np.errstate(divide='ignore'):
+            thresholds = threshold / weights
+        sums = self.sums_of_squares(parameters, thresholds)
+        return np.sum(weights * sums)
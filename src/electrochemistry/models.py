@@ -4,6 +4,49 @@ import electrochemistry
 import pints
 import numpy as np
 import copy
+import threading
+
+
+class ParameterTransform:
+
+    """Converts vectors of parameters between their non-dimensional and
+    dimensional values, using scale and offset arrays calculated once from a
+    model's characteristic values
+
+    Args:
+        model (ECModel or POMModel): model giving the characteristic values
+        names (list of str): names of the parameters in each vector
+        experiment (bool): if True, the dimensional values are those given
+            to the model's constructor, before the potentials of a reversed
+            scan are mirrored, rather than those in ``model.dim_params``
+    """
+
+    def __init__(self, model, names, experiment=False):
+        self.names = list(names)
+        self.scale = np.array([model._scale(name) for name in self.names])
+        self.offset = np.zeros(len(self.names))
+        if experiment:
+            for i, name in enumerate(self.names):
+                sign, self.offset[i] = model._mirror(name)
+                self.scale[i] *= sign
+
+    def dimensionalise(self, values):
+        """ converts non-dimensional values to dimensional ones
+
+        Args:
+            values (numpy array): a vector of len(names) values, or an
+                (n_samples x len(names)) array with one vector per row
+
+        returns:
+            values (numpy array): dimensional values, same shape as values
+        """
+        return np.asarray(values, dtype='double') * self.scale + self.offset
+
+    def non_dimensionalise(self, values):
+        """ converts dimensional values to non-dimensional ones, the inverse
+        of :meth:`dimensionalise`
+        """
+        return (np.asarray(values, dtype='double') - self.offset) / self.scale
 
 
 class ECModel:
@@ -19,6 +62,19 @@ class ECModel:
                  'E0',
                  'k0',
                  'alpha'
+
+    The solver settings are kept in ``self.params`` alongside the
+    non-dimensional parameters: 'Nx' (number of spatial mesh points) and 'Nt'
+    (number of time steps per period). Setting 'rtol' > 0 (and optionally
+    'atol', default 1e-6) switches to adaptive time stepping with these
+    tolerances instead of 'Nt' fixed steps; sensitivities are not available in
+    this mode. 'Xmax' (default 20) is the width of the spatial domain, or if
+    <= 0 it is chosen from the simulated times. Setting 'integral_tol' > 0
+    replaces the spatial mesh by the boundary integral form of the
+    (semi-infinite) diffusion, with its kernel approximated by a sum of
+    exponentials to this relative tolerance, so that 'Nx' and 'Xmax' are
+    unused; this needs fixed time steps, and sensitivities and chunked
+    simulation are not available.
     """
 
     def __init__(self, params):
@@ -77,6 +133,8 @@ class ECModel:
         self.params['Nt'] = 200
         self.params['startn'] = 0
 
+        self._transforms = {}
+
         self._nondim_params = {}
         self._nondim_params['Estart'] = self.params['Estart']
         self._nondim_params['Ereverse'] = self.params['Ereverse']
@@ -89,73 +147,241 @@ class ECModel:
         self._nondim_params['Ru'] = self.params['Ru']
         self._nondim_params['Cdl'] = self.params['Cdl']
 
+    def _scale(self, name):
+        # dimensional value = non-dimensional value * scale
+        scales = {
+            'Estart': self.E0,
+            'Ereverse': self.E0,
+            'omega': 1.0 / (2 * pi * self.T0),
+            'phase': 1.0,
+            'dE': self.E0,
+            'k0': self.dim_params['D'] / self.L0,
+            'alpha': 1.0,
+            'E0': self.E0,
+            'Ru': self.E0 / abs(self.I0),
+            'Cdl': abs(self.I0) * self.T0 / (self.dim_params['a'] * self.E0),
+            'I': self.I0,
+        }
+        return scales.get(name, np.nan)
+
+    def _mirror(self, name):
+        # the dimensional value given to the constructor is sign * value +
+        # offset, undoing the mirroring of E0 for a reversed scan
+        if self.dim_params['reversed'] and name == 'E0':
+            return -1.0, self.dim_params['Estart'] + self.dim_params['Ereverse']
+        return 1.0, 0.0
+
+    def __getstate__(self):
+        # pickles (without the constructor's output) to the parameters, the
+        # cached transforms are rebuilt on demand
+        state = dict(self.__dict__)
+        state['_transforms'] = {}
+        return state
+
+    def transform(self, names, experiment=False):
+        """ returns a (cached) :class:`ParameterTransform` for the parameters
+        in ``names``, see :class:`ParameterTransform` for ``experiment``
+        """
+        key = (tuple(names), experiment)
+        if key not in self._transforms:
+            self._transforms[key] = ParameterTransform(self, names,
+                                                       experiment)
+        return self._transforms[key]
+
     def dimensionalise(self, value, name):
-        if name == 'Estart':
-            return value * self.E0
-        elif name == 'Ereverse':
-            return value * self.E0
-        elif name == 'omega':
-            return value / (2 * pi * self.T0)
-        elif name == 'phase':
-            return value
-        elif name == 'dE':
-            return value * self.E0
-        elif name == 'k0':
-            return value * self.dim_params['D'] / self.L0
-        elif name == 'alpha':
-            return value
-        elif name == 'E0':
-            return value * self.E0
-        elif name == 'Ru':
-            return value * self.E0 / self.I0
-        elif name == 'Cdl':
-            return value * self.I0 * self.T0 / (self.dim_params['a'] * self.E0)
-        elif name == 'I':
-            return value * self.I0
-        else:
-            return NaN
+        return value * self._scale(name)
 
     def non_dimensionalise(self, value, name):
-        if name == 'Estart':
-            return value / self.E0
-        elif name == 'Ereverse':
-            return value / self.E0
-        elif name == 'omega':
-            return value * (2 * pi * self.T0)
-        elif name == 'phase':
-            return value
-        elif name == 'dE':
-            return value / self.E0
-        elif name == 'k0':
-            return value / self.dim_params['D'] * self.L0
-        elif name == 'alpha':
-            return value
-        elif name == 'E0':
-            return value / self.E0
-        elif name == 'Ru':
-            return value / self.E0 * self.I0
-        elif name == 'Cdl':
-            return value / self.I0 / self.T0 * (self.dim_params['a'] * self.E0)
-        elif name == 'I':
-            return value / self.I0
-        else:
-            return NaN
+        return value / self._scale(name)
 
     def suggest_times(self):
         final_time = self.params['Ereverse'] - self.params['Estart']
         return np.linspace(0, final_time, 1000, dtype='double')
 
-    def simulate(self, times):
+    def set_potential(self, potential, dt):
+        """ simulates with a measured applied potential, e.g. recorded by the
+        potentiostat, instead of the dc ramp and sine wave of 'Estart',
+        'Ereverse', 'dE', 'omega' and 'phase' (which are then unused, except
+        for 'omega' setting the time step)
+
+        The potential is interpolated linearly between the samples, and held
+        at the last one after it. The fixed-step solvers tabulate it once on
+        their time grid, and reuse the table for every simulation with the
+        same potential. The adaptive solvers (``rtol`` > 0) instead evaluate
+        it at each step, and have to take small steps across the kinks of the
+        interpolant, so are much slower than fixed steps with a measured
+        potential. Stored (non-dimensional) in ``self.params`` as 'Edata'
+        and 'dt_data'.
+
+        Args:
+            potential (numpy vector): (dimensional) applied potential, at
+                least two samples, or None to go back to the dc ramp and sine
+                wave
+            dt (float): (dimensional) time between the samples, the first
+                being at t = 0
+        """
+        if potential is None:
+            self.params.pop('Edata', None)
+            self.params.pop('dt_data', None)
+            return
+        potential = np.array(potential, dtype='double')
+        if potential.ndim != 1 or len(potential) < 2 or not dt > 0:
+            raise ValueError('potential must be a vector of at least two '
+                             'samples, dt apart with dt > 0')
+        if self.dim_params['reversed']:
+            # mirrored, as are Estart, Ereverse and E0
+            potential = (self.dim_params['Estart'] +
+                         self.dim_params['Ereverse'] - potential)
+        potential /= self.E0
+        potential.flags.writeable = False
+        self.params['Edata'] = potential
+        self.params['dt_data'] = dt / self.T0
+
+    def simulate(self, times, params=None, stats=False):
+        """ simulate the current at the given times
+
+        Args:
+            times (numpy vector): output times
+            params (dict): (non-dimensional) parameters to use instead of
+                ``self.params``, see :meth:`params_from_vector`
+            stats (bool): also return the solver stats
+
+        returns:
+            current (numpy vector): simulated current at each time
+            stats (dict): if ``stats``, counts of the accepted ('steps')
+                and rejected ('rejected_steps') time steps and Newton
+                iterations (total, max, and a histogram of iterations per
+                solve), the number of Newton solves that stopped at the edge
+                of their bracket or fell back to a bracketing method, and the
+                wall time of each phase in seconds
+        """
+        if params is None:
+            params = self.params
         times = np.asarray(times, dtype='double')
         current = np.empty_like(times)
-        electrochemistry.e_implicit_exponential_mesh(
-            self.params, current, times)
+        solver_stats = electrochemistry.e_implicit_exponential_mesh(
+            params, current, times, stats)
+        if stats:
+            return current, solver_stats
         return current
 
+    def simulate_chunks(self, times, chunk_size=10000, params=None,
+                        state=None):
+        """ simulate the current at the given times a chunk at a time, with
+        fixed time steps
+
+        A generator yielding the current at each ``chunk_size`` times in
+        turn, together with a snapshot of the solver state after them, a dict
+        of numbers and numpy arrays that can be pickled or saved with
+        ``np.savez``. Passing a snapshot as ``state`` resumes the simulation
+        from it, ``times`` then being the remaining output times.
+
+        Args:
+            times (numpy vector): increasing output times
+            chunk_size (int): number of times in each chunk
+            params (dict): (non-dimensional) parameters to use instead of
+                ``self.params``
+            state (dict): solver state to resume from
+
+        yields:
+            current (numpy vector): simulated current at each time in the
+                chunk
+            state (dict): solver state after the chunk
+        """
+        if params is None:
+            params = self.params
+        times = np.asarray(times, dtype='double')
+        simulator = electrochemistry.ECSimulator(params, [])
+        if state is None:
+            simulator.start(np.empty(0), times[-1])
+        else:
+            simulator.set_state(state)
+        for i in range(0, len(times), chunk_size):
+            chunk = times[i:i + chunk_size]
+            current = np.empty_like(chunk)
+            simulator.advance(chunk, current)
+            yield current, simulator.get_state()
+
+    def simulateS1(self, times, names, params=None):
+        """ simulate the current and its sensitivities to the parameters in
+        ``names`` (non-dimensional), in a single pass
+
+        returns:
+            current (numpy vector): simulated current at each time
+            dcurrent (numpy array): (len(times) x len(names)) array of the
+                derivatives of the current with respect to each parameter
+        """
+        if params is None:
+            params = self.params
+        times = np.asarray(times, dtype='double')
+        current = np.empty_like(times)
+        dcurrent = np.empty((len(times), len(names)))
+        electrochemistry.e_implicit_exponential_mesh_sensitivities(
+            params, list(names), current, dcurrent, times)
+        return current, dcurrent
+
+    def sum_of_squares(self, data, times, params=None, threshold=np.inf):
+        """ sum of squared differences between the simulated current and
+        ``data``, accumulated during the simulation without storing the
+        current. If the partial sum exceeds ``threshold`` the simulation is
+        stopped and the partial sum (which is > threshold) is returned
+        """
+        if params is None:
+            params = self.params
+        times = np.asarray(times, dtype='double')
+        data = np.asarray(data, dtype='double')
+        return electrochemistry.e_implicit_exponential_mesh_sum_of_squares(
+            params, data, times, threshold)
+
+    def simulate_batch(self, vectors, names, times, n_threads=0,
+                       params=None):
+        """ simulate many parameter sets in parallel
+
+        Args:
+            vectors (numpy array): (n_sets x len(names)) array of
+                (non-dimensional) parameter values, one set per row
+            names (list of str): names of the parameters in each row
+            times (numpy vector): output times, shared by all sets
+            n_threads (int): number of threads, default uses all cores
+            params (dict): (non-dimensional) parameters to use instead of
+                ``self.params`` for those not in ``names``
+
+        returns:
+            current (numpy array): (n_sets x len(times)) array of currents
+        """
+        if params is None:
+            params = self.params
+        times = np.asarray(times, dtype='double')
+        vectors = np.ascontiguousarray(vectors, dtype='double')
+        current = np.empty((vectors.shape[0], len(times)))
+        electrochemistry.e_implicit_exponential_mesh_batch(
+            params, list(names), vectors, current, times, n_threads)
+        return current
+
+    def simulator(self, names, params=None):
+        """ returns a compiled :class:`ECSimulator` for repeated simulation,
+        which keeps the mesh and work arrays between calls. Its ``simulate``
+        and ``sum_of_squares`` methods take a vector of (non-dimensional)
+        values for the parameters in ``names``, and use ``params`` (default
+        ``self.params``) for all the others
+        """
+        if params is None:
+            params = self.params
+        return electrochemistry.ECSimulator(params, list(names))
+
     def set_params_from_vector(self, vector, names):
-        for value, name in zip(vector, names):
+        dim_vector = self.transform(names).dimensionalise(vector)
+        for name, value, dim_value in zip(names, vector, dim_vector):
             self.params[name] = value
-            self.dim_params[name] = self.dimensionalise(value, name)
+            self.dim_params[name] = dim_value
+
+    def params_from_vector(self, vector, names):
+        """ returns a copy of ``self.params`` with the given (non-dimensional)
+        values substituted, leaving the model itself unchanged
+        """
+        params = dict(self.params)
+        params.update(zip(names, vector))
+        return params
 
     def get_params_from_vector(self, names):
         vector = np.zeros(len(names))
@@ -191,6 +417,21 @@ class ECModel:
 
 class POMModel:
 
+    """Represents a surface-confined polyoxometalate with up to 6 sequential
+    electron-transfer couples, couple i having the parameters 'E{i}1',
+    'E{i}2', 'k{i}1', 'k{i}2', and 'alpha1', 'alpha2' (i = 0) or 'alpha{i}1',
+    'alpha{i}2'. The number of couples is given by the keys present
+
+    The solver setting 'Nt' (number of time steps per period) is kept in
+    ``self.params``. Setting 'rtol' > 0 (and optionally 'atol', default 1e-6)
+    switches to an adaptive, L-stable second order integrator with these
+    tolerances instead of 'Nt' fixed backward Euler steps; sensitivities are
+    not available in this mode.
+
+    Args:
+        params (dict): dictionary of (dimensional) parameters
+    """
+
     def __init__(self, params):
         try:
             print('creating POMModel with (dimensional) parameters:')
@@ -204,18 +445,11 @@ class POMModel:
             print('\telectrode area: ', params['a'])
             print('\tRu: ', params['Ru'])
             print('\tCdl: ', params['Cdl'])
-            print('\tE01: ', params['E01'])
-            print('\tE02: ', params['E02'])
-            print('\tE11: ', params['E11'])
-            print('\tE12: ', params['E12'])
-            print('\tE21: ', params['E21'])
-            print('\tE22: ', params['E22'])
-            print('\tk01: ', params['k01'])
-            print('\tk02: ', params['k02'])
-            print('\tk11: ', params['k11'])
-            print('\tk12: ', params['k12'])
-            print('\tk21: ', params['k21'])
-            print('\tk22: ', params['k22'])
+            for i in range(POMModel.couples(params)):
+                for name in ['E', 'k']:
+                    for j in [1, 2]:
+                        key = '%s%d%d' % (name, i, j)
+                        print('\t%s: ' % key, params[key])
             print('\tGamma: ', params['Gamma'])
         except NameError as e:
             print('NameError: ', e.value)
@@ -232,25 +466,15 @@ class POMModel:
         self.params['phase'] = self.dim_params['phase']
         self.params['dE'] = self.dim_params['dE'] / self.E0
 
-        self.params['k01'] = self.dim_params['k01'] * self.T0
-        self.params['k02'] = self.dim_params['k02'] * self.T0
-        self.params['k11'] = self.dim_params['k11'] * self.T0
-        self.params['k12'] = self.dim_params['k12'] * self.T0
-        self.params['k21'] = self.dim_params['k21'] * self.T0
-        self.params['k22'] = self.dim_params['k22'] * self.T0
-        self.params['E01'] = self.dim_params['E01'] / self.E0
-        self.params['E02'] = self.dim_params['E02'] / self.E0
-        self.params['E11'] = self.dim_params['E11'] / self.E0
-        self.params['E12'] = self.dim_params['E12'] / self.E0
-        self.params['E21'] = self.dim_params['E21'] / self.E0
-        self.params['E22'] = self.dim_params['E22'] / self.E0
-
-        self.params['alpha1'] = self.dim_params['alpha1']
-        self.params['alpha2'] = self.dim_params['alpha2']
-        self.params['alpha11'] = self.dim_params['alpha11']
-        self.params['alpha12'] = self.dim_params['alpha12']
-        self.params['alpha21'] = self.dim_params['alpha21']
-        self.params['alpha22'] = self.dim_params['alpha22']
+        self.params['N'] = self.couples(self.dim_params)
+        for i in range(self.params['N']):
+            for j in [1, 2]:
+                k = 'k%d%d' % (i, j)
+                E = 'E%d%d' % (i, j)
+                alpha = 'alpha%d' % j if i == 0 else 'alpha%d%d' % (i, j)
+                self.params[k] = self.dim_params[k] * self.T0
+                self.params[E] = self.dim_params[E] / self.E0
+                self.params[alpha] = self.dim_params[alpha]
 
         self.params['Ru'] = self.dim_params['Ru'] * abs(self.I0) / self.E0
         self.params['Cdl'] = self.dim_params['Cdl'] * \
@@ -262,69 +486,236 @@ class POMModel:
 
         self.params['gamma'] = 1.0
 
-    def dimensionalise(self, value, name):
+        self._transforms = {}
+
+    @staticmethod
+    def couples(params):
+        """ number of sequential electron-transfer couples (at most 6) given
+        in ``params``, from the keys 'k01', 'k11', 'k21', ...
+        """
+        n = 0
+        while 'k%d1' % n in params:
+            n += 1
+        return n
+
+    def _scale(self, name):
+        # dimensional value = non-dimensional value * scale
         if name[0:1] == 'E':
-            return value * self.E0
+            return self.E0
         elif name[0:1] == 'k':
-            return value / self.T0
+            return 1.0 / self.T0
         elif name == 'omega':
-            return value / (2 * pi * self.T0)
-        elif name == 'phase':
-            return value
+            return 1.0 / (2 * pi * self.T0)
         elif name == 'dE':
-            return value * self.E0
+            return self.E0
         elif name == 'Ru':
-            return value * self.E0 / self.I0
+            return self.E0 / abs(self.I0)
         elif name == 'Cdl':
-            return value * self.I0 * self.T0 / (self.dim_params['a'] * self.E0)
-        elif name == 'gamma':
-            return value
+            return abs(self.I0) * self.T0 / (self.dim_params['a'] * self.E0)
         elif name == 'I':
-            return value * self.I0
-        elif name[:5] == 'alpha':
-            return value
+            return self.I0
+        elif name in ('phase', 'gamma') or name[:5] == 'alpha':
+            return 1.0
         else:
-            return NaN
+            return np.nan
+
+    def _mirror(self, name):
+        # the potentials of a POMModel are never mirrored
+        return 1.0, 0.0
+
+    def __getstate__(self):
+        # pickles (without the constructor's output) to the parameters, the
+        # cached transforms are rebuilt on demand
+        state = dict(self.__dict__)
+        state['_transforms'] = {}
+        return state
+
+    def transform(self, names, experiment=False):
+        """ returns a (cached) :class:`ParameterTransform` for the parameters
+        in ``names``, see :class:`ParameterTransform` for ``experiment``
+        """
+        key = (tuple(names), experiment)
+        if key not in self._transforms:
+            self._transforms[key] = ParameterTransform(self, names,
+                                                       experiment)
+        return self._transforms[key]
+
+    def dimensionalise(self, value, name):
+        return value * self._scale(name)
 
     def non_dimensionalise(self, value, name):
-        if name[0:1] == 'E':
-            return value / self.E0
-        elif name[0:1] == 'k':
-            return value * self.T0
-        elif name == 'omega':
-            return value * (2 * pi * self.T0)
-        elif name == 'phase':
-            return value
-        elif name == 'dE':
-            return value / self.E0
-        elif name == 'Ru':
-            return value / self.E0 * self.I0
-        elif name == 'Cdl':
-            return value / self.I0 / self.T0 * (self.dim_params['a'] * self.E0)
-        elif name == 'gamma':
-            return value
-        elif name == 'I':
-            return value / self.I0
-        elif name[:5] == 'alpha':
-            return value
-        else:
-            return NaN
+        return value / self._scale(name)
 
     def suggest_times(self):
         final_time = self.params['Ereverse'] - self.params['Estart']
         return np.linspace(0, final_time, 1000, dtype='double')
 
-    def simulate(self, times):
+    def set_potential(self, potential, dt):
+        """ simulates with a measured applied potential, e.g. recorded by the
+        potentiostat, instead of the dc ramp and sine wave of 'Estart',
+        'Ereverse', 'dE', 'omega' and 'phase' (which are then unused, except
+        for 'omega' setting the time step)
+
+        The potential is interpolated linearly between the samples, and held
+        at the last one after it. The fixed-step solvers tabulate it once on
+        their time grid, and reuse the table for every simulation with the
+        same potential. The adaptive solvers (``rtol`` > 0) instead evaluate
+        it at each step, and have to take small steps across the kinks of the
+        interpolant, so are much slower than fixed steps with a measured
+        potential. Stored (non-dimensional) in ``self.params`` as 'Edata'
+        and 'dt_data'.
+
+        Args:
+            potential (numpy vector): (dimensional) applied potential, at
+                least two samples, or None to go back to the dc ramp and sine
+                wave
+            dt (float): (dimensional) time between the samples, the first
+                being at t = 0
+        """
+        if potential is None:
+            self.params.pop('Edata', None)
+            self.params.pop('dt_data', None)
+            return
+        potential = np.array(potential, dtype='double')
+        if potential.ndim != 1 or len(potential) < 2 or not dt > 0:
+            raise ValueError('potential must be a vector of at least two '
+                             'samples, dt apart with dt > 0')
+        potential /= self.E0
+        potential.flags.writeable = False
+        self.params['Edata'] = potential
+        self.params['dt_data'] = dt / self.T0
+
+    def simulate(self, times, params=None, stats=False):
+        """ simulate the current at the given times
+
+        Args:
+            times (numpy vector): output times
+            params (dict): (non-dimensional) parameters to use instead of
+                ``self.params``, see :meth:`params_from_vector`
+            stats (bool): also return the solver stats
+
+        returns:
+            current (numpy vector): simulated current at each time
+            stats (dict): if ``stats``, counts of the accepted ('steps')
+                and rejected ('rejected_steps') time steps and Newton
+                iterations (total, max, and a histogram of iterations per
+                solve), the number of Newton solves that stopped at the edge
+                of their bracket or fell back to a bracketing method, and the
+                wall time of each phase in seconds
+        """
+        if params is None:
+            params = self.params
+        times = np.asarray(times, dtype='double')
+        current = np.empty_like(times)
+        solver_stats = electrochemistry.seq_electron_transfer3_explicit(
+            params, current, times, stats)
+        if stats:
+            return current, solver_stats
+        return current
+
+    def simulate_chunks(self, times, chunk_size=10000, params=None,
+                        state=None):
+        """ simulate the current at the given times a chunk at a time, with
+        fixed time steps
+
+        A generator yielding the current at each ``chunk_size`` times in
+        turn, together with a snapshot of the solver state after them, a dict
+        of numbers and numpy arrays that can be pickled or saved with
+        ``np.savez``. Passing a snapshot as ``state`` resumes the simulation
+        from it, ``times`` then being the remaining output times.
+
+        Args:
+            times (numpy vector): increasing output times
+            chunk_size (int): number of times in each chunk
+            params (dict): (non-dimensional) parameters to use instead of
+                ``self.params``
+            state (dict): solver state to resume from
+
+        yields:
+            current (numpy vector): simulated current at each time in the
+                chunk
+            state (dict): solver state after the chunk
+        """
+        if params is None:
+            params = self.params
+        times = np.asarray(times, dtype='double')
+        simulator = electrochemistry.POMSimulator(params, [])
+        if state is None:
+            simulator.start(np.empty(0))
+        else:
+            simulator.set_state(state)
+        for i in range(0, len(times), chunk_size):
+            chunk = times[i:i + chunk_size]
+            current = np.empty_like(chunk)
+            simulator.advance(chunk, current)
+            yield current, simulator.get_state()
+
+    def simulateS1(self, times, names, params=None):
+        """ simulate the current and its sensitivities to the parameters in
+        ``names`` (non-dimensional), in a single pass
+
+        returns:
+            current (numpy vector): simulated current at each time
+            dcurrent (numpy array): (len(times) x len(names)) array of the
+                derivatives of the current with respect to each parameter
+        """
+        if params is None:
+            params = self.params
         times = np.asarray(times, dtype='double')
         current = np.empty_like(times)
-        electrochemistry.seq_electron_transfer3_explicit(
-            self.params, current, times)
+        dcurrent = np.empty((len(times), len(names)))
+        electrochemistry.seq_electron_transfer3_explicit_sensitivities(
+            params, list(names), current, dcurrent, times)
+        return current, dcurrent
+
+    def sum_of_squares(self, data, times, params=None, threshold=np.inf):
+        """ sum of squared differences between the simulated current and
+        ``data``, accumulated during the simulation without storing the
+        current. If the partial sum exceeds ``threshold`` the simulation is
+        stopped and the partial sum (which is > threshold) is returned
+        """
+        if params is None:
+            params = self.params
+        times = np.asarray(times, dtype='double')
+        data = np.asarray(data, dtype='double')
+        return electrochemistry.seq_electron_transfer3_explicit_sum_of_squares(
+            params, data, times, threshold)
+
+    def simulate_batch(self, vectors, names, times, n_threads=0,
+                       params=None):
+        """ simulate many parameter sets in parallel, see
+        :meth:`ECModel.simulate_batch`
+        """
+        if params is None:
+            params = self.params
+        times = np.asarray(times, dtype='double')
+        vectors = np.ascontiguousarray(vectors, dtype='double')
+        current = np.empty((vectors.shape[0], len(times)))
+        electrochemistry.seq_electron_transfer3_explicit_batch(
+            params, list(names), vectors, current, times, n_threads)
         return current
 
+    def simulator(self, names, params=None):
+        """ returns a compiled :class:`POMSimulator` for repeated simulation,
+        see :meth:`ECModel.simulator`
+        """
+        if params is None:
+            params = self.params
+        return electrochemistry.POMSimulator(params, list(names))
+
     def set_params_from_vector(self, vector, names):
-        for value, name in zip(vector, names):
+        dim_vector = self.transform(names).dimensionalise(vector)
+        for name, value, dim_value in zip(names, vector, dim_vector):
             self.params[name] = value
-            self.dim_params[name] = self.dimensionalise(value, name)
+            self.dim_params[name] = dim_value
+
+    def params_from_vector(self, vector, names):
+        """ returns a copy of ``self.params`` with the given (non-dimensional)
+        values substituted, leaving the model itself unchanged
+        """
+        params = dict(self.params)
+        params.update(zip(names, vector))
+        return params
 
     def get_params_from_vector(self, names):
         vector = np.zeros(len(names))
@@ -353,11 +744,105 @@ class POMModel:
         return E_0, T_0, L_0, I_0
 
 
-class PintsModelAdaptor(pints.ForwardModel):
+def merge_stats(a, b):
+    """ combines two sets of solver stats (see :meth:`ECModel.simulate`),
+    e.g. from different simulators, into one
+    """
+    merged = {}
+    for key, value in a.items():
+        if key == 'max_newton_iterations':
+            merged[key] = max(value, b[key])
+        elif key == 'newton_histogram':
+            n = max(len(value), len(b[key]))
+            merged[key] = [
+                (value[i] if i < len(value) else 0) +
+                (b[key][i] if i < len(b[key]) else 0) for i in range(n)]
+        elif key == 'seconds':
+            merged[key] = dict(value)
+            for phase, seconds in b[key].items():
+                merged[key][phase] = merged[key].get(phase, 0) + seconds
+        else:
+            merged[key] = value + b[key]
+    return merged
+
+
+def _same_params(a, b):
+    # a == b for dicts of model parameters, which may hold numpy arrays
+    if a is None or b is None or a.keys() != b.keys():
+        return a is b
+    return all(np.array_equal(a[name], b[name])
+               if isinstance(a[name], np.ndarray) or
+               isinstance(b[name], np.ndarray) else a[name] == b[name]
+               for name in a)
+
+
+class PintsModelAdaptor(pints.ForwardModelS1):
+
+    """Wraps an :class:`ECModel` or :class:`POMModel` as a pints forward
+    model of the (non-dimensional) parameters in ``names``
+
+    Args:
+        ec_model (ECModel or POMModel): model to simulate
+        names (list of str): names of the fitted parameters
+        record_stats (bool): record solver stats, see :meth:`stats`
+        cache (SimulationCache): optional cache of the currents returned by
+            :meth:`simulate`, also used by :meth:`sum_of_squares` when it
+            holds the current
+        fidelity (MultilevelFidelity): optional mesh levels to simulate at,
+            starting from the coarsest. The level is only changed by
+            :meth:`set_level` or :meth:`update_level`, called by the
+            controller between iterations (see :meth:`level_callback`), so
+            that every evaluation of an iteration, in whichever process,
+            uses the same level
+        tolerance (float): relative discretisation error of the finest level
+            used, and the smallest relative improvement that counts as
+            progress at a level
+        patience (int): number of iterations without progress before
+            :meth:`update_level` moves to the next level
+    """
 
-    def __init__(self, ec_model, names):
+    def __init__(self, ec_model, names, record_stats=False, cache=None,
+                 fidelity=None, tolerance=1e-2, patience=10):
         self.ec_model = ec_model
         self.names = names
+        self.transform = ec_model.transform(names)
+        self.cache = cache
+        self._local = threading.local()
+
+        # the current fidelity level and the finest one to be used, the best
+        # sum of squares at the current level, and the number of iterations
+        # since it last improved
+        self.fidelity = fidelity
+        self.tolerance = tolerance
+        self.patience = patience
+        self.level = None if fidelity is None else 0
+        self.max_level = None
+        self._best = np.inf
+        self._stalled = 0
+        self._level_lock = threading.Lock()
+
+        # solver stats of the simulators in use, and those they replaced
+        self.record_stats = record_stats
+        self._simulators = []
+        self._retired_stats = None
+        self._stats_lock = threading.Lock()
+
+    def __getstate__(self):
+        # the simulators and stats belong to the process, a copy (e.g. in a
+        # worker process) starts without any
+        state = dict(self.__dict__)
+        for name in ['_local', '_simulators', '_retired_stats',
+                     '_stats_lock', '_level_lock']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._level_lock = threading.Lock()
+        self._simulators = []
+        self._retired_stats = None
+        self._stats_lock = threading.Lock()
 
     def n_parameters(self):
         return len(self.names)
@@ -365,6 +850,168 @@ class PintsModelAdaptor(pints.ForwardModel):
     def n_outputs(self):
         return 1
 
+    def dimensionalise(self, parameters):
+        """ converts a vector, or an (n_samples x n_parameters) array, of
+        (non-dimensional) parameters to dimensional values
+        """
+        return self.transform.dimensionalise(parameters)
+
+    def non_dimensionalise(self, parameters):
+        """ inverse of :meth:`dimensionalise` """
+        return self.transform.non_dimensionalise(parameters)
+
+    def _params(self):
+        # the parameters of self.ec_model, with the solver settings of the
+        # current fidelity level
+        if self.fidelity is None:
+            return self.ec_model.params
+        return self.fidelity.params(self.level, self.ec_model.params)
+
+    def set_level(self, level):
+        """ simulates at the given fidelity level from now on, restarting the
+        count of iterations without progress
+        """
+        with self._level_lock:
+            self.level = level
+            self._best = np.inf
+            self._stalled = 0
+
+    def update_level(self, times, value):
+        """ records the best sum of squares of an iteration, and moves to the
+        next fidelity level once it has not improved by a relative
+        ``tolerance`` in ``patience`` iterations, up to the level selected for
+        ``tolerance`` (see :meth:`MultilevelFidelity.select`) on the first
+        call
+
+        Call this in the controlling process, between iterations. Copies of
+        the adaptor in worker processes keep the level they were made with,
+        so a :class:`ProcessPoolEvaluator` must be restarted (see
+        :meth:`ProcessPoolEvaluator.restart`) when this returns True, while
+        ``pints.ParallelEvaluator`` makes new copies every iteration.
+
+        returns:
+            changed (bool): whether the level changed
+        """
+        if self.fidelity is None:
+            return False
+        if self.max_level is None:
+            self.max_level = self.fidelity.select(
+                times, self.tolerance, self.ec_model.params)
+        with self._level_lock:
+            if value < self._best * (1 - self.tolerance):
+                self._best = value
+                self._stalled = 0
+            else:
+                self._stalled += 1
+            if self._stalled < self.patience or self.level >= self.max_level:
+                return False
+            self.level += 1
+            self._best = np.inf
+            self._stalled = 0
+            return True
+
+    def level_callback(self, times):
+        """ a callback for ``pints.OptimisationController.set_callback``,
+        calling :meth:`update_level` with the optimiser's best value after
+        each iteration
+        """
+        def callback(iteration, optimiser):
+            self.update_level(times, optimiser.f_best())
+        return callback
+
+    def _simulator(self):
+        # one compiled simulator per thread, rebuilt if the parameters of
+        # self.ec_model (or the fidelity level) have changed since it was
+        # made
+        local = self._local
+        model_params = self._params()
+        if not _same_params(getattr(local, 'params', None), model_params):
+            params = dict(model_params)
+            simulator = self.ec_model.simulator(self.names, params)
+            if self.record_stats:
+                simulator.enable_stats()
+                with self._stats_lock:
+                    old = getattr(local, 'simulator', None)
+                    if old is not None:
+                        self._retire(old)
+                    self._simulators.append(simulator)
+            local.params = params
+            local.simulator = simulator
+        return local.simulator
+
+    def _retire(self, simulator):
+        # keeps the stats of a simulator that is no longer used
+        self._simulators.remove(simulator)
+        stats = simulator.get_stats()
+        if self._retired_stats is None:
+            self._retired_stats = stats
+        else:
+            self._retired_stats = merge_stats(self._retired_stats, stats)
+
+    def stats(self):
+        """ solver stats (see :meth:`ECModel.simulate`) summed over all the
+        calls to :meth:`simulate` and :meth:`sum_of_squares` since
+        construction or :meth:`reset_stats`, if created with
+        ``record_stats=True``. Also lists the parameters of (up to 100 per
+        thread) failed simulations under 'failures'
+        """
+        with self._stats_lock:
+            stats = self._retired_stats
+            for simulator in self._simulators:
+                if stats is None:
+                    stats = simulator.get_stats()
+                else:
+                    stats = merge_stats(stats, simulator.get_stats())
+        return stats
+
+    def reset_stats(self):
+        """ clears the stats returned by :meth:`stats` """
+        with self._stats_lock:
+            self._retired_stats = None
+            for simulator in self._simulators:
+                simulator.reset_stats()
+
+    def _cache_key(self, parameters, times):
+        if self.cache is None:
+            return None
+        return self.cache.key(parameters, self._params(), times, self.names,
+                              type(self.ec_model).__name__)
+
     def simulate(self, parameters, times):
-        self.ec_model.set_params_from_vector(parameters, self.names)
-        return self.ec_model.simulate(times)
+        # doesn't modify self.ec_model, so can be called from many threads
+        parameters = np.asarray(parameters, dtype='double')
+        times = np.asarray(times, dtype='double')
+        key = self._cache_key(parameters, times)
+        if key is not None:
+            current = self.cache.get(key)
+            if current is not None:
+                return current
+        current = np.empty_like(times)
+        self._simulator().simulate(parameters, times, current)
+        if key is not None:
+            self.cache.put(key, current)
+        return current
+
+    def simulateS1(self, parameters, times):
+        params = dict(self._params())
+        params.update(zip(self.names, parameters))
+        return self.ec_model.simulateS1(times, self.names, params)
+
+    def sum_of_squares(self, parameters, times, data, threshold=np.inf):
+        parameters = np.asarray(parameters, dtype='double')
+        times = np.asarray(times, dtype='double')
+        data = np.asarray(data, dtype='double')
+        key = self._cache_key(parameters, times)
+        if key is not None:
+            current = self.cache.get(key)
+            if current is not None:
+                return np.sum((current - data)**2)
+        return self._simulator().sum_of_squares(parameters, times, data,
+                                                threshold)
+
+    def simulate_batch(self, parameters, times, n_threads=0):
+        """ simulate each row of the 2d array ``parameters``, returning one
+        row of current per parameter set
+        """
+        return self.ec_model.simulate_batch(
+            parameters, self.names, times, n_threads, self._params())
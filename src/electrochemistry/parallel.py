@@ -0,0 +1,150 @@
+from __future__ import print_function
+import io
+import multiprocessing
+import pickle
+
+import numpy as np
+import pints
+
+# the function evaluated by this worker process, and its extra arguments
+_worker_function = None
+_worker_args = ()
+
+# shared memory blocks mapped by this worker process, kept open for as long
+# as the arrays viewing them are in use
+_worker_blocks = {}
+
+
+class _SharingPickler(pickle.Pickler):
+
+    # pickles numpy arrays of at least min_bytes as references to copies of
+    # them in shared memory, each array once
+    def __init__(self, file, blocks, min_bytes):
+        super(_SharingPickler, self).__init__(
+            file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.blocks = blocks
+        self.min_bytes = min_bytes
+        self.shared = {}
+
+    def persistent_id(self, obj):
+        if (not isinstance(obj, np.ndarray) or obj.dtype.hasobject or
+                obj.nbytes < max(self.min_bytes, 1)):
+            return None
+        key = id(obj)
+        if key not in self.shared:
+            from multiprocessing import shared_memory
+            block = shared_memory.SharedMemory(create=True, size=obj.nbytes)
+            view = np.ndarray(obj.shape, obj.dtype, buffer=block.buf)
+            view[...] = obj
+            self.blocks.append(block)
+            # also keeps obj alive, so that its id is not reused
+            self.shared[key] = (obj, (block.name, obj.shape, obj.dtype.str))
+        return self.shared[key][1]
+
+
+class _SharingUnpickler(pickle.Unpickler):
+
+    # maps the arrays pickled by _SharingPickler, read-only and without
+    # copying them
+    def persistent_load(self, pid):
+        name, shape, dtype = pid
+        if name not in _worker_blocks:
+            from multiprocessing import shared_memory
+            _worker_blocks[name] = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, np.dtype(dtype),
+                           buffer=_worker_blocks[name].buf)
+        array.flags.writeable = False
+        return array
+
+
+def _init_worker(payload):
+    global _worker_function, _worker_args
+    _worker_function, _worker_args = _SharingUnpickler(
+        io.BytesIO(payload)).load()
+
+
+def _evaluate_worker(x):
+    return _worker_function(x, *_worker_args)
+
+
+class ProcessPoolEvaluator(pints.Evaluator):
+
+    """Evaluates a function (e.g. an error measure or log-likelihood of a
+    problem wrapping a :class:`PintsModelAdaptor`) in a pool of worker
+    processes, which are started on the first call to :meth:`evaluate` and
+    kept until :meth:`close`, so they stay warm between the generations of an
+    optimiser or sampler
+
+    The function is pickled once, with every numpy array of at least
+    ``min_shared_bytes`` (the times and data, harmonic transforms, ...)
+    copied once into shared memory and mapped read-only by the workers, so
+    that only the positions and results are sent for each evaluation. Use as
+    a context manager, or call :meth:`close`, to stop the workers and free
+    the shared memory. Needs Python 3.8 or later.
+
+    Args:
+        function (callable): function ``f(x, *args)`` to evaluate
+        n_workers (int): number of worker processes, default one per core
+        args (sequence): extra arguments to the function
+        min_shared_bytes (int): size of the smallest array that is shared
+    """
+
+    def __init__(self, function, n_workers=None, args=None,
+                 min_shared_bytes=2**16):
+        self._pool = None
+        self._blocks = []
+        try:
+            from multiprocessing import shared_memory  # noqa
+        except ImportError:
+            raise ImportError('ProcessPoolEvaluator needs Python 3.8 or '
+                              'later (multiprocessing.shared_memory)')
+        super(ProcessPoolEvaluator, self).__init__(function, args)
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.n_workers = n_workers
+        self.min_shared_bytes = min_shared_bytes
+
+    def _start(self):
+        stream = io.BytesIO()
+        _SharingPickler(stream, self._blocks, self.min_shared_bytes).dump(
+            (self._function, tuple(self._args)))
+        self._pool = multiprocessing.Pool(
+            self.n_workers, initializer=_init_worker,
+            initargs=(stream.getvalue(),))
+
+    def _evaluate(self, positions):
+        if self._pool is None:
+            self._start()
+        chunksize = max(1, len(positions) // (4 * self.n_workers))
+        return self._pool.map(_evaluate_worker, positions, chunksize)
+
+    def shared_bytes(self):
+        """ total size of the arrays in shared memory """
+        return sum(block.size for block in self._blocks)
+
+    def restart(self):
+        """ stops the workers, so that the next call to :meth:`evaluate`
+        starts new ones with a fresh copy of the function, e.g. after the
+        fidelity level of the :class:`PintsModelAdaptor` it wraps changed
+        """
+        self.close()
+
+    def close(self):
+        """ stops the workers and frees the shared memory """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
@@ -1,6 +1,5 @@
 #include "seq_electron_transfer3_explicit.hpp"
 #include <math.h>
-#include <Eigen/Dense>
 #include <boost/math/constants/constants.hpp>
 #include <boost/math/tools/roots.hpp>
 #include <boost/math/tools/tuple.hpp>
@@ -8,11 +7,42 @@
 #include <iostream>
 
 namespace electrochemistry {
-template <unsigned int N>
-struct seq_elec_fun {
-    typedef Eigen::Matrix<double, 2 * N, 2 * N> matrix_type;
-    typedef Eigen::Matrix<double, 2 * N, 1> vector_type;
 
+// maximum number of species, two per couple plus the fully reduced species
+const int max_species = 2 * POMParams::max_N + 1;
+
+// solves T x = r for an n x n tridiagonal matrix T by the Thomas algorithm.
+// T is an M-matrix here (column diagonally dominant), so no pivoting is needed
+struct tridiagonal_solver {
+    int n;
+    // lower[i] = T(i, i-1), diag[i] = T(i, i), upper[i] = T(i, i+1)
+    double lower[max_species], diag[max_species], upper[max_species];
+
+    // factorisation
+    double pivot[max_species], upper_factor[max_species];
+
+    void factorise() {
+        pivot[0] = diag[0];
+        upper_factor[0] = upper[0] / pivot[0];
+        for (int i = 1; i < n; ++i) {
+            pivot[i] = diag[i] - lower[i] * upper_factor[i - 1];
+            upper_factor[i] = upper[i] / pivot[i];
+        }
+    }
+
+    // x = T^{-1} r, x and r may be the same array
+    void solve(const double *r, double *x) const {
+        x[0] = r[0] / pivot[0];
+        for (int i = 1; i < n; ++i) {
+            x[i] = (r[i] - lower[i] * x[i - 1]) / pivot[i];
+        }
+        for (int i = n - 2; i >= 0; --i) {
+            x[i] -= upper_factor[i] * x[i + 1];
+        }
+    }
+};
+
+struct seq_elec_fun {
     double Cdl, CdlE, CdlE2, CdlE3;
     const double *E01, *E02;
     double Ru;
@@ -20,16 +50,28 @@ struct seq_elec_fun {
     const double *alpha1, *alpha2;
     double dt;
     const double *gamma;
+    // number of couples, and of species (including the fully reduced one)
+    int N, Ns;
 
     double dedt;
-    vector_type u0, u1;
+    double u0[max_species], u1[max_species];
     double Cdlp;
 
+    // factorisation of (I-dt*A) and b from the last step, reused to step the
+    // sensitivities
+    tridiagonal_solver solver;
+    double b[max_species];
+
+    // POMParams indices of the parameters to calculate sensitivities for,
+    // and the sensitivities of u0 (Ns values per parameter)
+    std::vector<int> sens;
+    std::vector<double> su0;
+
     seq_elec_fun(const double Cdl, const double CdlE, const double CdlE2,
                  const double CdlE3, const double *E01, const double *E02,
                  const double Ru, const double *k01, const double *k02,
                  const double *alpha1, const double *alpha2, const double dt,
-                 const double *gamma
+                 const double *gamma, const int N
 
                  )
         : Cdl(Cdl),
@@ -44,13 +86,19 @@ struct seq_elec_fun {
           alpha1(alpha1),
           alpha2(alpha2),
           dt(dt),
-          gamma(gamma) {}
+          gamma(gamma),
+          N(N),
+          Ns(2 * N + 1) {
+        solver.n = Ns;
+    }
 
-    void init() {
+    void init(const std::vector<int> &sensitivities = {}) {
         u0[0] = 1.0;
-        for (int i = 1; i < 2 * N; i++) {
+        for (int i = 1; i < Ns; i++) {
             u0[i] = 0;
         }
+        sens = sensitivities;
+        su0.assign(Ns * sens.size(), 0);
     }
 
     double operator()(const double In0, const double E, const double dE) {
@@ -61,161 +109,494 @@ struct seq_elec_fun {
         return In1;
     }
 
-    void update_concentrations(const double In0, const double E,
-                               const double dE) {
-        const double Ereduced = E - Ru * In0;
-        const double Ereduced2 = pow(Ereduced, 2);
-        const double Ereduced3 = Ereduced * Ereduced2;
-
-        // dudt = A*u + c
-        // u1-u0 = dt*A*u1 + dt*c
-        // u1-dt*A*u1 = u0 + dt*c
-        // (I-dt*A)*u1 = u0 + dt*c
-        // B*u1 = d
-        //
-        // dedt = b'*u + c[-1]
-        matrix_type A = matrix_type::Zero();
-        vector_type b = vector_type::Zero();
-        vector_type c = vector_type::Zero();
-        double exp2o_old = 0;
-        double exp2r_old = 0;
-        double k02_old = 0;
+    // dudt = A*u
+    // dedt = b'*u
+    //
+    // u holds the 2N+1 species of the chain of N couples, the last being the
+    // fully reduced species, so that A is tridiagonal (lower, diag, upper).
+    // Keeping it, rather than eliminating it using the conservation of total
+    // concentration, avoids a dense row in A and cancellation in dedt. T is
+    // double, or dual to differentiate the system with respect to a parameter
+    // or the current, and P (the parameter type) is double or T
+    template <typename T, typename P>
+    static void assemble(const int N, const T Ereduced, const P *E01,
+                         const P *E02, const P *k01, const P *k02,
+                         const P *alpha1, const P *alpha2, T *lower, T *diag,
+                         T *upper, T *b) {
+        using std::exp;
+        for (int j = 0; j <= 2 * N; ++j) {
+            b[j] = 0;
+        }
+        T exp2o_old = 0;
+        T exp2r_old = 0;
+        T k02_old = 0;
         for (int i = 0; i < N; i++) {
-            const double expval1 = Ereduced - E01[i];
-            const double expval2 = Ereduced - E02[i];
+            const T expval1 = Ereduced - E01[i];
+            const T expval2 = Ereduced - E02[i];
 
-            const double exp1o = std::exp((1.0 - alpha1[i]) * expval1);
-            const double exp1r = std::exp(-alpha1[i] * expval1);
-            const double exp2o = std::exp((1.0 - alpha2[i]) * expval2);
-            const double exp2r = std::exp(-alpha2[i] * expval2);
+            const T exp1o = exp((1.0 - alpha1[i]) * expval1);
+            const T exp1r = exp(-alpha1[i] * expval1);
+            const T exp2o = exp((1.0 - alpha2[i]) * expval2);
+            const T exp2r = exp(-alpha2[i] * expval2);
 
             if (i != 0) {
-                A(2 * i, 2 * i - 1) = k02_old * exp2r_old;
-                A(2 * i, 2 * i) = -k01[i] * exp1r - k02_old * exp2o_old;
-                b(2 * i) += -k01[i] * exp1r;
+                lower[2 * i] = k02_old * exp2r_old;
+                diag[2 * i] = -k01[i] * exp1r - k02_old * exp2o_old;
+                b[2 * i] += -k01[i] * exp1r;
             } else {
-                A(2 * i, 2 * i) = -k01[i] * exp1r;
-                b(2 * i) += -k01[i] * exp1r;
+                lower[2 * i] = 0;
+                diag[2 * i] = -k01[i] * exp1r;
+                b[2 * i] += -k01[i] * exp1r;
             }
             exp2o_old = exp2o;
             exp2r_old = exp2r;
             k02_old = k02[i];
-            A(2 * i, 2 * i + 1) = k01[i] * exp1o;
-            b(2 * i + 1) += k01[i] * exp1o;
-
-            A(2 * i + 1, 2 * i) = k01[i] * exp1r;
-            A(2 * i + 1, 2 * i + 1) = -k02[i] * exp2r - k01[i] * exp1o;
-            b(2 * i + 1) += -k02[i] * exp2r;
-            if (i != 2) {
-                A(2 * i + 1, 2 * i + 2) = k02[i] * exp2o;
-                b(2 * i + 2) += k02[i] * exp2o;
-            } else {
-                c(2 * i + 1) = k02[i] * exp2o;
-                for (int j = 0; j < 2 * N; ++j) {
-                    A(2 * i + 1, j) += -k02[i] * exp2o;
-                    b(j) += -k02[i] * exp2o;
-                }
-            }
+            upper[2 * i] = k01[i] * exp1o;
+            b[2 * i + 1] += k01[i] * exp1o;
+
+            lower[2 * i + 1] = k01[i] * exp1r;
+            diag[2 * i + 1] = -k02[i] * exp2r - k01[i] * exp1o;
+            b[2 * i + 1] += -k02[i] * exp2r;
+            upper[2 * i + 1] = k02[i] * exp2o;
+            b[2 * i + 2] += k02[i] * exp2o;
         }
-        // std::cout << "---------------"<<std::endl;
-        // std::cout << A << std::endl;
+        // fully reduced species
+        lower[2 * N] = k02_old * exp2r_old;
+        diag[2 * N] = -k02_old * exp2o_old;
+        upper[2 * N] = 0;
+    }
+
+    void update_concentrations(const double In0, const double E,
+                               const double dE) {
+        const double Ereduced = E - Ru * In0;
+        const double Ereduced2 = pow(Ereduced, 2);
+        const double Ereduced3 = Ereduced * Ereduced2;
+
+        // dudt = A*u
+        // u1-u0 = dt*A*u1
+        // (I-dt*A)*u1 = u0
+        //
+        // dedt = b'*u
+        double lower[max_species], diag[max_species], upper[max_species];
+        assemble(N, Ereduced, E01, E02, k01, k02, alpha1, alpha2, lower, diag,
+                 upper, b);
 
         // integrate concentrations and calculate dudut
-        u1 = (matrix_type::Identity() - dt * A)
-                 .colPivHouseholderQr()
-                 .solve(u0 + dt * c);
-        dedt = (b.transpose() * u1)(0) + c[5];
-        u0 = u1;
+        for (int i = 0; i < Ns; ++i) {
+            solver.lower[i] = -dt * lower[i];
+            solver.diag[i] = 1 - dt * diag[i];
+            solver.upper[i] = -dt * upper[i];
+        }
+        solver.factorise();
+        solver.solve(u0, u1);
+        dedt = 0;
+        for (int i = 0; i < Ns; ++i) {
+            dedt += b[i] * u1[i];
+            u0[i] = u1[i];
+        }
 
         Cdlp = Cdl *
                (1.0 + CdlE * Ereduced + CdlE2 * Ereduced2 + CdlE3 * Ereduced3);
     }
-};
 
-void seq_electron_transfer3_explicit(py::dict params,
-                                     py::array_t<double> Itot_numpy,
-                                     py::array_t<double> t_numpy) {
-    py::buffer_info Itot_info = Itot_numpy.request();
-    py::buffer_info t_info = t_numpy.request();
+    // given the current In0 and its sensitivities sIn0 at the start of the
+    // last step taken by operator(), step the sensitivities of the
+    // concentrations and return the sensitivities of the new current in sIn1
+    void update_sensitivities(const double In0, const double *sIn0,
+                              const double E, const double dE, double *sIn1) {
+        const int base = 6 * POMParams::max_N;
+        for (int j = 0; j < sens.size(); ++j) {
+            auto seed = [&](const double value, const int index) {
+                return dual(value, sens[j] == index ? 1 : 0);
+            };
+            dual sE01[POMParams::max_N], sE02[POMParams::max_N];
+            dual sk01[POMParams::max_N], sk02[POMParams::max_N];
+            dual salpha1[POMParams::max_N], salpha2[POMParams::max_N];
+            for (int i = 0; i < N; ++i) {
+                sk01[i] = seed(k01[i], 6 * i);
+                sk02[i] = seed(k02[i], 6 * i + 1);
+                sE01[i] = seed(E01[i], 6 * i + 2);
+                sE02[i] = seed(E02[i], 6 * i + 3);
+                salpha1[i] = seed(alpha1[i], 6 * i + 4);
+                salpha2[i] = seed(alpha2[i], 6 * i + 5);
+            }
+            const dual sgamma = seed(gamma[0], base);
+            const dual sRu = seed(Ru, base + 1);
+            const dual sCdl = seed(Cdl, base + 2);
+            const dual sCdlE = seed(CdlE, base + 3);
+            const dual sCdlE2 = seed(CdlE2, base + 4);
+            const dual sCdlE3 = seed(CdlE3, base + 5);
 
-    if ((Itot_info.ndim != 1) || (t_info.ndim != 1))
-        throw std::runtime_error("Number of dimensions must be one");
+            const dual sIn0j(In0, sIn0[j]);
+            const dual Ereduced = E - sRu * sIn0j;
+            dual lower[max_species], diag[max_species], upper[max_species];
+            dual b[max_species];
+            assemble(N, Ereduced, sE01, sE02, sk01, sk02, salpha1, salpha2,
+                     lower, diag, upper, b);
 
-    if (Itot_info.shape[0] != t_info.shape[0])
-        throw std::runtime_error("Input shapes must be equal");
+            // differentiate (I-dt*A)*u1 = u0
+            double *su0j = su0.data() + Ns * j;
+            for (int row = 0; row < Ns; ++row) {
+                double dAu1 = diag[row].deriv * u1[row];
+                if (row > 0) dAu1 += lower[row].deriv * u1[row - 1];
+                if (row < Ns - 1) dAu1 += upper[row].deriv * u1[row + 1];
+                su0j[row] += dt * dAu1;
+            }
+            solver.solve(su0j, su0j);
 
-    const size_t Ntime = Itot_info.shape[0];
-    auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
-    auto t = reinterpret_cast<double *>(t_info.ptr);
+            double sdedt = 0;
+            for (int row = 0; row < Ns; ++row) {
+                sdedt += b[row].deriv * u1[row] + b[row].value * su0j[row];
+            }
 
-    const size_t N = 3;
-    double k01[N], k02[N], alpha1[N], alpha2[N], E01[N], E02[N], gamma[N];
-
-    k01[0] = get(params, std::string("k01"), 35.0);
-    k02[0] = get(params, std::string("k02"), 65.0);
-    E01[0] = get(params, std::string("E01"), 0.25);
-    E02[0] = get(params, std::string("E02"), -0.25);
-    gamma[0] = get(params, std::string("gamma"), 1.0);
-    alpha1[0] = get(params, std::string("alpha1"), 0.5);
-    alpha2[0] = get(params, std::string("alpha2"), 0.5);
-    if (N > 1) {
-        k01[1] = get(params, std::string("k11"), 35.0);
-        k02[1] = get(params, std::string("k12"), 65.0);
-        alpha1[1] = get(params, std::string("alpha11"), 0.5);
-        alpha2[1] = get(params, std::string("alpha12"), 0.5);
-        E01[1] = get(params, std::string("E11"), 0.25);
-        E02[1] = get(params, std::string("E12"), -0.25);
-        gamma[1] = gamma[0];
-        if (N > 2) {
-            k01[2] = get(params, std::string("k21"), 35.0);
-            k02[2] = get(params, std::string("k22"), 65.0);
-            alpha1[2] = get(params, std::string("alpha21"), 0.5);
-            alpha2[2] = get(params, std::string("alpha22"), 0.5);
-            E01[2] = get(params, std::string("E21"), 0.25);
-            E02[2] = get(params, std::string("E22"), -0.25);
-            gamma[2] = gamma[0];
+            const dual Ereduced2 = Ereduced * Ereduced;
+            const dual Ereduced3 = Ereduced * Ereduced2;
+            const dual sCdlp = sCdl * (1.0 + sCdlE * Ereduced +
+                                       sCdlE2 * Ereduced2 + sCdlE3 * Ereduced3);
+            dual In1 = sCdlp * (dE + sRu * sIn0j / dt);
+            In1 += sgamma * dual(dedt, sdedt);
+            sIn1[j] = (In1 / (1.0 + sCdlp * sRu / dt)).deriv;
         }
     }
+};
+
+// residual of an implicit stage of the SDIRK integrator for the POM model, as
+// a function of the current I at the stage. At the stage, the concentrations
+// solve (I - h*A(E - Ru*I))*u = su, and the current solves
+// Ru*Cdlp*(I - sI) = h*(Cdlp*dE + gamma*dedt - I), where su and sI are the
+// explicit parts of the stage and h is the step size times the diagonal
+// coefficient. This is the stage form of du/dt = A*u and of
+// I = Cdlp*d(E - Ru*I)/dt + gamma*dedt, which remains valid for Ru = 0
+struct pom_stage {
+    pom_stage(const seq_elec_fun &fun, const double E, const double dE,
+              const double h, const double sI, const double *su, double *u)
+        : fun(fun), E(E), dE(dE), h(h), sI(sI), su(su), u(u) {
+        solver.n = fun.Ns;
+    }
 
-    const double Ru = get(params, std::string("Ru"), 0.001);
-    const double Cdl = get(params, std::string("Cdl"), 0.0037);
-    const double CdlE = get(params, std::string("CdlE"), 0.0);
-    const double CdlE2 = get(params, std::string("CdlE2"), 0.0);
-    const double CdlE3 = get(params, std::string("CdlE3"), 0.0);
-    const double Estart = get(params, std::string("Estart"), -10.0);
-    const double Ereverse = get(params, std::string("Ereverse"), 10.0);
-    const int Nt = get(params, std::string("Nt"), 600.0);
+    // returns the residual and its derivative, and leaves the
+    // concentrations at the stage in u
+    boost::math::tuple<double, double> operator()(const double I) {
+        const int Ns = fun.Ns;
+        const dual sI1(I, 1);
+        const dual Ereduced = E - fun.Ru * sI1;
+        dual lower[max_species], diag[max_species], upper[max_species];
+        dual b[max_species];
+        seq_elec_fun::assemble(fun.N, Ereduced, fun.E01, fun.E02, fun.k01,
+                               fun.k02, fun.alpha1, fun.alpha2, lower, diag,
+                               upper, b);
+        for (int i = 0; i < Ns; ++i) {
+            solver.lower[i] = -h * lower[i].value;
+            solver.diag[i] = 1 - h * diag[i].value;
+            solver.upper[i] = -h * upper[i].value;
+        }
+        solver.factorise();
+        solver.solve(su, u);
 
-    const double pi = boost::math::constants::pi<double>();
-    const double omega = get(params, std::string("omega"), 2 * pi);
-    const double phase = get(params, std::string("phase"), 0.0);
-    const double dE = get(params, std::string("dE"), 0.1);
-    const double reverse = 0;
+        // du/dI = (I - h*A)^{-1} * h*(dA/dI)*u
+        double du[max_species];
+        for (int row = 0; row < Ns; ++row) {
+            du[row] = diag[row].deriv * u[row];
+            if (row > 0) du[row] += lower[row].deriv * u[row - 1];
+            if (row < Ns - 1) du[row] += upper[row].deriv * u[row + 1];
+            du[row] *= h;
+        }
+        solver.solve(du, du);
+
+        dual dedt = 0;
+        for (int row = 0; row < Ns; ++row) {
+            dedt += dual(b[row].value * u[row],
+                         b[row].deriv * u[row] + b[row].value * du[row]);
+        }
+        const dual Cdlp =
+            fun.Cdl * (1.0 + fun.CdlE * Ereduced +
+                       fun.CdlE2 * Ereduced * Ereduced +
+                       fun.CdlE3 * Ereduced * Ereduced * Ereduced);
+        const dual residual = fun.Ru * Cdlp * (sI1 - sI) -
+                              h * (Cdlp * dE + fun.gamma[0] * dedt - sI1);
+        return boost::math::make_tuple(residual.value, residual.deriv);
+    }
+
+    const seq_elec_fun &fun;
+    const double E, dE, h, sI;
+    const double *su;
+    double *u;
+    tridiagonal_solver solver;
+};
+
+POMSimulator::POMSimulator(const POMParams &params,
+                           const std::vector<int> &indices)
+    : params(params), indices(indices), stats_enabled(false) {}
+
+POMSimulator::POMSimulator(py::dict params, py::list names)
+    : POMSimulator(POMParams(params), POMParams::indices(names)) {}
+
+void POMSimulator::set_values(const double *values) {
+    for (size_t j = 0; j < indices.size(); ++j) {
+        params[indices[j]] = values[j];
+    }
+}
+
+// as run, but integrating the concentrations and the current together with
+// the two stage, L-stable and stiffly accurate SDIRK method of order 2,
+// instead of Nt backward Euler steps per period. The step size is chosen to
+// keep the local error in the concentrations and the current below
+// atol + rtol * |value|, estimated by the difference with the first order
+// solution y0 + h*k1, and the current at the output times is given by cubic
+// Hermite interpolation
+template <typename Output>
+void POMSimulator::run_sdirk(const double *t, const size_t Ntime,
+                             Output &output) {
+    const int N = params.N;
+    double gamma[POMParams::max_N];
+    for (int i = 0; i < N; ++i) {
+        gamma[i] = params.gamma;
+    }
+    const double Cdl = params.Cdl;
+    const double CdlE = params.CdlE;
+    const double CdlE2 = params.CdlE2;
+    const double CdlE3 = params.CdlE3;
+    const double Ru = params.Ru;
+    const double omega = params.omega;
+    const double dE = params.dE;
+    const double rtol = params.rtol;
+    const double atol = params.atol;
 
     const int digits_accuracy = std::numeric_limits<double>::digits * 0.5;
-    const double max_iterations = N * 100;
+    const double max_iterations = 100;
+
+    const double pi = boost::math::constants::pi<double>();
+    const double period = 2 * pi / omega;
+    const double min_step = 1e-12 * period;
+    const double max_step = period / 8;
+    const double dt = period / params.Nt;
+    solver_stats *const st = stats_enabled ? &stats : nullptr;
+
+    // SDIRK coefficients, diagonal g and c = (g, 1), a21 = 1 - g
+    const double g = 1 - 1 / std::sqrt(2.0);
+
+    // the step size varies, so the potential is evaluated rather than
+    // tabulated
+    const Efun Eeq = applied_potential(params, params.phase, dt);
+
+    seq_elec_fun fun(Cdl, CdlE, CdlE2, CdlE3, params.E01, params.E02, Ru,
+                     params.k01, params.k02, params.alpha1, params.alpha2, dt,
+                     gamma, N);
+    fun.init();
+    const int Ns = fun.Ns;
+
+    // state at t1, and the current and its derivative at the previous step
+    double t1 = 0;
+    double *u = fun.u0;
+    const double E = Eeq(t1);
+    double Itot1 = Cdl * (1.0 + CdlE * E + CdlE2 * E * E + CdlE3 * E * E * E) *
+                   Eeq.ddt(t1);
+    if (Ru == 0) {
+        // the current is then an algebraic variable, start from the
+        // consistent value including the faradaic current
+        double lower[max_species], diag[max_species], upper[max_species];
+        double b[max_species];
+        seq_elec_fun::assemble(N, E, params.E01, params.E02, params.k01,
+                               params.k02, params.alpha1, params.alpha2,
+                               lower, diag, upper, b);
+        for (int i = 0; i < Ns; ++i) {
+            Itot1 += gamma[0] * b[i] * u[i];
+        }
+    }
+    double dItot1 = 0;
+    double t0 = t1 - 1, Itot0 = Itot1, dItot0 = 0;
+    const double Itot_bound = std::max(10 * Cdl * dE * omega, 1.0);
+    double step = 1e-3 * period;
+    bool first_step = true;
+
+    double s[max_species], u_stage1[max_species], u_stage2[max_species];
+    double k1[max_species], k2[max_species];
+
+    for (size_t n_out = 0; n_out < Ntime; n_out++) {
+        while (t1 < t[n_out]) {
+            const double h = step;
+            const double gh = g * h;
+
+            // first stage, at t1 + g*h
+            boost::uintmax_t max_it = max_iterations;
+            pom_stage stage1(fun, Eeq(t1 + gh), Eeq.ddt(t1 + gh), gh, Itot1,
+                             u, u_stage1);
+            double I_stage1;
+            {
+                phase_timer timer(st, "newton");
+                I_stage1 = boost::math::tools::newton_raphson_iterate(
+                    stage1, Itot1, Itot1 - Itot_bound, Itot1 + Itot_bound,
+                    digits_accuracy, max_it);
+            }
+            if (st) {
+                st->newton(max_it,
+                           std::abs(I_stage1 - Itot1) >= Itot_bound);
+            }
+            bool failed = max_it == max_iterations;
+            stage1(I_stage1);
+            for (int i = 0; i < Ns; ++i) {
+                k1[i] = (u_stage1[i] - u[i]) / gh;
+                s[i] = u[i] + (h - gh) * k1[i];
+            }
+            const double kI1 = (I_stage1 - Itot1) / gh;
+            const double sI = Itot1 + (h - gh) * kI1;
+
+            // second stage, at t1 + h, gives the solution
+            max_it = max_iterations;
+            pom_stage stage2(fun, Eeq(t1 + h), Eeq.ddt(t1 + h), gh, sI, s,
+                             u_stage2);
+            double I_stage2;
+            {
+                phase_timer timer(st, "newton");
+                I_stage2 = boost::math::tools::newton_raphson_iterate(
+                    stage2, I_stage1, I_stage1 - Itot_bound,
+                    I_stage1 + Itot_bound, digits_accuracy, max_it);
+            }
+            if (st) {
+                st->newton(max_it,
+                           std::abs(I_stage2 - I_stage1) >= Itot_bound);
+            }
+            failed = failed || max_it == max_iterations;
+            if (failed) {
+                if (st) st->rejected_steps++;
+                // retry with a smaller step
+                step = h / 4;
+                if (step < min_step)
+                    throw std::runtime_error(
+                        "non-linear solve for the SDIRK stages failed, max "
+                        "number of iterations reached");
+                continue;
+            }
+            stage2(I_stage2);
+            for (int i = 0; i < Ns; ++i) {
+                k2[i] = (u_stage2[i] - s[i]) / gh;
+            }
+            const double kI2 = (I_stage2 - sI) / gh;
+
+            // y1 - (y0 + h*k1) = g*h*(k2 - k1). For Ru = 0 the current is
+            // algebraic, jumping with dE/dt at Ereverse, and is left out
+            double error = 0;
+            if (Ru != 0) {
+                error = gh * std::abs(kI2 - kI1) /
+                        (atol + rtol * std::abs(I_stage2));
+            }
+            for (int i = 0; i < Ns; ++i) {
+                error = std::max(error, gh * std::abs(k2[i] - k1[i]) /
+                                            (atol + rtol * std::abs(
+                                                               u_stage2[i])));
+            }
+            double factor = error > 0 ? 0.9 / std::sqrt(error) : 2;
+            factor = std::min(std::max(factor, 0.2), 2.0);
+            if (error > 1) {
+                if (st) st->rejected_steps++;
+                step = h * factor;
+                if (step < min_step)
+                    throw std::runtime_error(
+                        "adaptive time step became too small");
+                continue;
+            }
+
+            // accept the step
+            if (st) st->steps++;
+            for (int i = 0; i < Ns; ++i) {
+                u[i] = u_stage2[i];
+            }
+            t0 = t1;
+            Itot0 = Itot1;
+            dItot0 = first_step ? kI1 : dItot1;
+            t1 += h;
+            Itot1 = I_stage2;
+            dItot1 = kI2;
+            first_step = false;
+            step = std::min(h * factor, max_step);
+        }
+
+        // cubic Hermite interpolation over the last step
+        const double h = t1 - t0;
+        const double x = (t[n_out] - t0) / h;
+        const double x2 = x * x;
+        const double x3 = x2 * x;
+        const double I = (2 * x3 - 3 * x2 + 1) * Itot0 +
+                         (x3 - 2 * x2 + x) * h * dItot0 +
+                         (-2 * x3 + 3 * x2) * Itot1 + (x3 - x2) * h * dItot1;
+        if (!output(n_out, I)) return;
+    }
+}
+
+// simulates the current at times t, passing the current at each time to
+// output(n, I), which returns false to stop the simulation early. If sens is
+// non-empty, also integrates the forward sensitivities of the current with
+// respect to params[sens[j]], and writes them to the (Ntime x sens.size())
+// array dItot
+template <typename Output>
+void POMSimulator::run(const double *t, const size_t Ntime, Output &output,
+                       const std::vector<int> &sens, double *dItot) {
+    if (!stats_enabled) {
+        integrate(t, Ntime, output, sens, dItot);
+        return;
+    }
+    phase_timer timer(&stats, "total");
+    stats.simulations++;
+    try {
+        integrate(t, Ntime, output, sens, dItot);
+    } catch (const std::exception &e) {
+        std::map<std::string, double> values;
+        for (int i = 0; i < POMParams::size; ++i) {
+            if (i >= 6 * params.N && i < 6 * POMParams::max_N) continue;
+            values[POMParams::name(i)] = params[i];
+        }
+        stats.failure(e.what(), values);
+        throw;
+    }
+}
+
+template <typename Output>
+void POMSimulator::integrate(const double *t, const size_t Ntime,
+                             Output &output, const std::vector<int> &sens,
+                             double *dItot) {
+    const int N = params.N;
+    if (N < 1 || N > POMParams::max_N)
+        throw std::runtime_error("number of couples N must be from 1 to " +
+                                 std::to_string(POMParams::max_N));
+    if (params.rtol > 0) {
+        if (!sens.empty())
+            throw std::runtime_error(
+                "sensitivities are not available with adaptive time "
+                "stepping");
+        run_sdirk(t, Ntime, output);
+        return;
+    }
+    const double Cdl = params.Cdl;
+    const double CdlE = params.CdlE;
+    const double CdlE2 = params.CdlE2;
+    const double CdlE3 = params.CdlE3;
+    const int Nt = params.Nt;
+
+    const double pi = boost::math::constants::pi<double>();
+    const double omega = params.omega;
+    const double phase = params.phase;
 
 #ifndef NDEBUG
     std::cout << "Running seq_electron_transfer with parameters:" << std::endl;
     for (int i = 0; i < N; ++i) {
-        std::cout << "\tk01 = " << k01[i] << std::endl;
-        std::cout << "\tk02 = " << k02[i] << std::endl;
-        std::cout << "\talpha1 = " << alpha1[i] << std::endl;
-        std::cout << "\talpha2 = " << alpha2[i] << std::endl;
-        std::cout << "\tE01 = " << E01[i] << std::endl;
-        std::cout << "\tE02 = " << E02[i] << std::endl;
-        std::cout << "\tgamma = " << gamma[i] << std::endl;
+        std::cout << "\tk01 = " << params.k01[i] << std::endl;
+        std::cout << "\tk02 = " << params.k02[i] << std::endl;
+        std::cout << "\talpha1 = " << params.alpha1[i] << std::endl;
+        std::cout << "\talpha2 = " << params.alpha2[i] << std::endl;
+        std::cout << "\tE01 = " << params.E01[i] << std::endl;
+        std::cout << "\tE02 = " << params.E02[i] << std::endl;
     }
-    std::cout << "\tRu = " << Ru << std::endl;
+    std::cout << "\tgamma = " << params.gamma << std::endl;
+    std::cout << "\tRu = " << params.Ru << std::endl;
     std::cout << "\tCdl = " << Cdl << std::endl;
     std::cout << "\tCdlE = " << CdlE << std::endl;
     std::cout << "\tCdlE2 = " << CdlE2 << std::endl;
     std::cout << "\tCdlE3 = " << CdlE3 << std::endl;
-    std::cout << "\tEstart = " << Estart << std::endl;
-    std::cout << "\tEreverse = " << Ereverse << std::endl;
+    std::cout << "\tEstart = " << params.Estart << std::endl;
+    std::cout << "\tEreverse = " << params.Ereverse << std::endl;
     std::cout << "\tomega = " << omega << std::endl;
     std::cout << "\tphase = " << phase << std::endl;
-    std::cout << "\tdE= " << dE << std::endl;
+    std::cout << "\tdE= " << params.dE << std::endl;
     std::cout << "\tNt= " << Nt << std::endl;
 #endif
     // if (Ereverse < Estart) throw std::runtime_error("Ereverse must be greater
@@ -229,33 +610,385 @@ void seq_electron_transfer3_explicit(py::dict params,
               << t[Ntime - 1] << std::endl;
 #endif
 
-    Efun Eeq(Estart, Ereverse, dE, omega, phase, dt);
+    const Efun Eeq = applied_potential(params, phase, dt);
 
-    double Itot0, Itot1;
-    double t1 = 0;
+    reset();
     const double E = Eeq(t1);
-    const double Cdlp =
-        Cdl * (1.0 + CdlE * E + CdlE2 * pow(E, 2) + CdlE3 * pow(E, 2));
-    const double Itot_bound = std::max(10 * Cdlp * dE * omega / Nt, 1.0);
 
+    const size_t P = sens.size();
+    sItot0.resize(P);
+    sItot1.resize(P);
+    for (int j = 0; j < P; ++j) {
+        auto seed = [&](const double value, const int index) {
+            return dual(value, sens[j] == index ? 1 : 0);
+        };
+        const dual sCdlp =
+            seed(Cdl, POMParams::index("Cdl")) *
+            (1.0 + seed(CdlE, POMParams::index("CdlE")) * E +
+             seed(CdlE2, POMParams::index("CdlE2")) * E * E +
+             seed(CdlE3, POMParams::index("CdlE3")) * E * E);
+        sItot1[j] = sCdlp.deriv * Eeq.ddt(t1 + 0.5 * dt);
+        sItot0[j] = sItot1[j];
+    }
+
+    step_to(t, Ntime, output, sens, dItot);
+}
+
+// sets the solver state to the initial conditions at t = 0
+void POMSimulator::reset() {
+    const double pi = boost::math::constants::pi<double>();
+    const double dt = (1.0 / params.Nt) * 2 * pi / params.omega;
+    const Efun Eeq = applied_potential(params, params.phase, dt);
+
+    t1 = 0;
+    const double E = Eeq(t1);
+    const double Cdlp = params.Cdl * (1.0 + params.CdlE * E +
+                                      params.CdlE2 * pow(E, 2) +
+                                      params.CdlE3 * pow(E, 2));
     Itot0 = Cdlp * Eeq.ddt(t1 + 0.5 * dt);
     Itot1 = Itot0;
-    seq_elec_fun<N> bc(Cdl, CdlE, CdlE2, CdlE3, E01, E02, Ru, k01, k02, alpha1,
-                       alpha2, dt, gamma);
-    bc.init();
+    u.assign(2 * params.N + 1, 0);
+    u[0] = 1.0;
+}
+
+// steps the solver state on to each of the times t in turn, passing the
+// current at each to output
+template <typename Output>
+void POMSimulator::step_to(const double *t, const size_t Ntime,
+                           Output &output, const std::vector<int> &sens,
+                           double *dItot) {
+    const int N = params.N;
+    double gamma[POMParams::max_N];
+    for (int i = 0; i < N; ++i) {
+        gamma[i] = params.gamma;
+    }
+    const double pi = boost::math::constants::pi<double>();
+    const double dt = (1.0 / params.Nt) * 2 * pi / params.omega;
+    // the potential at the end, and its derivative at the middle, of each
+    // step n = t1 / dt
+    Etab.update(applied_potential(params, params.phase, dt),
+                Ntime > 0 ? std::max(t[Ntime - 1], t1) : t1);
+    const double *Eapp = Etab.E.data();
+    const double *dEapp = Etab.dEdt.data();
+    long n = std::lround(t1 / dt);
+
+    seq_elec_fun bc(params.Cdl, params.CdlE, params.CdlE2, params.CdlE3,
+                    params.E01, params.E02, params.Ru, params.k01,
+                    params.k02, params.alpha1, params.alpha2, dt, gamma, N);
+    bc.init(sens);
+    std::copy(u.begin(), u.end(), bc.u0);
 
+    const size_t P = sens.size();
+    solver_stats *const st = stats_enabled ? &stats : nullptr;
     for (int n_out = 0; n_out < Ntime; n_out++) {
         while (t1 < t[n_out]) {
+            if (st) st->steps++;
             Itot0 = Itot1;
-            const double E = Eeq(t1 + dt);
-            const double dE = Eeq.ddt(t1 + 0.5 * dt);
+            const double E = Eapp[2 * n + 2];
+            const double dE = dEapp[2 * n + 1];
             Itot1 = bc(Itot0, E, dE);
+            if (P > 0) {
+                sItot0.swap(sItot1);
+                bc.update_sensitivities(Itot0, sItot0.data(), E, dE,
+                                        sItot1.data());
+            }
             t1 += dt;
+            n++;
         }
 
         // std::cout << "-----------------" << std::endl;
         // std::cout << bc.dudt << std::endl;
-        Itot[n_out] = (Itot1 - Itot0) * (t[n_out] - t1 + dt) / dt + Itot0;
+        for (int j = 0; j < P; ++j) {
+            dItot[n_out * P + j] =
+                (sItot1[j] - sItot0[j]) * (t[n_out] - t1 + dt) / dt +
+                sItot0[j];
+        }
+        if (!output(n_out,
+                    (Itot1 - Itot0) * (t[n_out] - t1 + dt) / dt + Itot0))
+            break;
+    }
+    std::copy(bc.u0, bc.u0 + bc.Ns, u.begin());
+}
+
+void POMSimulator::simulate(py::array_t<double> values_numpy,
+                            py::array_t<double> t_numpy,
+                            py::array_t<double> Itot_numpy) {
+    py::buffer_info values_info = values_numpy.request();
+    py::buffer_info Itot_info = Itot_numpy.request();
+    py::buffer_info t_info = t_numpy.request();
+
+    if ((values_info.ndim != 1) || (Itot_info.ndim != 1) ||
+        (t_info.ndim != 1))
+        throw std::runtime_error("Number of dimensions must be one");
+
+    if ((Itot_info.shape[0] != t_info.shape[0]) ||
+        (values_info.shape[0] != indices.size()))
+        throw std::runtime_error("Input shapes must be equal");
+
+    const size_t Ntime = Itot_info.shape[0];
+    auto values = reinterpret_cast<double *>(values_info.ptr);
+    auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+    auto t = reinterpret_cast<double *>(t_info.ptr);
+
+    py::gil_scoped_release release;
+    set_values(values);
+    store_current output(Itot);
+    run(t, Ntime, output);
+}
+
+double POMSimulator::sum_of_squares(py::array_t<double> values_numpy,
+                                    py::array_t<double> t_numpy,
+                                    py::array_t<double> data_numpy,
+                                    const double threshold) {
+    py::buffer_info values_info = values_numpy.request();
+    py::buffer_info data_info = data_numpy.request();
+    py::buffer_info t_info = t_numpy.request();
+
+    if ((values_info.ndim != 1) || (data_info.ndim != 1) ||
+        (t_info.ndim != 1))
+        throw std::runtime_error("Number of dimensions must be one");
+
+    if ((data_info.shape[0] != t_info.shape[0]) ||
+        (values_info.shape[0] != indices.size()))
+        throw std::runtime_error("Input shapes must be equal");
+
+    const size_t Ntime = data_info.shape[0];
+    auto values = reinterpret_cast<double *>(values_info.ptr);
+    auto data = reinterpret_cast<double *>(data_info.ptr);
+    auto t = reinterpret_cast<double *>(t_info.ptr);
+
+    py::gil_scoped_release release;
+    set_values(values);
+    sum_of_squares_output output(data, threshold);
+    run(t, Ntime, output);
+    return output.sum;
+}
+
+void POMSimulator::enable_stats(const bool enabled) {
+    stats_enabled = enabled;
+}
+
+py::dict POMSimulator::get_stats() const { return stats.to_dict(); }
+
+void POMSimulator::reset_stats() { stats.reset(); }
+
+void POMSimulator::start(py::array_t<double> values_numpy) {
+    py::buffer_info values_info = values_numpy.request();
+    if (values_info.ndim != 1)
+        throw std::runtime_error("Number of dimensions must be one");
+    if (values_info.shape[0] != indices.size())
+        throw std::runtime_error("Input shapes must be equal");
+
+    set_values(reinterpret_cast<double *>(values_info.ptr));
+    check_chunked();
+    reset();
+}
+
+void POMSimulator::check_chunked() const {
+    if (params.N < 1 || params.N > POMParams::max_N)
+        throw std::runtime_error("number of couples N must be from 1 to " +
+                                 std::to_string(POMParams::max_N));
+    if (params.rtol > 0)
+        throw std::runtime_error(
+            "chunked simulation is not available with adaptive time "
+            "stepping");
+}
+
+void POMSimulator::advance(py::array_t<double> t_numpy,
+                           py::array_t<double> Itot_numpy) {
+    py::buffer_info Itot_info = Itot_numpy.request();
+    py::buffer_info t_info = t_numpy.request();
+
+    if ((Itot_info.ndim != 1) || (t_info.ndim != 1))
+        throw std::runtime_error("Number of dimensions must be one");
+    if (Itot_info.shape[0] != t_info.shape[0])
+        throw std::runtime_error("Input shapes must be equal");
+    if (u.empty())
+        throw std::runtime_error("start or set_state must be called first");
+
+    const size_t Ntime = Itot_info.shape[0];
+    auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+    auto t = reinterpret_cast<double *>(t_info.ptr);
+    // the current is interpolated over the last step
+    const double pi = boost::math::constants::pi<double>();
+    const double dt = (1.0 / params.Nt) * 2 * pi / params.omega;
+    if (Ntime > 0 && t[0] < t1 - dt)
+        throw std::runtime_error("times must not be before the solver state");
+
+    py::gil_scoped_release release;
+    store_current output(Itot);
+    step_to(t, Ntime, output, {}, nullptr);
+}
+
+py::dict POMSimulator::get_state() {
+    if (u.empty())
+        throw std::runtime_error("start or set_state must be called first");
+    std::vector<double> values(indices.size());
+    for (size_t j = 0; j < indices.size(); ++j) {
+        values[j] = params[indices[j]];
+    }
+    const std::vector<double> Itot = {Itot0, Itot1};
+    py::dict state;
+    state["t"] = t1;
+    state["Itot"] = py::array_t<double>(Itot.size(), Itot.data());
+    state["u"] = py::array_t<double>(u.size(), u.data());
+    state["values"] = py::array_t<double>(values.size(), values.data());
+    return state;
+}
+
+void POMSimulator::set_state(py::dict state) {
+    auto values = state["values"].cast<py::array_t<double>>();
+    auto Itot = state["Itot"].cast<py::array_t<double>>();
+    auto u_state = state["u"].cast<py::array_t<double>>();
+    if (values.size() != indices.size() || Itot.size() != 2 ||
+        u_state.size() != 2 * params.N + 1)
+        throw std::runtime_error("state does not match the simulator");
+    set_values(values.data());
+    check_chunked();
+
+    t1 = state["t"].cast<double>();
+    Itot0 = Itot.at(0);
+    Itot1 = Itot.at(1);
+    u.assign(u_state.data(), u_state.data() + u_state.size());
+}
+
+py::object seq_electron_transfer3_explicit(py::dict params,
+                                           py::array_t<double> Itot_numpy,
+                                           py::array_t<double> t_numpy,
+                                           const bool stats) {
+    py::buffer_info Itot_info = Itot_numpy.request();
+    py::buffer_info t_info = t_numpy.request();
+
+    if ((Itot_info.ndim != 1) || (t_info.ndim != 1))
+        throw std::runtime_error("Number of dimensions must be one");
+
+    if (Itot_info.shape[0] != t_info.shape[0])
+        throw std::runtime_error("Input shapes must be equal");
+
+    const size_t Ntime = Itot_info.shape[0];
+    auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+    auto t = reinterpret_cast<double *>(t_info.ptr);
+
+    POMSimulator simulator(params);
+    simulator.enable_stats(stats);
+    {
+        py::gil_scoped_release release;
+        store_current output(Itot);
+        simulator.run(t, Ntime, output);
     }
+    if (stats)
+        return simulator.get_stats();
+    return py::none();
 }
+
+void seq_electron_transfer3_explicit_sensitivities(
+    py::dict params, py::list names, py::array_t<double> Itot_numpy,
+    py::array_t<double> dItot_numpy, py::array_t<double> t_numpy) {
+    py::buffer_info Itot_info = Itot_numpy.request();
+    py::buffer_info dItot_info = dItot_numpy.request();
+    py::buffer_info t_info = t_numpy.request();
+
+    if ((Itot_info.ndim != 1) || (dItot_info.ndim != 2) || (t_info.ndim != 1))
+        throw std::runtime_error(
+            "Itot and t must be one dimensional, and dItot must be two "
+            "dimensional");
+
+    if ((Itot_info.shape[0] != t_info.shape[0]) ||
+        (dItot_info.shape[0] != t_info.shape[0]) ||
+        (dItot_info.shape[1] != py::len(names)))
+        throw std::runtime_error("Input shapes must be equal");
+
+    const size_t Ntime = Itot_info.shape[0];
+    auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+    auto dItot = reinterpret_cast<double *>(dItot_info.ptr);
+    auto t = reinterpret_cast<double *>(t_info.ptr);
+
+    // the couples from N on are not simulated, so have no sensitivities
+    const POMParams pom_params(params);
+    const std::vector<int> sens = POMParams::indices(names);
+    for (size_t j = 0; j < sens.size(); ++j) {
+        if ((sens[j] > POMParams::index("CdlE3")) ||
+            ((sens[j] < 6 * POMParams::max_N) && (sens[j] / 6 >= pom_params.N)))
+            throw std::runtime_error(
+                "sensitivities not available for parameter: " +
+                names[j].cast<std::string>());
+    }
+
+    POMSimulator simulator(pom_params);
+    py::gil_scoped_release release;
+    store_current output(Itot);
+    simulator.run(t, Ntime, output, sens, dItot);
+}
+
+double seq_electron_transfer3_explicit_sum_of_squares(
+    py::dict params, py::array_t<double> data_numpy,
+    py::array_t<double> t_numpy, const double threshold) {
+    py::buffer_info data_info = data_numpy.request();
+    py::buffer_info t_info = t_numpy.request();
+
+    if ((data_info.ndim != 1) || (t_info.ndim != 1))
+        throw std::runtime_error("Number of dimensions must be one");
+
+    if (data_info.shape[0] != t_info.shape[0])
+        throw std::runtime_error("Input shapes must be equal");
+
+    const size_t Ntime = data_info.shape[0];
+    auto data = reinterpret_cast<double *>(data_info.ptr);
+    auto t = reinterpret_cast<double *>(t_info.ptr);
+
+    POMSimulator simulator(params);
+    py::gil_scoped_release release;
+    sum_of_squares_output output(data, threshold);
+    simulator.run(t, Ntime, output);
+    return output.sum;
+}
+
+void seq_electron_transfer3_explicit_batch(py::dict params, py::list names,
+                                           py::array_t<double> values_numpy,
+                                           py::array_t<double> Itot_numpy,
+                                           py::array_t<double> t_numpy,
+                                           const int n_threads) {
+    py::buffer_info values_info = values_numpy.request();
+    py::buffer_info Itot_info = Itot_numpy.request();
+    py::buffer_info t_info = t_numpy.request();
+
+    if ((values_info.ndim != 2) || (Itot_info.ndim != 2) ||
+        (t_info.ndim != 1))
+        throw std::runtime_error(
+            "values and Itot must be two dimensional, and t must be one "
+            "dimensional");
+
+    if ((values_info.shape[0] != Itot_info.shape[0]) ||
+        (values_info.shape[1] != py::len(names)) ||
+        (Itot_info.shape[1] != t_info.shape[0]))
+        throw std::runtime_error("Input shapes must be equal");
+
+    const size_t Nbatch = values_info.shape[0];
+    const size_t Nparams = values_info.shape[1];
+    const size_t Ntime = t_info.shape[0];
+    auto values = reinterpret_cast<double *>(values_info.ptr);
+    auto Itot = reinterpret_cast<double *>(Itot_info.ptr);
+    auto t = reinterpret_cast<double *>(t_info.ptr);
+
+    // one simulator (and hence one set of work arrays) per thread
+    std::vector<POMSimulator> simulators(
+        parallel_for_threads(Nbatch, n_threads), POMSimulator(params, names));
+
+    py::gil_scoped_release release;
+    parallel_for(Nbatch, n_threads, [&](const size_t i, const size_t thread) {
+        POMSimulator &simulator = simulators[thread];
+        simulator.set_values(values + i * Nparams);
+        store_current output(Itot + i * Ntime);
+        simulator.run(t, Ntime, output);
+    });
+}
+
+// the kernels run by joint_sum_of_squares and joint_simulate
+template void POMSimulator::run<store_current>(const double *, const size_t,
+                                               store_current &,
+                                               const std::vector<int> &,
+                                               double *);
+template void POMSimulator::run<sum_of_squares_output>(
+    const double *, const size_t, sum_of_squares_output &,
+    const std::vector<int> &, double *);
 }  // namespace electrochemistry
@@ -3,14 +3,237 @@
 
 #include "utilities.hpp"
 
+#include <boost/math/constants/constants.hpp>
+
 #include <map>
 #include <string>
 #include <vector>
 
 namespace electrochemistry {
-void seq_electron_transfer3_explicit(py::dict params,
-                                     py::array_t<double> Itot_numpy,
-                                     py::array_t<double> t_numpy);
+
+struct POMParams {
+    // maximum number of sequential electron-transfer couples
+    static const int max_N = 6;
+
+    POMParams(py::dict params)
+        : N(get(params, std::string("N"), 3.0)),
+          gamma(get(params, std::string("gamma"), 1.0)),
+          Ru(get(params, std::string("Ru"), 0.001)),
+          Cdl(get(params, std::string("Cdl"), 0.0037)),
+          CdlE(get(params, std::string("CdlE"), 0.0)),
+          CdlE2(get(params, std::string("CdlE2"), 0.0)),
+          CdlE3(get(params, std::string("CdlE3"), 0.0)),
+          Estart(get(params, std::string("Estart"), -10.0)),
+          Ereverse(get(params, std::string("Ereverse"), 10.0)),
+          omega(get(params, std::string("omega"),
+                    2 * boost::math::constants::pi<double>())),
+          phase(get(params, std::string("phase"), 0.0)),
+          dE(get(params, std::string("dE"), 0.1)),
+          Nt(get(params, std::string("Nt"), 600.0)),
+          rtol(get(params, std::string("rtol"), 0.0)),
+          atol(get(params, std::string("atol"), 1e-6)),
+          Edata(get(params, std::string("Edata"), std::vector<double>())),
+          dt_data(get(params, std::string("dt_data"), 0.0)) {
+        for (int i = 0; i < max_N; ++i) {
+            k01[i] = get(params, name("k", i, 1), 35.0);
+            k02[i] = get(params, name("k", i, 2), 65.0);
+            E01[i] = get(params, name("E", i, 1), 0.25);
+            E02[i] = get(params, name("E", i, 2), -0.25);
+            alpha1[i] = get(params, name("alpha", i, 1), 0.5);
+            alpha2[i] = get(params, name("alpha", i, 2), 0.5);
+        }
+    }
+
+    // name of parameter for electron transfer j (1 or 2) of couple i, e.g.
+    // k01, E12, alpha1, alpha21
+    static std::string name(const std::string &prefix, const int i,
+                            const int j) {
+        if (prefix == "alpha" && i == 0) {
+            return prefix + std::to_string(j);
+        }
+        return prefix + std::to_string(i) + std::to_string(j);
+    }
+
+    // number of (floating point) parameters accessible with operator[]
+    static const int size = 6 * max_N + 11;
+
+    // name of the parameter with the given index
+    static std::string name(const int index) {
+        if (index < 6 * max_N) {
+            const char *prefixes[] = {"k", "E", "alpha"};
+            return name(prefixes[index % 6 / 2], index / 6, index % 2 + 1);
+        }
+        const char *names[] = {"gamma", "Ru",     "Cdl",      "CdlE",
+                               "CdlE2", "CdlE3",  "Estart",   "Ereverse",
+                               "omega", "phase",  "dE"};
+        return names[index - 6 * max_N];
+    }
+
+    // index of a named (floating point) parameter, for use with operator[]
+    static int index(const std::string &name) {
+        for (int i = 0; i < size; ++i) {
+            if (name == POMParams::name(i)) return i;
+        }
+        throw std::runtime_error("unknown parameter name: " + name);
+    }
+
+    // indices of a list of parameter names
+    static std::vector<int> indices(py::list names) {
+        std::vector<int> indices(py::len(names));
+        for (size_t j = 0; j < indices.size(); ++j) {
+            indices[j] = index(names[j].cast<std::string>());
+        }
+        return indices;
+    }
+
+    double &operator[](const int index) {
+        if (index < 6 * max_N) {
+            const int i = index / 6;
+            switch (index % 6) {
+                case 0:
+                    return k01[i];
+                case 1:
+                    return k02[i];
+                case 2:
+                    return E01[i];
+                case 3:
+                    return E02[i];
+                case 4:
+                    return alpha1[i];
+                default:
+                    return alpha2[i];
+            }
+        }
+        switch (index - 6 * max_N) {
+            case 0:
+                return gamma;
+            case 1:
+                return Ru;
+            case 2:
+                return Cdl;
+            case 3:
+                return CdlE;
+            case 4:
+                return CdlE2;
+            case 5:
+                return CdlE3;
+            case 6:
+                return Estart;
+            case 7:
+                return Ereverse;
+            case 8:
+                return omega;
+            case 9:
+                return phase;
+            default:
+                return dE;
+        }
+    }
+
+    // number of couples in use, parameters of couples N..max_N-1 are ignored
+    int N;
+    double k01[max_N], k02[max_N], E01[max_N], E02[max_N], alpha1[max_N],
+        alpha2[max_N];
+    double gamma, Ru, Cdl, CdlE, CdlE2, CdlE3, Estart, Ereverse, omega, phase,
+        dE;
+    int Nt;
+
+    // tolerances for the adaptive SDIRK integrator, which replaces the fixed
+    // Nt backward Euler steps per period if rtol > 0
+    double rtol, atol;
+
+    // measured applied potential, sampled every dt_data from t = 0, which
+    // replaces the dc ramp and sine wave if not empty (see
+    // applied_potential)
+    std::vector<double> Edata;
+    double dt_data;
+};
+
+// Simulates the POM model for many parameter sets in turn, reusing the
+// parsed parameters and the work arrays for the sensitivities. Not thread
+// safe, use one POMSimulator per thread.
+class POMSimulator {
+   public:
+    // params gives every parameter, and names (or indices) the parameters
+    // which are then set by each call to simulate
+    POMSimulator(const POMParams &params,
+                 const std::vector<int> &indices = {});
+    POMSimulator(py::dict params, py::list names);
+
+    void simulate(py::array_t<double> values, py::array_t<double> t,
+                  py::array_t<double> Itot);
+    double sum_of_squares(py::array_t<double> values, py::array_t<double> t,
+                          py::array_t<double> data, const double threshold);
+
+    // chunked simulation with fixed time steps: start sets the values and
+    // resets the solver state to t = 0, advance continues from the state to
+    // the times t, and get_state and set_state snapshot and restore the state
+    // between calls
+    void start(py::array_t<double> values);
+    void advance(py::array_t<double> t, py::array_t<double> Itot);
+    py::dict get_state();
+    void set_state(py::dict state);
+
+    // solver stats (see solver_stats) are recorded while enabled, and
+    // summed over simulations until reset. Recording is off by default
+    void enable_stats(const bool enabled = true);
+    py::dict get_stats() const;
+    void reset_stats();
+
+    void set_values(const double *values);
+    template <typename Output>
+    void run(const double *t, const size_t Ntime, Output &output,
+             const std::vector<int> &sens = {}, double *dItot = nullptr);
+
+    POMParams params;
+    std::vector<int> indices;
+
+   private:
+    template <typename Output>
+    void integrate(const double *t, const size_t Ntime, Output &output,
+                   const std::vector<int> &sens, double *dItot);
+    void check_chunked() const;
+    void reset();
+    template <typename Output>
+    void step_to(const double *t, const size_t Ntime, Output &output,
+                 const std::vector<int> &sens, double *dItot);
+    template <typename Output>
+    void run_sdirk(const double *t, const size_t Ntime, Output &output);
+
+    // solver state: the time t1, the current at the last two steps and the
+    // concentrations u
+    double t1, Itot0, Itot1;
+    std::vector<double> u;
+
+    std::vector<double> sItot0, sItot1;
+
+    // applied potential at the half steps of the fixed-step solver
+    Etable Etab;
+
+    solver_stats stats;
+    bool stats_enabled;
+};
+
+py::object seq_electron_transfer3_explicit(py::dict params,
+                                           py::array_t<double> Itot_numpy,
+                                           py::array_t<double> t_numpy,
+                                           const bool stats);
+
+void seq_electron_transfer3_explicit_sensitivities(
+    py::dict params, py::list names, py::array_t<double> Itot_numpy,
+    py::array_t<double> dItot_numpy, py::array_t<double> t_numpy);
+
+// sum of squared differences between the simulated current and data, stops
+// early and returns the partial sum once it exceeds threshold
+double seq_electron_transfer3_explicit_sum_of_squares(
+    py::dict params, py::array_t<double> data_numpy,
+    py::array_t<double> t_numpy, const double threshold);
+
+void seq_electron_transfer3_explicit_batch(py::dict params, py::list names,
+                                           py::array_t<double> values_numpy,
+                                           py::array_t<double> Itot_numpy,
+                                           py::array_t<double> t_numpy,
+                                           const int n_threads);
 }
 
 #endif
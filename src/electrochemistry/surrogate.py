@@ -0,0 +1,232 @@
+from __future__ import print_function
+import json
+import threading
+
+import numpy as np
+import pints
+
+from .cache import _json_default
+
+
+def _latin_hypercube(n, d, seed=None):
+    # n points in the d-dimensional unit cube, one in each of the n strata of
+    # every dimension
+    random = np.random.RandomState(seed)
+    strata = np.array([random.permutation(n) for _ in range(d)]).T
+    return (strata + random.uniform(size=(n, d))) / n
+
+
+class SurrogateModel(pints.ForwardModel):
+
+    """Gaussian process emulator of the current trace of a
+    :class:`PintsModelAdaptor`, at a fixed set of times and within a box of
+    parameter values
+
+    The training traces are compressed by proper orthogonal decomposition
+    (POD), and the coefficients of each mode are interpolated over the
+    (box-scaled) parameters by a Gaussian process with a squared exponential
+    kernel. The length scale of the kernel is chosen, and the variance of
+    each mode calibrated, by leave-one-out cross-validation on the training
+    set, giving an estimate of the relative RMS error of each prediction.
+    Where that estimate exceeds ``tolerance`` (or for parameters outside the
+    box, or other times), :meth:`simulate` runs the wrapped model instead and
+    adds the run to the training set.
+
+    Args:
+        model (PintsModelAdaptor): model to emulate
+        times (numpy vector): output times
+        lower (numpy vector): lower bounds of the (non-dimensional)
+            parameters
+        upper (numpy vector): upper bounds of the parameters
+        n_train (int): size of the initial Latin hypercube design of runs,
+            simulated in parallel
+        tolerance (float): largest estimated relative RMS error of an
+            emulated trace
+        seed (int): seed of the random design
+    """
+
+    def __init__(self, model, times, lower, upper, n_train=50,
+                 tolerance=1e-2, seed=None):
+        self.model = model
+        self.times = np.asarray(times, dtype='double')
+        self.lower = np.asarray(lower, dtype='double')
+        self.upper = np.asarray(upper, dtype='double')
+        self.tolerance = tolerance
+        self.evaluations = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+        design = _latin_hypercube(n_train, len(self.lower), seed)
+        x = self.lower + design * (self.upper - self.lower)
+        self._x, self._y = self._run(x)
+        self._train()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def n_parameters(self):
+        return len(self.lower)
+
+    def n_outputs(self):
+        return 1
+
+    def n_train(self):
+        """ number of runs of the wrapped model in the training set """
+        return len(self._x)
+
+    def _run(self, x):
+        # simulates the rows of x, dropping any that fail
+        try:
+            return x, self.model.simulate_batch(x, self.times)
+        except RuntimeError:
+            rows = []
+            currents = []
+            for row in x:
+                try:
+                    currents.append(self.model.simulate(row, self.times))
+                    rows.append(row)
+                except RuntimeError:
+                    pass
+            return np.array(rows), np.array(currents)
+
+    def _unit(self, x):
+        return (x - self.lower) / (self.upper - self.lower)
+
+    def _kernel(self, a, b, length):
+        distance = np.sum((a[:, np.newaxis, :] - b[np.newaxis, :, :])**2,
+                          axis=2)
+        return np.exp(-0.5 * distance / length**2)
+
+    def _train(self):
+        x = self._unit(self._x)
+        y = self._y
+        n = len(y)
+        self._mean = np.mean(y, axis=0)
+        u, s, vt = np.linalg.svd(y - self._mean, full_matrices=False)
+
+        # modes carrying all but 1e-12 of the variance of the traces
+        energy = np.cumsum(s**2)
+        k = min(np.searchsorted(energy, (1 - 1e-12) * energy[-1]) + 1, n - 1)
+        self._basis = vt[:k]
+        coefficients = u[:, :k] * s[:k]
+        self._truncation = np.sum(s[k:]**2) / (n * len(self.times))
+        self._scale = np.sqrt(np.mean(y**2))
+
+        # the length scale with the smallest leave-one-out error, for which
+        # the (scaled) leave-one-out residual of sample i is
+        # [K^-1 c]_i / [K^-1]_ii with unit variance 1 / [K^-1]_ii
+        best = np.inf
+        d = x.shape[1]
+        for length in np.sqrt(d) * np.logspace(-1.5, 0.5, 21):
+            K = self._kernel(x, x, length) + 1e-10 * np.eye(n)
+            try:
+                inverse = np.linalg.inv(np.linalg.cholesky(K))
+            except np.linalg.LinAlgError:
+                continue
+            K_inv = np.dot(inverse.T, inverse)
+            diagonal = np.diag(K_inv)
+            residuals = np.dot(K_inv, coefficients) / diagonal[:, np.newaxis]
+            error = np.sum(residuals**2)
+            if error < best:
+                best = error
+                self._length = length
+                self._K_inv = K_inv
+                self._alpha = np.dot(K_inv, coefficients)
+                self._variance = np.mean(
+                    residuals**2 * diagonal[:, np.newaxis], axis=0)
+
+    def predict(self, parameters):
+        """ the emulated current at a parameter vector, and the estimated
+        relative RMS error of it
+        """
+        x = self._unit(np.asarray(parameters, dtype='double'))
+        kx = self._kernel(x[np.newaxis, :], self._unit(self._x),
+                          self._length)[0]
+        current = self._mean + np.dot(np.dot(kx, self._alpha), self._basis)
+        variance = max(1 - np.dot(kx, np.dot(self._K_inv, kx)), 0)
+        mse = (variance * np.sum(self._variance) / len(self.times) +
+               self._truncation)
+        return current, np.sqrt(mse) / self._scale
+
+    def error_estimate(self, parameters):
+        """ the estimated relative RMS error of the emulated current """
+        return self.predict(parameters)[1]
+
+    def simulate(self, parameters, times):
+        parameters = np.asarray(parameters, dtype='double')
+        times = np.asarray(times, dtype='double')
+        with self._lock:
+            self.evaluations += 1
+            if (np.array_equal(times, self.times) and
+                    np.all(parameters >= self.lower) and
+                    np.all(parameters <= self.upper)):
+                current, error = self.predict(parameters)
+                if error <= self.tolerance:
+                    return current
+            self.fallbacks += 1
+        current = self.model.simulate(parameters, times)
+        if np.array_equal(times, self.times):
+            with self._lock:
+                self._x = np.vstack((self._x, parameters))
+                self._y = np.vstack((self._y, current))
+                self._train()
+        return current
+
+    def sum_of_squares(self, parameters, times, data, threshold=np.inf):
+        # threshold is unused, an emulated trace costs little
+        current = self.simulate(parameters, times)
+        return np.sum((current - data)**2)
+
+    def _protocol(self):
+        # the wrapped model's parameters that are not being fitted, as json
+        params = self.model.ec_model.params
+        return json.dumps({name: params[name] for name in sorted(params)
+                           if name not in self.model.names},
+                          default=_json_default)
+
+    def save(self, filename):
+        """ saves the training set, to be reused by :meth:`load` in later fits
+        of the same experimental protocol
+        """
+        with self._lock:
+            np.savez(filename, x=self._x, y=self._y, times=self.times,
+                     lower=self.lower, upper=self.upper,
+                     tolerance=self.tolerance,
+                     names=json.dumps(list(self.model.names)),
+                     protocol=self._protocol())
+
+    @classmethod
+    def load(cls, filename, model):
+        """ a surrogate of model, trained on the runs saved by :meth:`save`
+
+        Raises:
+            ValueError: if model fits other parameters, or has different
+                values of the others, than the saved surrogate
+        """
+        with np.load(filename) as f:
+            surrogate = cls.__new__(cls)
+            surrogate.model = model
+            surrogate.times = f['times']
+            surrogate.lower = f['lower']
+            surrogate.upper = f['upper']
+            surrogate.tolerance = float(f['tolerance'])
+            surrogate.evaluations = 0
+            surrogate.fallbacks = 0
+            surrogate._lock = threading.Lock()
+            surrogate._x = f['x']
+            surrogate._y = f['y']
+            names = json.loads(str(f['names']))
+            protocol = str(f['protocol'])
+        if names != list(model.names):
+            raise ValueError('surrogate was trained on parameters ' +
+                             ', '.join(names))
+        if protocol != surrogate._protocol():
+            raise ValueError('surrogate was trained on another protocol')
+        surrogate._train()
+        return surrogate
@@ -0,0 +1,198 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from .models import ECModel, POMModel
+from .surrogate import _latin_hypercube
+
+MODELS = {'ec': ECModel, 'pom': POMModel}
+
+
+def sweep_model(spec):
+    """ the :class:`ECModel` or :class:`POMModel` of a sweep spec, with its
+    solver settings
+    """
+    # the constructors print their parameters
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            model = MODELS[spec['model']](dict(spec['params']))
+        finally:
+            sys.stdout = stdout
+    model.params.update(spec.get('solver', {}))
+    return model
+
+
+def sweep_times(spec, model):
+    """ the (non-dimensional) output times of a sweep spec """
+    if 'times' not in spec:
+        return model.suggest_times()
+    start, stop, n = spec['times']
+    return np.linspace(start, stop, int(n)) / model.T0
+
+
+def sweep_design(spec):
+    """ the (dimensional) parameter sets of a sweep spec, one per row, in
+    the order of ``spec['ranges']``
+    """
+    names = list(spec['ranges'])
+    lower = np.array([spec['ranges'][name][0] for name in names], dtype=float)
+    upper = np.array([spec['ranges'][name][1] for name in names], dtype=float)
+    log = np.array([name in spec.get('log', []) for name in names])
+    d = len(names)
+    if spec.get('design', 'grid') == 'grid':
+        points = spec['points']
+        if not isinstance(points, dict):
+            points = {name: points for name in names}
+        axes = [np.linspace(0, 1, int(points[name])) for name in names]
+        unit = np.stack(np.meshgrid(*axes, indexing='ij'), -1).reshape(-1, d)
+    elif spec['design'] == 'lhs':
+        unit = _latin_hypercube(int(spec['n']), d, spec.get('seed'))
+    else:
+        raise ValueError('unknown design ' + spec['design'])
+    values = lower + unit * (upper - lower)
+    values[:, log] = np.exp(np.log(lower[log]) +
+                            unit[:, log] * np.log(upper[log] / lower[log]))
+    return values
+
+
+def _completed(filename):
+    # the chunks recorded in the log, ignoring a partly written last line
+    if not os.path.exists(filename):
+        return set()
+    with open(filename) as f:
+        return {int(line) for line in f.read().split('\n')[:-1]}
+
+
+def run_sweep(spec, directory, n_threads=0, chunk_size=1000, report=print):
+    """ simulates every parameter set of a sweep, writing the currents to
+    ``directory`` a chunk of sets at a time
+
+    The directory holds the spec, the (dimensional) parameter sets
+    ``parameters.npy``, the (non-dimensional) times ``times.npy``, and the
+    (non-dimensional) currents ``current.npy``, one row per parameter set
+    (NaN for a failed simulation), which can be opened with
+    ``np.load(..., mmap_mode='r')`` while the sweep runs or after. Each chunk
+    is flushed to disk and then its index is appended to ``completed.txt``
+    (the rows of chunks not listed there are not yet simulated). Running the
+    sweep again on the same directory only simulates the chunks not listed,
+    so an interrupted sweep resumes where it stopped.
+
+    Args:
+        spec (dict): the sweep, with keys 'model' ('ec' or 'pom'),
+            'params' (the dimensional parameters of the model), optional
+            'solver' (non-dimensional solver settings, e.g. 'Nt'), 'ranges'
+            (``{name: [lower, upper]}`` of the dimensional parameters to
+            sweep, as given to the model), optional 'log' (names sampled on a
+            log scale), 'design' ('grid' with 'points' per parameter, or
+            'lhs' with 'n' sets and an optional 'seed'), and optional 'times'
+            (``[start, stop, n]`` in seconds, by default
+            ``model.suggest_times()``)
+        directory (str): output directory
+        n_threads (int): number of threads simulating each chunk, default
+            uses all cores
+        chunk_size (int): number of parameter sets in each chunk, fixed when
+            the sweep is started
+        report (callable): called with a progress message after each chunk
+
+    returns:
+        current (numpy array): the memory-mapped currents
+    """
+    spec_filename = os.path.join(directory, 'spec.json')
+    log_filename = os.path.join(directory, 'completed.txt')
+    current_filename = os.path.join(directory, 'current.npy')
+    # as it is saved, e.g. with lists rather than tuples
+    spec = json.loads(json.dumps(spec))
+    model = sweep_model(spec)
+    names = list(spec['ranges'])
+
+    if os.path.exists(spec_filename):
+        with open(spec_filename) as f:
+            saved = json.load(f)
+        chunk_size = saved.pop('chunk_size')
+        if saved != spec:
+            raise ValueError('directory holds another sweep: ' + directory)
+        parameters = np.load(os.path.join(directory, 'parameters.npy'))
+        times = np.load(os.path.join(directory, 'times.npy'))
+        current = np.load(current_filename, mmap_mode='r+')
+    else:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        parameters = sweep_design(spec)
+        times = sweep_times(spec, model)
+        np.save(os.path.join(directory, 'parameters.npy'), parameters)
+        np.save(os.path.join(directory, 'times.npy'), times)
+        current = np.lib.format.open_memmap(
+            current_filename, mode='w+', dtype='double',
+            shape=(len(parameters), len(times)))
+        open(log_filename, 'w').close()
+        # written last, so that a directory with a spec is complete
+        with open(spec_filename, 'w') as f:
+            json.dump(dict(spec, chunk_size=chunk_size), f, indent=1)
+
+    vectors = model.transform(names, experiment=True).non_dimensionalise(
+        parameters)
+    n = len(parameters)
+    chunks = [slice(i, min(i + chunk_size, n))
+              for i in range(0, n, chunk_size)]
+    completed = _completed(log_filename)
+    done = sum(chunks[i].stop - chunks[i].start for i in completed)
+    start = time.time()
+    simulated = 0
+    with open(log_filename, 'a') as log:
+        for i, rows in enumerate(chunks):
+            if i in completed:
+                continue
+            current[rows] = _simulate_chunk(model, vectors[rows], names,
+                                            times, n_threads)
+            current.flush()
+            log.write('%d\n' % i)
+            log.flush()
+            os.fsync(log.fileno())
+
+            done += rows.stop - rows.start
+            simulated += rows.stop - rows.start
+            rate = simulated / (time.time() - start)
+            report('chunk %d/%d: %d/%d sets, %.1f sets/s, %.0f s left' % (
+                i + 1, len(chunks), done, n, rate, (n - done) / rate))
+    return current
+
+
+def _simulate_chunk(model, vectors, names, times, n_threads):
+    # simulates a chunk as a batch, or if any set fails one at a time, with
+    # NaN for those that fail
+    try:
+        return model.simulate_batch(vectors, names, times, n_threads)
+    except RuntimeError:
+        current = np.full((len(vectors), len(times)), np.nan)
+        for j, vector in enumerate(vectors):
+            try:
+                current[j] = model.simulate(
+                    times, model.params_from_vector(vector, names))
+            except RuntimeError:
+                pass
+        return current
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Simulates an ECModel or POMModel over a grid or Latin '
+        'hypercube of parameter sets given by a JSON spec (see run_sweep), '
+        'writing the currents to a memory-mappable array in a directory. '
+        'Run again with the same directory to resume an interrupted sweep.')
+    parser.add_argument('spec', help='JSON file of the sweep spec')
+    parser.add_argument('directory', help='output directory')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='number of threads, default uses all cores')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='number of parameter sets in each chunk')
+    args = parser.parse_args(args)
+    with open(args.spec) as f:
+        spec = json.load(f)
+    run_sweep(spec, args.directory, args.threads, args.chunk_size)
@@ -3,113 +3,279 @@
 
 #include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
 
+#include <algorithm>
+#include <atomic>
+#include <chrono>
 #include <cmath>
+#include <exception>
 #include <iostream>
 #include <map>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <vector>
 
 namespace py = pybind11;
 
 template <typename V>
 V get(py::dict m, const std::string &key, const V &defval) {
-    return m[key.c_str()].cast<V>();
-    /*
     if (m.contains(key.c_str())) {
-      return defval;
+        return m[key.c_str()].cast<V>();
     } else {
-      return m[key.c_str()].cast<V>();
+        return defval;
     }
-    */
+}
+// number of worker threads used by parallel_for(n, n_threads, f)
+inline size_t parallel_for_threads(const size_t n, const int n_threads) {
+    const size_t nthreads = n_threads > 0
+                                ? n_threads
+                                : std::thread::hardware_concurrency();
+    return std::max<size_t>(std::min(nthreads, n), 1);
+}
+
+// calls f(i, thread) for i = 0..n-1 using n_threads worker threads (all
+// available cores if n_threads <= 0), where thread < parallel_for_threads(n,
+// n_threads) identifies the worker making the call, so that f can reuse
+// per-thread workspace. The first exception thrown by any call is rethrown
+// on the calling thread once all workers have finished. Must not touch any
+// python objects, so callers can release the GIL around it.
+template <typename Function>
+void parallel_for(const size_t n, const int n_threads, Function f) {
+    const size_t nthreads = parallel_for_threads(n, n_threads);
+
+    std::atomic<size_t> next(0);
+    std::exception_ptr error = nullptr;
+    std::mutex error_mutex;
+    auto worker = [&](const size_t thread) {
+        for (size_t i = next++; i < n; i = next++) {
+            try {
+                f(i, thread);
+            } catch (...) {
+                std::lock_guard<std::mutex> lock(error_mutex);
+                if (!error) error = std::current_exception();
+                next = n;
+            }
+        }
+    };
+
+    std::vector<std::thread> threads;
+    for (size_t i = 1; i < nthreads; ++i) {
+        threads.emplace_back(worker, i);
+    }
+    worker(0);
+    for (auto &thread : threads) {
+        thread.join();
+    }
+    if (error) std::rethrow_exception(error);
+}
+
+// counters and timings recorded by a simulator while stats are enabled,
+// summed over its simulations until reset
+struct solver_stats {
+    // number of failed simulations whose parameters are kept
+    static const size_t max_failures = 100;
+
+    solver_stats() { reset(); }
+
+    void reset() {
+        simulations = 0;
+        steps = 0;
+        rejected_steps = 0;
+        newton_solves = 0;
+        newton_iterations = 0;
+        max_newton_iterations = 0;
+        bracket_hits = 0;
+        fallbacks = 0;
+        newton_histogram.clear();
+        seconds.clear();
+        failures.clear();
+        failure_params.clear();
+    }
+
+    // records a Newton solve taking the given number of iterations, whose
+    // result was (or was not) at the edge of its bracket
+    void newton(const long iterations, const bool bracket_hit) {
+        newton_solves++;
+        newton_iterations += iterations;
+        max_newton_iterations = std::max(max_newton_iterations, iterations);
+        if (newton_histogram.size() <= iterations) {
+            newton_histogram.resize(iterations + 1, 0);
+        }
+        newton_histogram[iterations]++;
+        bracket_hits += bracket_hit;
+    }
+
+    // records a failed simulation, with the values of the named parameters
+    void failure(const std::string &message,
+                 const std::map<std::string, double> &params) {
+        if (failures.size() < max_failures) {
+            failures.push_back(message);
+            failure_params.push_back(params);
+        }
+    }
+
+    py::dict to_dict() const {
+        py::dict stats;
+        stats["simulations"] = simulations;
+        stats["steps"] = steps;
+        stats["rejected_steps"] = rejected_steps;
+        stats["newton_solves"] = newton_solves;
+        stats["newton_iterations"] = newton_iterations;
+        stats["max_newton_iterations"] = max_newton_iterations;
+        stats["newton_histogram"] = py::cast(newton_histogram);
+        stats["bracket_hits"] = bracket_hits;
+        stats["fallbacks"] = fallbacks;
+        stats["seconds"] = py::cast(seconds);
+        py::list failed;
+        for (size_t i = 0; i < failures.size(); ++i) {
+            py::dict failure;
+            failure["message"] = failures[i];
+            failure["params"] = py::cast(failure_params[i]);
+            failed.append(failure);
+        }
+        stats["failures"] = failed;
+        return stats;
+    }
+
+    // steps counts the accepted time steps only, rejected_steps those
+    // retried with a smaller step
+    long simulations, steps, rejected_steps;
+    long newton_solves, newton_iterations, max_newton_iterations;
+    long bracket_hits;
+    // number of solves where Newton failed and a bracketing method was used
+    long fallbacks;
+    // newton_histogram[i] is the number of Newton solves taking i iterations
+    std::vector<long> newton_histogram;
+    // wall time spent in each phase of the simulations
+    std::map<std::string, double> seconds;
+    std::vector<std::string> failures;
+    std::vector<std::map<std::string, double>> failure_params;
+};
+
+// adds the wall time from construction to destruction to
+// stats->seconds[phase], or does nothing if stats is null
+class phase_timer {
+   public:
+    phase_timer(solver_stats *stats, const char *phase)
+        : stats(stats), phase(phase) {
+        if (stats) start = std::chrono::steady_clock::now();
+    }
+    ~phase_timer() {
+        if (stats) {
+            const std::chrono::duration<double> elapsed =
+                std::chrono::steady_clock::now() - start;
+            stats->seconds[phase] += elapsed.count();
+        }
+    }
+
+   private:
+    solver_stats *stats;
+    const char *phase;
+    std::chrono::steady_clock::time_point start;
+};
+
+// kernel output that stores the simulated current at each sample time
+struct store_current {
+    store_current(double *Itot) : Itot(Itot) {}
+    bool operator()(const size_t n, const double I) {
+        Itot[n] = I;
+        return true;
+    }
+    double *Itot;
+};
+
+// kernel output that accumulates the sum of squared residuals against data,
+// asking the kernel to stop as soon as the sum exceeds threshold
+struct sum_of_squares_output {
+    sum_of_squares_output(const double *data, const double threshold)
+        : data(data), threshold(threshold), sum(0) {}
+    bool operator()(const size_t n, const double I) {
+        const double residual = I - data[n];
+        sum += residual * residual;
+        return sum <= threshold;
+    }
+    const double *data;
+    const double threshold;
+    double sum;
+};
+
+// forward-mode automatic differentiation: a value and its derivative along a
+// single direction in parameter space
+struct dual {
+    dual(const double value = 0, const double deriv = 0)
+        : value(value), deriv(deriv) {}
+    dual &operator+=(const dual &other) {
+        value += other.value;
+        deriv += other.deriv;
+        return *this;
+    }
+    double value, deriv;
+};
+
+inline dual operator+(const dual &a, const dual &b) {
+    return dual(a.value + b.value, a.deriv + b.deriv);
+}
+inline dual operator-(const dual &a, const dual &b) {
+    return dual(a.value - b.value, a.deriv - b.deriv);
+}
+inline dual operator-(const dual &a) { return dual(-a.value, -a.deriv); }
+inline dual operator*(const dual &a, const dual &b) {
+    return dual(a.value * b.value, a.deriv * b.value + a.value * b.deriv);
+}
+inline dual operator/(const dual &a, const dual &b) {
+    return dual(a.value / b.value,
+                (a.deriv * b.value - a.value * b.deriv) / (b.value * b.value));
+}
+inline dual exp(const dual &a) {
+    const double value = std::exp(a.value);
+    return dual(value, a.deriv * value);
 }
 
 struct Efun {
     Efun(){};
-    Efun(const Efun &other)
-        : Estart(other.Estart),
-          Ereverse(other.Ereverse),
-          dE(other.dE),
-          omega(other.omega),
-          phase(other.phase),
-          dt(other.dt),
-          treverse(other.treverse),
-          direction(other.direction),
-          dt_data(other.dt_data),
-          Edata(other.Edata){};
     Efun(const std::vector<double> *Edata, const double dt_data,
          const double dE, const double omega, const double phase,
          const double dt)
-        : Edata(Edata),
-          dt_data(dt_data),
+        : Estart(0),
+          Ereverse(0),
           dE(dE),
           omega(omega),
+          dt(dt),
+          treverse(0),
           phase(phase),
-          dt(dt){};
+          direction(1),
+          Edata(Edata),
+          dt_data(dt_data){};
     Efun(const double Estart, const double Ereverse, const double dE,
          const double omega, const double phase, const double dt)
         : Estart(Estart),
           Ereverse(Ereverse),
           dE(dE),
           omega(omega),
-          phase(phase),
           dt(dt),
           treverse(std::abs(Estart - Ereverse)),
+          phase(phase),
           direction(Ereverse > Estart ? 1 : -1),
-          Edata(NULL){};
-    double operator[](const int n) const {
-        const double t = n * dt;
-        double Edc;
-        if (Edata == NULL) {
-            if (t < treverse) {
-                Edc = Estart + direction * t;
-            } else {
-                Edc = Ereverse - direction * (t - treverse);
-            }
-        } else {
-            const double x = t / dt_data;
-            const unsigned int x0 = floor(x);
-            const unsigned int x1 = ceil(x);
-            const double y0 = (*Edata)[x0];
-            const double y1 = (*Edata)[x1];
-            Edc = ((x - x0) / dt_data) * y1 + ((x - x1) / dt_data) * y0;
-        }
-
-        return Edc + dE * std::sin(omega * t + phase);
-    }
+          Edata(NULL),
+          dt_data(0){};
+    double operator[](const int n) const { return (*this)(n * dt); }
     double operator()(const double t) const {
-        double Edc;
-        if (Edata == NULL) {
-            if (t < treverse) {
-                Edc = Estart + direction * t;
-            } else {
-                Edc = Ereverse - direction * (t - treverse);
-            }
-        } else {
-            const double x = t / dt_data;
-            const unsigned int x0 = floor(x);
-            const unsigned int x1 = ceil(x);
-            const double y0 = (*Edata)[x0];
-            const double y1 = (*Edata)[x1];
-            Edc = (x - x0) * y1 + (x1 - x) * y0;
-        }
-        return Edc + dE * std::sin(omega * t + phase);
+        return dc(t) + dE * std::sin(omega * t + phase);
     }
     double dc(const double t) const {
-        double Edc;
         if (Edata == NULL) {
             if (t < treverse) {
-                Edc = Estart + direction * t;
+                return Estart + direction * t;
             } else {
-                Edc = Ereverse - direction * (t - treverse);
+                return Ereverse - direction * (t - treverse);
             }
-        } else {
-            const double x = t / dt_data;
-            const unsigned int x0 = floor(x);
-            const unsigned int x1 = ceil(x);
-            const double y0 = (*Edata)[x0];
-            const double y1 = (*Edata)[x1];
-            Edc = (x - x0) * y1 + (x1 - x) * y0;
         }
-        return Edc;
+        // linear interpolation between the samples, held at the last one
+        const size_t x0 = sample(t);
+        const double w = std::min(t / dt_data - x0, 1.0);
+        return (*Edata)[x0] + w * ((*Edata)[x0 + 1] - (*Edata)[x0]);
     }
     double ddt(const double t) const {
         double dEdcdt;
@@ -120,12 +286,8 @@ struct Efun {
                 dEdcdt = direction;
             }
         } else {
-            const double x = t / dt_data;
-            const unsigned int x0 = floor(x);
-            const unsigned int x1 = ceil(x);
-            const double y0 = (*Edata)[x0];
-            const double y1 = (*Edata)[x1];
-            dEdcdt = (y1 - y0) / dt_data;
+            const size_t x0 = sample(t);
+            dEdcdt = ((*Edata)[x0 + 1] - (*Edata)[x0]) / dt_data;
         }
         return dEdcdt + omega * dE * std::cos(omega * t + phase);
     }
@@ -133,11 +295,85 @@ struct Efun {
         return -std::pow(omega, 2) * dE * std::sin(omega * t + phase);
     }
     void set_phase(const double new_phase) { phase = new_phase; }
+
+    // true if other gives the same potential at every time
+    bool same_as(const Efun &other) const {
+        const bool same_data =
+            Edata == other.Edata ||
+            (Edata != NULL && other.Edata != NULL && *Edata == *other.Edata);
+        return same_data && Estart == other.Estart &&
+               Ereverse == other.Ereverse && dE == other.dE &&
+               omega == other.omega && phase == other.phase &&
+               dt == other.dt && dt_data == other.dt_data;
+    }
+
     double Estart, Ereverse, dE, omega, dt, treverse;
     double phase;
     int direction;
     const std::vector<double> *Edata;
     double dt_data;
+
+   private:
+    // index of the sample at the start of the interval containing t
+    size_t sample(const double t) const {
+        const double x = std::max(t / dt_data, 0.0);
+        return std::min<size_t>(std::floor(x), Edata->size() - 2);
+    }
+};
+
+// the applied potential of a simulation with parameters params (ECParams or
+// POMParams): the measured potential params.Edata, sampled every
+// params.dt_data from t = 0, if given, otherwise the dc ramp from Estart to
+// Ereverse and back plus the sine wave
+template <typename Params>
+Efun applied_potential(const Params &params, const double phase,
+                       const double dt) {
+    if (!params.Edata.empty()) {
+        if (params.Edata.size() < 2 || !(params.dt_data > 0))
+            throw std::runtime_error(
+                "a measured potential needs at least two samples and "
+                "dt_data > 0");
+        return Efun(&params.Edata, params.dt_data, 0.0, params.omega, phase,
+                    dt);
+    }
+    return Efun(params.Estart, params.Ereverse, params.dE, params.omega,
+                phase, dt);
+}
+
+// the applied potential E and its time derivative dEdt tabulated at the half
+// steps t = k dt / 2 of a fixed-step solver, so that the stepping loops
+// evaluate neither the sine wave nor the dc ramp. The table is only
+// recalculated when the potential changes or more steps are needed, so a
+// simulator reuses it for every parameter set of a fit that leaves the
+// potential alone. A copy starts empty, as the potential it was made for may
+// point into the parameters of another simulator
+struct Etable {
+    Etable() : steps(-1) {}
+    Etable(const Etable &) : steps(-1) {}
+    Etable &operator=(const Etable &) {
+        steps = -1;
+        return *this;
+    }
+
+    // tabulates fun for (at least) the steps up to time t_end, doing
+    // nothing if it already is
+    void update(const Efun &fun_new, const double t_end) {
+        const long n = static_cast<long>(std::ceil(t_end / fun_new.dt)) + 2;
+        if (n <= steps && fun_new.same_as(fun)) return;
+        fun = fun_new;
+        steps = n;
+        E.resize(2 * n + 1);
+        dEdt.resize(2 * n + 1);
+        for (long k = 0; k <= 2 * n; ++k) {
+            const double t = 0.5 * k * fun.dt;
+            E[k] = fun(t);
+            dEdt[k] = fun.ddt(t);
+        }
+    }
+
+    Efun fun;
+    long steps;
+    std::vector<double> E, dEdt;
 };
 
 #endif
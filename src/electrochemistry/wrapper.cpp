@@ -1,11 +1,77 @@
 #include <pybind11/pybind11.h>
+#include <limits>
 #include "e_implicit_exponential_mesh.hpp"
+#include "joint.hpp"
 #include "seq_electron_transfer3_explicit.hpp"
 
 namespace py = pybind11;
 using namespace electrochemistry;
 
 PYBIND11_MODULE(electrochemistry, m) {
-    m.def("e_implicit_exponential_mesh", &e_implicit_exponential_mesh);
-    m.def("seq_electron_transfer3_explicit", &seq_electron_transfer3_explicit);
+    m.def("e_implicit_exponential_mesh", &e_implicit_exponential_mesh,
+          py::arg("params"), py::arg("Itot"), py::arg("t"),
+          py::arg("stats") = false);
+    m.def("seq_electron_transfer3_explicit", &seq_electron_transfer3_explicit,
+          py::arg("params"), py::arg("Itot"), py::arg("t"),
+          py::arg("stats") = false);
+    m.def("e_implicit_exponential_mesh_sensitivities",
+          &e_implicit_exponential_mesh_sensitivities);
+    m.def("seq_electron_transfer3_explicit_sensitivities",
+          &seq_electron_transfer3_explicit_sensitivities);
+    m.def("e_implicit_exponential_mesh_sum_of_squares",
+          &e_implicit_exponential_mesh_sum_of_squares, py::arg("params"),
+          py::arg("data"), py::arg("t"),
+          py::arg("threshold") = std::numeric_limits<double>::infinity());
+    m.def("seq_electron_transfer3_explicit_sum_of_squares",
+          &seq_electron_transfer3_explicit_sum_of_squares, py::arg("params"),
+          py::arg("data"), py::arg("t"),
+          py::arg("threshold") = std::numeric_limits<double>::infinity());
+    m.def("e_implicit_exponential_mesh_batch",
+          &e_implicit_exponential_mesh_batch, py::arg("params"),
+          py::arg("names"), py::arg("values"), py::arg("Itot"), py::arg("t"),
+          py::arg("n_threads") = 0);
+    m.def("seq_electron_transfer3_explicit_batch",
+          &seq_electron_transfer3_explicit_batch, py::arg("params"),
+          py::arg("names"), py::arg("values"), py::arg("Itot"), py::arg("t"),
+          py::arg("n_threads") = 0);
+    m.def("joint_sum_of_squares", &joint_sum_of_squares,
+          py::arg("simulators"), py::arg("values"), py::arg("t"),
+          py::arg("data"), py::arg("thresholds"), py::arg("sums"),
+          py::arg("n_threads") = 0);
+    m.def("joint_simulate", &joint_simulate, py::arg("simulators"),
+          py::arg("values"), py::arg("t"), py::arg("Itot"),
+          py::arg("n_threads") = 0);
+
+    py::class_<ECSimulator>(m, "ECSimulator")
+        .def(py::init<py::dict, py::list>(), py::arg("params"),
+             py::arg("names"))
+        .def("simulate", &ECSimulator::simulate, py::arg("values"),
+             py::arg("t"), py::arg("Itot"))
+        .def("sum_of_squares", &ECSimulator::sum_of_squares,
+             py::arg("values"), py::arg("t"), py::arg("data"),
+             py::arg("threshold") = std::numeric_limits<double>::infinity())
+        .def("start", &ECSimulator::start, py::arg("values"), py::arg("t_end"))
+        .def("advance", &ECSimulator::advance, py::arg("t"), py::arg("Itot"))
+        .def("get_state", &ECSimulator::get_state)
+        .def("set_state", &ECSimulator::set_state, py::arg("state"))
+        .def("enable_stats", &ECSimulator::enable_stats,
+             py::arg("enabled") = true)
+        .def("get_stats", &ECSimulator::get_stats)
+        .def("reset_stats", &ECSimulator::reset_stats);
+    py::class_<POMSimulator>(m, "POMSimulator")
+        .def(py::init<py::dict, py::list>(), py::arg("params"),
+             py::arg("names"))
+        .def("simulate", &POMSimulator::simulate, py::arg("values"),
+             py::arg("t"), py::arg("Itot"))
+        .def("sum_of_squares", &POMSimulator::sum_of_squares,
+             py::arg("values"), py::arg("t"), py::arg("data"),
+             py::arg("threshold") = std::numeric_limits<double>::infinity())
+        .def("start", &POMSimulator::start, py::arg("values"))
+        .def("advance", &POMSimulator::advance, py::arg("t"), py::arg("Itot"))
+        .def("get_state", &POMSimulator::get_state)
+        .def("set_state", &POMSimulator::set_state, py::arg("state"))
+        .def("enable_stats", &POMSimulator::enable_stats,
+             py::arg("enabled") = true)
+        .def("get_stats", &POMSimulator::get_stats)
+        .def("reset_stats", &POMSimulator::reset_stats);
 }
@@ -118,6 +118,984 @@ class TestModel(unittest.TestCase):
         self.assertEqual(len(values), len(values2))
         self.assertTrue(np.all(np.array(values) == np.array(values2)))
 
+    def test_ec_batch(self):
+        """
+        Simulates several parameter sets at once.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        parameters = ['E0', 'k0', 'Cdl']
+        pints_model = electrochemistry.PintsModelAdaptor(model, parameters)
+        real = np.array([model.params[x] for x in parameters])
+        batch = np.array([real, 1.01 * real, 0.99 * real])
+
+        values = pints_model.simulate_batch(batch, times)
+        self.assertEqual(values.shape, (3, len(times)))
+        for row, vector in zip(values, batch):
+            expected = pints_model.simulate(vector, times)
+            self.assertTrue(np.allclose(row, expected, rtol=1e-12, atol=0))
+
+    def test_poms_batch(self):
+        """
+        Simulates several parameter sets at once.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.POMModel(DEFAULT_POMS)
+        times = np.linspace(0, 4.0, 150)
+        parameters = ['E01', 'k11', 'alpha21', 'Cdl']
+        pints_model = electrochemistry.PintsModelAdaptor(model, parameters)
+        real = np.array([model.params[x] for x in parameters])
+        batch = np.array([real, 1.01 * real])
+
+        values = pints_model.simulate_batch(batch, times, n_threads=2)
+        self.assertEqual(values.shape, (2, len(times)))
+        self.assertGreater(np.max(np.abs(values[1] - values[0])), 0)
+        for row, vector in zip(values, batch):
+            expected = pints_model.simulate(vector, times)
+            self.assertTrue(np.allclose(row, expected, rtol=1e-12, atol=0))
+
+    def test_ec_threads(self):
+        """
+        Evaluates the wrapped model from several threads at once.
+        """
+        import electrochemistry
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        parameters = ['E0', 'k0', 'Cdl']
+        pints_model = electrochemistry.PintsModelAdaptor(model, parameters)
+        real = np.array([model.params[x] for x in parameters])
+        batch = [real * (1 + 0.01 * i) for i in range(4)]
+
+        expected = [pints_model.simulate(x, times) for x in batch]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            values = list(pool.map(
+                lambda x: pints_model.simulate(x, times), batch))
+        for value, expect in zip(values, expected):
+            self.assertTrue(np.all(value == expect))
+
+        # the shared model is left unchanged
+        self.assertTrue(np.all(
+            real == np.array([model.params[x] for x in parameters])))
+
+    def test_ec_simulator(self):
+        """
+        Reuses one compiled simulator for several parameter sets.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        parameters = ['E0', 'k0', 'omega']
+        simulator = model.simulator(parameters)
+        real = np.array([model.params[x] for x in parameters])
+        current = np.empty_like(times)
+        for vector in [1.01 * real, real, [real[0], real[1], 1.1 * real[2]]]:
+            simulator.simulate(np.array(vector, dtype='double'), times,
+                               current)
+            params = model.params_from_vector(vector, parameters)
+            self.assertTrue(np.all(current == model.simulate(times, params)))
+            self.assertEqual(
+                simulator.sum_of_squares(np.array(vector, dtype='double'),
+                                         times, current), 0)
+
+        # the adaptor notices changes to the model's parameters
+        pints_model = electrochemistry.PintsModelAdaptor(model, ['E0'])
+        before = pints_model.simulate([real[0]], times)
+        model.params['Cdl'] *= 2
+        after = pints_model.simulate([real[0]], times)
+        self.assertTrue(np.all(after == model.simulate(times)))
+        self.assertFalse(np.all(after == before))
+
+    def test_transform(self):
+        """
+        Converts parameter vectors to dimensional values and back.
+        """
+        import electrochemistry
+        import numpy as np
+
+        for model, parameters in [
+                (electrochemistry.ECModel(DEFAULT),
+                 ['E0', 'k0', 'Cdl', 'Ru', 'alpha', 'omega']),
+                (electrochemistry.POMModel(DEFAULT_POMS),
+                 ['E01', 'k11', 'alpha21', 'Cdl', 'Ru', 'omega'])]:
+            pints_model = electrochemistry.PintsModelAdaptor(model, parameters)
+            real = np.array([model.params[x] for x in parameters])
+            dim = np.array([model.dim_params[x] for x in parameters])
+            self.assertTrue(np.allclose(pints_model.dimensionalise(real), dim,
+                                        rtol=1e-12, atol=0))
+
+            samples = real * np.linspace(0.5, 1.5, 7)[:, np.newaxis]
+            dim_samples = pints_model.dimensionalise(samples)
+            self.assertEqual(dim_samples.shape, samples.shape)
+            for row, dim_row in zip(samples, dim_samples):
+                expected = [model.dimensionalise(x, name)
+                            for x, name in zip(row, parameters)]
+                self.assertTrue(np.allclose(dim_row, expected, rtol=1e-12,
+                                            atol=0))
+            self.assertTrue(np.allclose(
+                pints_model.non_dimensionalise(dim_samples), samples,
+                rtol=1e-12, atol=0))
+
+    def test_ec_adaptive(self):
+        """
+        Compares adaptive time stepping with a fine fixed step simulation.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        fine = dict(model.params, Nt=4000)
+        expected = model.simulate(times, fine)
+        scale = np.max(np.abs(expected))
+
+        adaptive = dict(model.params, rtol=1e-5, atol=1e-5)
+        values = model.simulate(times, adaptive)
+        self.assertTrue(np.allclose(values, expected, rtol=0,
+                                    atol=1e-3 * scale))
+
+        # as accurate as the default Nt = 200, with far fewer steps (counting
+        # those rejected) and few rejections
+        values, fixed_stats = model.simulate(times, stats=True)
+        fixed_error = np.max(np.abs(values - expected))
+        adaptive = dict(model.params, rtol=1e-3, atol=1e-3)
+        values, stats = model.simulate(times, adaptive, stats=True)
+        self.assertLess(np.max(np.abs(values - expected)), fixed_error)
+        attempted = stats['steps'] + stats['rejected_steps']
+        self.assertLess(attempted, fixed_stats['steps'] / 3)
+        self.assertLess(stats['rejected_steps'], 0.05 * attempted)
+
+        self.assertRaises(RuntimeError, model.simulateS1, times, ['E0'],
+                          adaptive)
+
+    def test_ec_domain_width(self):
+        """
+        Chooses the width of the spatial domain from the simulated times.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        expected = model.simulate(times)
+        scale = np.max(np.abs(expected))
+
+        # a wider domain, chosen from the times, changes little
+        values = model.simulate(times, dict(model.params, Xmax=0))
+        self.assertTrue(np.allclose(values, expected, rtol=0,
+                                    atol=1e-4 * scale))
+
+    def test_poms_couples(self):
+        """
+        Simulates different numbers of sequential couples.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.POMModel(DEFAULT_POMS)
+        self.assertEqual(model.params['N'], 3)
+        times = np.linspace(0, 10.0, 300)
+        expected = model.simulate(times)
+
+        # couples with zero rate constants are never reached
+        params = dict(model.params, N=4, k31=0.0, k32=0.0)
+        self.assertTrue(np.all(model.simulate(times, params) == expected))
+        params = dict(model.params, k21=0.0, k22=0.0)
+        self.assertTrue(np.all(model.simulate(times, params) ==
+                               model.simulate(times, dict(model.params, N=2))))
+
+        for n in range(1, 7):
+            values = model.simulate(times, dict(model.params, N=n))
+            self.assertTrue(np.all(np.isfinite(values)))
+        self.assertRaises(RuntimeError, model.simulate, times,
+                          dict(model.params, N=7))
+
+    def test_poms_adaptive(self):
+        """
+        Compares adaptive time stepping with a fine fixed step simulation.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.POMModel(DEFAULT_POMS)
+        times = np.linspace(0, 10.0, 300)
+        fine = dict(model.params, Nt=50000)
+        expected = model.simulate(times, fine)
+
+        adaptive = dict(model.params, rtol=1e-4)
+        values = model.simulate(times, adaptive)
+        self.assertTrue(np.allclose(values, expected, rtol=0,
+                                    atol=1e-3 * np.max(np.abs(expected))))
+
+        self.assertRaises(RuntimeError, model.simulateS1, times, ['E01'],
+                          adaptive)
+
+    def test_chunks(self):
+        """
+        Simulates a chunk at a time, resuming from a pickled state.
+        """
+        import electrochemistry
+        import numpy as np
+        import pickle
+
+        for model in [electrochemistry.ECModel(DEFAULT),
+                      electrochemistry.POMModel(DEFAULT_POMS)]:
+            times = np.linspace(0, 10.0, 1000)
+            for params in [model.params, dict(model.params, Xmax=0)]:
+                expected = model.simulate(times, params)
+                chunks = model.simulate_chunks(times, 300, params)
+                current, state = next(chunks)
+                values = [current] + [current for current, _ in chunks]
+                self.assertEqual([len(v) for v in values],
+                                 [300, 300, 300, 100])
+                self.assertTrue(np.all(np.concatenate(values) == expected))
+
+                state = pickle.loads(pickle.dumps(state))
+                values = [current for current, _ in model.simulate_chunks(
+                    times[300:], 500, params, state)]
+                self.assertTrue(np.all(np.concatenate(values) ==
+                                       expected[300:]))
+
+            self.assertRaises(
+                RuntimeError, next,
+                model.simulate_chunks(times, 300, dict(model.params,
+                                                       rtol=1e-4)))
+
+    def test_stats(self):
+        """
+        Records solver stats, and aggregates them over many simulations.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        expected = model.simulate(times)
+        values, stats = model.simulate(times, stats=True)
+        self.assertTrue(np.all(values == expected))
+        self.assertEqual(stats['simulations'], 1)
+        self.assertGreater(stats['steps'], 0)
+        self.assertEqual(stats['newton_solves'], stats['steps'])
+        self.assertEqual(sum(stats['newton_histogram']), stats['steps'])
+        self.assertEqual(len(stats['newton_histogram']),
+                         stats['max_newton_iterations'] + 1)
+        self.assertGreater(stats['seconds']['total'], 0)
+
+        model = electrochemistry.POMModel(DEFAULT_POMS)
+        times = np.linspace(0, 10.0, 300)
+        params = dict(model.params, rtol=1e-4)
+        values, stats = model.simulate(times, params, stats=True)
+        self.assertGreater(stats['newton_solves'], stats['steps'])
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        parameters = ['E0', 'k0', 'Cdl']
+        pints_model = electrochemistry.PintsModelAdaptor(
+            model, parameters, record_stats=True)
+        real = np.array([model.params[x] for x in parameters])
+        pints_model.simulate(real, times)
+        steps = pints_model.stats()['steps']
+        pints_model.sum_of_squares(real, times, expected)
+        model.params['Nt'] = 100
+        pints_model.simulate(real, times)
+        stats = pints_model.stats()
+        self.assertEqual(stats['simulations'], 3)
+        self.assertEqual(stats['steps'], 2.5 * steps)
+
+        # parameters of failed simulations
+        model.params['rtol'] = model.params['atol'] = 1e-300
+        self.assertRaises(RuntimeError, pints_model.simulate, real, times)
+        stats = pints_model.stats()
+        self.assertEqual(stats['simulations'], 4)
+        self.assertEqual(len(stats['failures']), 1)
+        self.assertEqual(stats['failures'][0]['params']['k0'], real[1])
+        pints_model.reset_stats()
+        self.assertEqual(pints_model.stats()['simulations'], 0)
+
+    def test_ec_boundary_integral(self):
+        """
+        The boundary integral engine converges to the finite difference
+        solution.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        differences = []
+        for Nt in [200, 1000]:
+            params = dict(model.params, Nt=Nt)
+            expected = model.simulate(times, params)
+            current = model.simulate(
+                times, dict(params, integral_tol=1e-8))
+            differences.append(np.max(np.abs(current - expected)) /
+                               np.max(np.abs(expected)))
+        self.assertLess(differences[0], 1e-2)
+        self.assertLess(differences[1], differences[0] / 3)
+
+        model.params['integral_tol'] = 1e-8
+        names = ['E0', 'k0', 'Cdl']
+        real = np.array([model.params[x] for x in names])
+        batch = model.simulate_batch(np.array([real, real]), names, times)
+        self.assertTrue(np.all(batch[1] == model.simulate(times)))
+        self.assertRaises(RuntimeError, model.simulateS1, times, names)
+
+    def test_measured_potential(self):
+        """
+        Simulating with the sampled dc ramp and sine wave as a measured
+        potential gives the same current.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        expected = model.simulate(times)
+
+        # the potential applied by the potentiostat, before the model
+        # mirrors the reversed scan
+        dt = 1e-4
+        t = dt * np.arange(int(14 / dt))
+        v = abs(DEFAULT['v'])
+        treverse = (DEFAULT['Estart'] - DEFAULT['Ereverse']) / v
+        potential = np.where(t < treverse, DEFAULT['Estart'] - v * t,
+                             DEFAULT['Ereverse'] + v * (t - treverse))
+        potential += DEFAULT['dE'] * np.sin(
+            2 * math.pi * DEFAULT['omega'] * t + DEFAULT['phase'])
+        model.set_potential(potential, dt)
+
+        scale = np.max(np.abs(expected))
+        current = model.simulate(times)
+        self.assertLess(np.max(np.abs(current - expected)) / scale, 1e-3)
+
+        # fits reuse the potential, and cache and compare it by value
+        names = ['E0', 'k0']
+        cache = electrochemistry.SimulationCache()
+        adaptor = electrochemistry.PintsModelAdaptor(model, names,
+                                                     cache=cache)
+        real = model.get_params_from_vector(names)
+        self.assertTrue(np.all(adaptor.simulate(real, times) == current))
+        self.assertTrue(np.all(adaptor.simulate(real, times) == current))
+        self.assertEqual(cache.hits, 1)
+        model.set_potential(potential + 0.01, dt)
+        self.assertFalse(np.all(adaptor.simulate(real, times) == current))
+
+        model.set_potential(None, dt)
+        self.assertTrue(np.all(model.simulate(times) == expected))
+        self.assertRaises(ValueError, model.set_potential, potential[:1], dt)
+
+    def test_ec_newton_fallback(self):
+        """
+        The root of the boundary condition is found outside the Newton
+        bracket when the double layer current is large and Ru is zero.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.ECModel(dict(DEFAULT, Ru=0.0, Cdl=0.01))
+        times = model.suggest_times()
+        current, stats = model.simulate(times, stats=True)
+        self.assertGreater(stats['fallbacks'], 0)
+        self.assertLess(stats['newton_iterations'] / stats['newton_solves'],
+                        3)
+
+        reference = model.simulate(times, dict(model.params, Nt=2000))
+        error = np.max(np.abs(current - reference)) / \
+            np.max(np.abs(reference))
+        self.assertLess(error, 0.05)
+
+    def test_ec_sensitivities(self):
+        """
+        Compares forward sensitivities with finite differences.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        parameters = ['E0', 'k0', 'Cdl', 'Ru', 'alpha']
+        pints_model = electrochemistry.PintsModelAdaptor(model, parameters)
+        real = np.array([model.params[x] for x in parameters])
+
+        values, dvalues = pints_model.simulateS1(real, times)
+        self.assertEqual(dvalues.shape, (len(times), len(parameters)))
+        self.assertTrue(np.all(values == pints_model.simulate(real, times)))
+        for j in range(len(parameters)):
+            h = np.zeros(len(parameters))
+            h[j] = 1e-6 * real[j]
+            fd = (pints_model.simulate(real + h, times) -
+                  pints_model.simulate(real - h, times)) / (2 * h[j])
+            self.assertTrue(np.allclose(dvalues[:, j], fd, rtol=0,
+                                        atol=1e-5 * np.max(np.abs(fd))))
+
+    def test_poms_sensitivities(self):
+        """
+        Compares forward sensitivities with finite differences.
+        """
+        import electrochemistry
+        import numpy as np
+
+        model = electrochemistry.POMModel(DEFAULT_POMS)
+        times = np.linspace(0, 4.0, 150)
+        parameters = ['E01', 'Cdl', 'Ru', 'gamma']
+        pints_model = electrochemistry.PintsModelAdaptor(model, parameters)
+        real = np.array([model.params[x] for x in parameters])
+
+        values, dvalues = pints_model.simulateS1(real, times)
+        self.assertEqual(dvalues.shape, (len(times), len(parameters)))
+        self.assertTrue(np.all(values == pints_model.simulate(real, times)))
+        for j in range(len(parameters)):
+            h = np.zeros(len(parameters))
+            h[j] = 1e-3 * max(abs(real[j]), 1)
+            fd = (pints_model.simulate(real + h, times) -
+                  pints_model.simulate(real - h, times)) / (2 * h[j])
+            self.assertTrue(np.allclose(dvalues[:, j], fd, rtol=0,
+                                        atol=1e-2 * np.max(np.abs(fd))))
+
+        # the couples the model does not have have no sensitivities
+        self.assertEqual(model.params['N'], 3)
+        for name in ['E31', 'k41', 'omega']:
+            self.assertRaises(RuntimeError, model.simulateS1, times,
+                              ['E01', name])
+
+    def test_ec_sum_of_squares(self):
+        """
+        Compares the in-kernel error measures with pints' own.
+        """
+        import electrochemistry
+        import numpy as np
+        import pints
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        parameters = ['E0', 'k0', 'Cdl']
+        pints_model = electrochemistry.PintsModelAdaptor(model, parameters)
+        real = np.array([model.params[x] for x in parameters])
+        values = pints_model.simulate(real, times)
+        values += np.random.RandomState(1).normal(0, 0.01, len(times))
+        problem = pints.SingleOutputProblem(pints_model, times, values)
+        x = 1.01 * real
+
+        error = electrochemistry.SumOfSquaresError(problem)
+        expected_error = pints.SumOfSquaresError(problem)(x)
+        self.assertAlmostEqual(error(x) / expected_error, 1.0, places=12)
+
+        log_likelihood = electrochemistry.GaussianKnownSigmaLogLikelihood(
+            problem, 0.01)
+        expected_log_likelihood = pints.GaussianKnownSigmaLogLikelihood(
+            problem, 0.01)(x)
+        self.assertAlmostEqual(
+            log_likelihood(x) / expected_log_likelihood, 1.0, places=12)
+
+        # stops early once the threshold is exceeded
+        error.threshold = 0.5 * expected_error
+        self.assertGreater(error(x), error.threshold)
+        self.assertLess(error(x), expected_error)
+        offset = -0.5 * len(times) * np.log(2 * np.pi * 0.01**2)
+        log_likelihood.threshold = 0.5 * (offset + expected_log_likelihood)
+        self.assertLess(log_likelihood(x), log_likelihood.threshold)
+        self.assertGreater(log_likelihood(x), expected_log_likelihood)
+
+    def test_harmonics(self):
+        """
+        Extracts harmonics, and compares them in an error measure.
+        """
+        import electrochemistry
+        import numpy as np
+        import pints
+
+        # envelopes of a signal with known harmonics
+        omega = 2.0
+        times = np.linspace(0, 100 * 2 * np.pi / omega, 10000, endpoint=False)
+        current = 0.5 + 2.0 * np.sin(omega * times) + \
+            0.3 * np.cos(3 * omega * times + 1.0)
+        transform = electrochemistry.HarmonicTransform(times, omega, [0, 1, 3])
+        envelopes = transform.envelopes(current)
+        self.assertTrue(np.allclose(envelopes[:, 1000:-1000].T,
+                                    [0.5, 2.0, 0.3], rtol=1e-6))
+
+        # the sum of squares is that of the filtered signals
+        other = current + 0.1 * np.sin(3 * omega * times)
+        filtered = electrochemistry.HarmonicTransform(times, omega, [3])
+        a = filtered.coefficients(current)
+        b = filtered.coefficients(other)
+        self.assertAlmostEqual(filtered.sum_of_squares(a, b),
+                               np.sum((0.1 * np.sin(3 * omega * times))**2))
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        parameters = ['E0', 'k0', 'Cdl']
+        pints_model = electrochemistry.PintsModelAdaptor(model, parameters)
+        real = np.array([model.params[x] for x in parameters])
+        values = pints_model.simulate(real, times)
+        problem = pints.SingleOutputProblem(pints_model, times, values)
+        error = electrochemistry.HarmonicSumOfSquaresError(
+            problem, [1, 2, 3, 4])
+        self.assertEqual(error(real), 0)
+
+        x = 1.01 * real
+        value, derivative = error.evaluateS1(x)
+        self.assertAlmostEqual(value / error(x), 1.0)
+        for i in range(len(x)):
+            h = 1e-6 * x[i]
+            xh = np.array(x)
+            xh[i] += h
+            self.assertAlmostEqual(
+                (error(xh) - value) / h / derivative[i], 1.0, places=3)
+
+    def test_multilevel_fidelity(self):
+        """
+        Estimates the discretisation error of each mesh level, selects the
+        cheapest level meeting a tolerance, and refines a fit's level as it
+        stops improving.
+        """
+        import electrochemistry
+        import numpy as np
+        import os
+        import pints
+        import shutil
+        import tempfile
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        reference = model.simulate(times, dict(model.params, Nt=6400))
+        scale = np.max(np.abs(reference))
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'levels.json')
+            fidelity = electrochemistry.MultilevelFidelity(
+                model, filename=filename)
+            level = fidelity.select(times, 1e-2)
+            error, extrapolated = fidelity.error_estimate(times, level)
+            self.assertLess(error, 1e-2)
+            self.assertGreater(fidelity.error_estimate(times, level - 1)[0],
+                               1e-2)
+            current = fidelity.simulate(times, level)
+            true_error = np.max(np.abs(current - reference)) / scale
+            self.assertLess(true_error, error)
+            self.assertGreater(true_error, error / 2)
+            self.assertLess(np.max(np.abs(extrapolated - reference)) / scale,
+                            true_error / 2)
+            self.assertAlmostEqual(
+                fidelity.observed_order(times, level), 1, delta=0.2)
+
+            # the selection is cached by protocol, and saved
+            cached = electrochemistry.MultilevelFidelity(
+                model, filename=filename)
+            self.assertEqual(cached.select(times, 1e-2), level)
+            self.assertEqual(len(cached._selections), 1)
+        finally:
+            shutil.rmtree(directory)
+
+        # the level is changed by the controller between iterations, so the
+        # worker processes of either evaluator use the same level
+        names = ['E0', 'k0', 'Cdl']
+        real = np.array([model.params[x] for x in names])
+        pints_model = electrochemistry.PintsModelAdaptor(
+            model, names, fidelity=fidelity, tolerance=1e-2, patience=2)
+        problem = pints.SingleOutputProblem(pints_model, times, reference)
+        error = electrochemistry.SumOfSquaresError(problem)
+        positions = [real, 1.01 * real]
+        values = []
+        with electrochemistry.ProcessPoolEvaluator(
+                error, n_workers=2) as evaluator:
+            for _ in range(3 * (level + 1)):
+                expected = [error(x) for x in positions]
+                self.assertEqual(pints.ParallelEvaluator(
+                    error, n_workers=2).evaluate(positions), expected)
+                self.assertEqual(evaluator.evaluate(positions), expected)
+                values.append(expected[0])
+                if pints_model.update_level(times, min(expected)):
+                    evaluator.restart()
+        self.assertEqual(pints_model.max_level, level)
+        self.assertEqual(pints_model.level, level)
+        self.assertEqual(len(set(values)), level + 1)
+        self.assertTrue(np.all(
+            pints_model.simulate(real, times) == current))
+
+    def test_sweep(self):
+        """
+        Sweeps parameter sets into a memory-mapped array, resuming an
+        interrupted sweep.
+        """
+        import electrochemistry
+        import electrochemistry.sweep
+        import json
+        import numpy as np
+        import os
+        import shutil
+        import tempfile
+
+        spec = {
+            'model': 'ec',
+            'params': DEFAULT,
+            'solver': {'Nt': 50, 'Nx': 100},
+            'ranges': {'E0': [0.2, 0.25], 'k0': [0.001, 0.1]},
+            'log': ['k0'],
+            'design': 'grid',
+            'points': {'E0': 3, 'k0': 4},
+            'times': [0, 2, 50],
+        }
+        model = electrochemistry.sweep.sweep_model(spec)
+        names = ['E0', 'k0']
+        parameters = electrochemistry.sweep.sweep_design(spec)
+        self.assertEqual(parameters.shape, (12, 2))
+        self.assertTrue(np.allclose(np.unique(parameters[:, 1]),
+                                    np.geomspace(0.001, 0.1, 4)))
+        vectors = model.transform(names, experiment=True).non_dimensionalise(
+            parameters)
+        times = electrochemistry.sweep.sweep_times(spec, model)
+        expected = model.simulate_batch(vectors, names, times)
+
+        # E0 is mirrored for a reversed scan, as by the model itself
+        other = electrochemistry.ECModel(
+            dict(DEFAULT, E0=parameters[5, 0], k0=parameters[5, 1]))
+        self.assertTrue(np.allclose(vectors[5],
+                                    [other.params[x] for x in names]))
+
+        directory = tempfile.mkdtemp()
+        try:
+            output = os.path.join(directory, 'sweep')
+            messages = []
+
+            def interrupt(message):
+                messages.append(message)
+                if len(messages) == 2:
+                    raise KeyboardInterrupt()
+
+            self.assertRaises(
+                KeyboardInterrupt, electrochemistry.run_sweep, spec, output,
+                chunk_size=5, report=interrupt)
+            with open(os.path.join(output, 'completed.txt')) as f:
+                self.assertEqual(f.read(), '0\n1\n')
+
+            # resumes with the last chunk, whatever the chunk size given
+            spec_filename = os.path.join(directory, 'spec.json')
+            with open(spec_filename, 'w') as f:
+                json.dump(spec, f)
+            electrochemistry.sweep.main([spec_filename, output,
+                                         '--chunk-size', '100'])
+            with open(os.path.join(output, 'completed.txt')) as f:
+                self.assertEqual(f.read(), '0\n1\n2\n')
+            current = np.load(os.path.join(output, 'current.npy'),
+                              mmap_mode='r')
+            self.assertTrue(np.all(current == expected))
+
+            self.assertRaises(ValueError, electrochemistry.run_sweep,
+                              dict(spec, points=2), output)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_multi_experiment(self):
+        """
+        Fits shared parameters to experiments with different protocols,
+        simulated concurrently.
+        """
+        import electrochemistry
+        import numpy as np
+
+        names = ['E0', 'k0', 'Cdl']
+        forward = dict(DEFAULT, reversed=False, Estart=DEFAULT['Ereverse'],
+                       Ereverse=DEFAULT['Estart'], v=-DEFAULT['v'],
+                       omega=12.0, dE=0.05, a=0.03)
+        models = [electrochemistry.ECModel(dict(DEFAULT, Nt=50)),
+                  electrochemistry.ECModel(dict(forward, Nt=50))]
+        currents = [model.simulate(np.linspace(0, 2, 200) / model.T0)
+                    for model in models]
+        datasets = [(np.linspace(0, 2, 200) / model.T0, current)
+                    for model, current in zip(models, currents)]
+        joint = electrochemistry.MultiExperimentModel(models, names, datasets)
+        self.assertEqual(joint.n_parameters(), 3)
+
+        # the shared vector maps to each model's own (mirrored) values
+        true = joint.non_dimensionalise([DEFAULT[x] for x in names])
+        for model, vector in zip(models, joint.experiment_vectors(true)):
+            self.assertTrue(np.allclose(
+                vector, model.get_params_from_vector(names)))
+        for simulated, current in zip(joint.simulate(true), currents):
+            self.assertTrue(np.allclose(simulated, current))
+
+        x = true * [1.02, 0.8, 1.1]
+        sums = joint.sums_of_squares(x)
+        for model, vector, (times, current), value in zip(
+                models, joint.experiment_vectors(x), datasets, sums):
+            expected = model.sum_of_squares(
+                current, times, model.params_from_vector(vector, names))
+            self.assertAlmostEqual(value / expected, 1)
+        self.assertTrue(np.all(sums > 0))
+        self.assertTrue(np.allclose(joint.sums_of_squares(true), 0))
+        total = joint.sum_of_squares(x)
+        self.assertAlmostEqual(total / np.sum(joint.weights * sums), 1)
+        self.assertAlmostEqual(
+            joint.weights[1], (models[1].I0 / models[0].I0)**2)
+
+        # stopped early once certain to exceed the threshold
+        self.assertGreater(joint.sum_of_squares(x, total / 10), total / 10)
+        self.assertLess(joint.sum_of_squares(x, total / 10), total)
+
+        error = electrochemistry.MultiExperimentSumOfSquaresError(joint)
+        self.assertEqual(error(x), total)
+        sigma = np.array([0.01, 0.02])
+        log_likelihood = electrochemistry.MultiExperimentLogLikelihood(
+            joint, sigma)
+        expected = np.sum(-0.5 * 200 * np.log(2 * np.pi * sigma**2) -
+                          sums / (2 * sigma**2))
+        self.assertAlmostEqual(log_likelihood(x) / expected, 1)
+        self.assertLess(log_likelihood(x), log_likelihood(true))
+
+    def test_simulation_cache(self):
+        """
+        Caches simulated currents, evicting the least recently used.
+        """
+        import electrochemistry
+        import numpy as np
+        import os
+        import shutil
+        import tempfile
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        names = ['E0', 'k0', 'Cdl']
+        real = np.array([model.params[x] for x in names])
+        cache = electrochemistry.SimulationCache(
+            max_bytes=2 * times.nbytes)
+        pints_model = electrochemistry.PintsModelAdaptor(
+            model, names, cache=cache)
+
+        expected = pints_model.simulate(real, times)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        current = pints_model.simulate(real, times)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertTrue(np.all(current == expected))
+        data = expected + 0.1
+        error = pints_model.sum_of_squares(real, times, data)
+        self.assertAlmostEqual(error / (0.01 * len(times)), 1.0)
+        self.assertEqual(cache.hits, 2)
+
+        # the returned current doesn't alias the cache
+        current[:] = 0
+        self.assertTrue(np.all(pints_model.simulate(real, times) == expected))
+
+        # other times, or fixed parameters, are other simulations
+        pints_model.simulate(real, times[:-1])
+        model.params['Ru'] *= 2
+        pints_model.simulate(real, times)
+        model.params['Ru'] /= 2
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(len(cache), 2)
+        pints_model.simulate(real, times)
+        self.assertEqual(cache.misses, 4)
+
+        # adaptors sharing the cache, with the parameters in another order,
+        # are other simulations
+        swapped = electrochemistry.PintsModelAdaptor(
+            model, names[::-1], cache=cache)
+        current = swapped.simulate(real, times)
+        self.assertEqual(cache.misses, 5)
+        self.assertTrue(np.all(current == model.simulate(
+            times, model.params_from_vector(real, names[::-1]))))
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'cache.npz')
+            cache.save(filename)
+            cache = electrochemistry.SimulationCache(filename=filename)
+            self.assertEqual(len(cache), 2)
+            pints_model = electrochemistry.PintsModelAdaptor(
+                model, names, cache=cache)
+            self.assertTrue(
+                np.all(pints_model.simulate(real, times) == expected))
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_process_pool(self):
+        """
+        Pickles models quietly, and evaluates an error measure in warm
+        worker processes sharing its arrays.
+        """
+        import contextlib
+        import electrochemistry
+        import io
+        import numpy as np
+        import pickle
+        import pints
+
+        model = electrochemistry.ECModel(DEFAULT)
+        names = ['E0', 'k0', 'Cdl']
+        pints_model = electrochemistry.PintsModelAdaptor(
+            model, names, record_stats=True,
+            cache=electrochemistry.SimulationCache())
+        times = model.suggest_times()
+        real = np.array([model.params[x] for x in names])
+        data = pints_model.simulate(real, times)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            copy = pickle.loads(pickle.dumps(pints_model))
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual(len(copy.cache), 0)
+        self.assertTrue(np.all(copy.simulate(real, times) == data))
+
+        problem = pints.SingleOutputProblem(pints_model, times, data)
+        error = electrochemistry.SumOfSquaresError(problem)
+        positions = [real * x for x in [0.99, 1.0, 1.01]]
+        expected = [error(x) for x in positions]
+        with electrochemistry.ProcessPoolEvaluator(
+                error, n_workers=2, min_shared_bytes=1) as evaluator:
+            self.assertEqual(evaluator.evaluate(positions), expected)
+            self.assertGreaterEqual(evaluator.shared_bytes(),
+                                    times.nbytes + data.nbytes)
+            pool = evaluator._pool
+            self.assertEqual(evaluator.evaluate(positions), expected)
+            self.assertIs(evaluator._pool, pool)
+        self.assertEqual(evaluator.shared_bytes(), 0)
+
+    def test_surrogate(self):
+        """
+        Emulates a model, falling back to it outside the training box, and
+        reuses the saved surrogate for the same protocol only.
+        """
+        import electrochemistry
+        import numpy as np
+        import os
+        import shutil
+        import tempfile
+
+        model = electrochemistry.ECModel(DEFAULT)
+        times = model.suggest_times()
+        names = ['E0', 'k0', 'Cdl']
+        pints_model = electrochemistry.PintsModelAdaptor(model, names)
+        real = np.array([model.params[x] for x in names])
+        surrogate = electrochemistry.SurrogateModel(
+            pints_model, times, 0.95 * real, 1.05 * real, n_train=20,
+            tolerance=1e-2, seed=1)
+
+        x = real * np.array([1.01, 0.98, 1.02])
+        current = surrogate.simulate(x, times)
+        expected = pints_model.simulate(x, times)
+        error = np.sqrt(np.mean((current - expected)**2)) / \
+            np.sqrt(np.mean(expected**2))
+        self.assertLess(error, 1e-3)
+        self.assertLess(error, 10 * surrogate.error_estimate(x))
+        self.assertEqual(surrogate.fallbacks, 0)
+
+        # outside the box, the model is run and added to the training set
+        x = 1.1 * real
+        current = surrogate.simulate(x, times)
+        self.assertTrue(np.all(current == pints_model.simulate(x, times)))
+        self.assertEqual(surrogate.fallbacks, 1)
+        self.assertEqual(surrogate.n_train(), 21)
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'surrogate.npz')
+            surrogate.save(filename)
+            loaded = electrochemistry.SurrogateModel.load(
+                filename, pints_model)
+            self.assertEqual(loaded.n_train(), 21)
+            x = real * np.array([0.99, 1.03, 0.97])
+            self.assertTrue(np.all(
+                loaded.simulate(x, times) == surrogate.simulate(x, times)))
+
+            model.params['Ru'] *= 2
+            self.assertRaises(ValueError, electrochemistry.SurrogateModel.load,
+                              filename, pints_model)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_data_cache(self):
+        """
+        Reads a datafile, through its binary cache on later reads.
+        """
+        import electrochemistry.data
+        import numpy as np
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'data.txt')
+            data = np.random.RandomState(1).normal(size=(100, 3))
+            np.savetxt(filename, data, header='\n' * 18)
+
+            times, current = electrochemistry.data.read_cvsin_type_1(filename)
+            self.assertTrue(np.all(times == data[:, 2]))
+            self.assertTrue(np.all(current == data[:, 1]))
+            self.assertTrue(os.path.exists(filename + '.npy'))
+
+            times, current = electrochemistry.data.read_cvsin_type_1(filename)
+            self.assertIsInstance(times, np.memmap)
+            self.assertTrue(np.all(times == data[:, 2]))
+            self.assertTrue(np.all(current == data[:, 1]))
+
+            # modifying the datafile invalidates the cache
+            np.savetxt(filename, 2 * data, header='\n' * 18)
+            stat = os.stat(filename)
+            os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+            times, current = electrochemistry.data.read_cvsin_type_1(filename)
+            self.assertTrue(np.all(times == 2 * data[:, 2]))
+            times, current = electrochemistry.data.read_cvsin_type_1(filename)
+            self.assertIsInstance(times, np.memmap)
+            self.assertTrue(np.all(current == 2 * data[:, 1]))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_data_decimation(self):
+        """
+        Trims and decimates a datafile, a chunk at a time.
+        """
+        import electrochemistry
+        import numpy as np
+        import os
+        import shutil
+        import tempfile
+
+        model = electrochemistry.ECModel(DEFAULT)
+        samples_per_period = 1000
+        dt = 1.0 / (model.dim_params['omega'] * samples_per_period)
+        n = 20 * samples_per_period + 321
+        times = dt * np.arange(n)
+        current = np.sin(2 * np.pi * times * model.dim_params['omega'])
+        data = np.array([np.zeros(n), current, times]).T
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'data.txt')
+            np.savetxt(filename, data, header='\n' * 18)
+
+            # trim 50 + 20 samples and the partial period, and average over
+            # windows of 7 samples
+            per_period = 1.0 / (model.dim_params['omega'] *
+                                (times[150] - times[149]))
+            end = n - 20 - int((n - 70) % per_period)
+            expected_times = [np.mean(times[i:min(i + 7, end)])
+                              for i in range(50, end, 7)]
+            expected_current = [np.mean(current[i:min(i + 7, end)])
+                                for i in range(50, end, 7)]
+            for cache, chunk_size in [(False, 2**20), (True, 1000),
+                                      (True, 13)]:
+                ec_data = electrochemistry.ECTimeData(
+                    filename, model, 50, 20, samples_per_period=140,
+                    cache=cache, chunk_size=chunk_size)
+                self.assertTrue(np.allclose(ec_data.times * model.T0,
+                                            expected_times, rtol=1e-12))
+                self.assertTrue(np.allclose(ec_data.current * model.I0,
+                                            expected_current, rtol=0,
+                                            atol=1e-12))
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()